@@ -1,12 +1,41 @@
 
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import (Flask, render_template, request, redirect, url_for, session, jsonify, g,
+                   has_request_context, stream_with_context)
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import Signer, BadSignature
+from werkzeug.datastructures import CallbackDict
 import mysql.connector
+import numpy as np
+import click
 import csv
 import os
 import shutil
+import sqlite3
+import secrets
+import sys
 import hashlib
-from datetime import datetime, timedelta
+import functools
+from collections import Counter, OrderedDict
+from itertools import chain
+from array import array
+import io
+import tempfile
+import uuid
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeout
+from contextlib import contextmanager
+from datetime import datetime, timedelta, date
 import json
+from decimal import Decimal, ROUND_HALF_UP
+import random
+import re
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 # ========================================
 # 1. APP CONFIGURATION
@@ -16,24 +45,599 @@ app.secret_key = "medical_secret_key_production_2026"
 
 # File Paths
 USERS_CSV = "user.csv"
+USERS_FIELDS = ['username', 'password', 'role', 'phone']
+USERS_STAT_INTERVAL = 1.0      # Seconds between checks of user.csv for outside edits
 CSV_FILE = "SearchMedicineData.csv"
 
+# Database Settings
+DB_CONFIG = {
+    "host": "localhost",
+    "user": "root",
+    "password": "",
+    "database": "medical_6thsem"
+}
+DB_POOL_SIZE = 10              # Max open connections per process
+DB_POOL_WAIT_TIMEOUT = 2       # Seconds to wait for a free connection (kept under DASHBOARD_WIDGET_TIMEOUT)
+DB_CONNECT_TIMEOUT = 5         # Seconds to open a new connection
+DB_QUERY_TIMEOUT_MS = 10000    # max_execution_time for SELECT statements
+DB_HEALTHCHECK_IDLE = 30       # Ping connections idle longer than this (seconds)
+
+# Dashboard Cache Settings
+DASHBOARD_CACHE_TTL = 60       # Seconds a cached widget stays fresh
+DASHBOARD_POOL_HEADROOM = 4    # Pool connections left for request threads while widgets load
+DASHBOARD_WORKERS = max(DB_POOL_SIZE - DASHBOARD_POOL_HEADROOM, 1)  # Threads fetching widgets in parallel
+DASHBOARD_WIDGET_TIMEOUT = 3   # Seconds a widget may run (from when it starts) before it renders empty
+DASHBOARD_POLL_INTERVAL = 30   # Seconds between owner dashboard widget polls
+
+# Catalog Import Settings
+IMPORT_CHUNK_SIZE = 1000       # Rows per executemany INSERT / commit
+IMPORT_MAX_REJECTS = 5000      # Rejected rows kept for the error report
+IMPORT_JOB_HISTORY = 20        # Finished import jobs kept in the import_jobs table
+IMPORT_DATE_FORMATS = ('%m/%d/%Y', '%Y-%m-%d', '%d/%m/%Y')
+
+# Reorder Settings
+REORDER_LEAD_TIME_DAYS = 7     # Supplier lead time (expected_delivery of restock orders)
+REORDER_REVIEW_DAYS = 14       # Extra days of demand each order should cover
+REORDER_MIN_HISTORY_DAYS = 28  # Velocity spans each product's full sales history, but at least this many days
+REORDER_SAFETY_Z = 1.65        # Safety stock in std devs of daily demand (~95% service)
+REORDER_DEFAULT_POINT = 15     # Reorder point for products with no sales history
+REORDER_DEFAULT_UP_TO = 50     # Restock target for products with no sales history
+REORDER_WRITE_BATCH = 1000     # reorder_plan rows per executemany
+
+# Expiry Settings
+EXPIRY_ALERT_DAYS = 30         # Default window of the "expiring soon" panel
+EXPIRY_PANEL_LIMIT = 200       # Rows shown per expiry list
+
+# Billing & GST Settings
+GST_SLABS = (0, 5, 12, 18)     # Allowed per-product GST rates (percent, split equally into CGST/SGST)
+GST_DEFAULT_RATE = 5           # Slab for products without a gst_rate of their own
+BILL_DISCOUNT_RATE = 8         # Store discount (percent) on lines no discount rule matches
+PRICING_TTL = 60               # Seconds discount rules and priced carts stay cached
+PRICED_CART_CACHE_SIZE = 1000  # Priced carts kept (least recently used dropped)
+GST_EXPORT_BATCH = 2000        # Ledger lines fetched per keyset query while exporting
+GST_EXPORT_FIELDS = ['invoice_no', 'bill_id', 'bill_date', 'gst_rate', 'gross_amount', 'discount',
+                     'taxable_amount', 'cgst', 'sgst', 'gst', 'total_amount']
+
+# Payment History Settings
+PAYMENT_PAGE_SIZE = 50         # Bills per payment history page
+PAYMENT_EXPORT_BATCH = 2000    # Bills fetched per keyset query while exporting
+PAYMENT_EXPORT_FIELDS = ['bill_id', 'invoice_no', 'customer_name', 'phone', 'total_amount',
+                         'discount', 'gst', 'final_amount', 'bill_date']
+
+# Customer Settings
+CUSTOMER_TOP_LIMIT = 20        # Customers in the top-customer lists
+CUSTOMER_BACKFILL_BATCH = 1000 # Rows read / written per round trip by backfill-customers
+
+# Background Job Settings
+SCHEDULER_ENABLED = True       # Run housekeeping jobs in a background thread of each worker
+SCHEDULER_TICK = 5             # Seconds between checks for due jobs
+SCHEDULER_JITTER = 0.1         # Random +/- fraction applied to every job interval
+ORDER_CLEANUP_INTERVAL = 3600  # Seconds between deletes of long-delivered orders
+ROLLUP_REBUILD_INTERVAL = 6 * 3600  # Seconds between reconciles of recent rollups and the reorder plan
+ROLLUP_REBUILD_DAYS = 2        # Days of rollups (today included) each reconcile rebuilds
+CACHE_WARM_INTERVAL = DASHBOARD_CACHE_TTL - 10  # Re-fill owner widgets just before they expire
+EXPIRY_SWEEP_INTERVAL = 3600   # Seconds between expiry sweeps
+EXPIRY_AUTO_WRITE_OFF = False  # Let the sweep write off expired stock (otherwise it only reports)
+
+# Session Settings
+SESSION_BACKEND = "sqlite"     # "memory" for one process, "sqlite" to share across workers
+SESSION_DB = None              # SQLite file for the sqlite backend (None = sessions.db in app.instance_path)
+SESSION_IDLE_TIMEOUT = 8 * 3600  # Seconds of inactivity before a session (and cart) expires
+SESSION_TOUCH_INTERVAL = 300   # Refresh an unchanged session's expiry at most this often
+SESSION_PURGE_INTERVAL = 600   # Seconds between sweeps of expired sessions
+
+# Search Index Settings
+SEARCH_NGRAM = 3               # Characters per n-gram in the product name index
+SEARCH_LOAD_BATCH = 5000       # Rows fetched per round trip when (re)building the index
+SEARCH_FULL_REBUILD_AT = 500   # Dirty products above which a full rebuild is cheaper
+SEARCH_PAGE_SIZE = 24          # Search results shown per page
+SEARCH_MAX_EDITS = 2           # Edit distance allowed for typo matches (1 for short terms)
+SEARCH_FUZZY_MIN_LEN = 4       # Shorter words only match exactly
+SEARCH_FUZZY_CANDIDATES = 200  # Closest-looking name words checked per typo'd word
+USE_STOPWORDS = {'a', 'an', 'and', 'as', 'by', 'for', 'in', 'of', 'on', 'the', 'to', 'with'}
+USE_FACET_LIMIT = 12           # Related-use pills shown on a category page
+SEARCH_STORE_MAX_BYTES = 32 * 1024 * 1024  # Memory budget for stored search results
+SEARCH_STORE_MAX_ENTRIES = 500 # Stored searches kept (least recently used dropped)
+SEARCH_STORE_TTL = 1800        # Seconds a stored search stays pageable
+SUBSTITUTE_MAX_DEPTH = 2       # Hops followed through substitute0/substitute1 links
+SUBSTITUTE_CACHE_SIZE = 5000   # Cached substitute closures (least recently used dropped)
+SUBSTITUTE_MAX_RESULTS = 5     # Alternatives offered per product
+SUBSTITUTE_SHOW_BELOW = 15     # Stock level under which search/cart suggest alternatives
+
 # ========================================
 # 2. DATABASE & CSV UTILITIES
 # ========================================
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up in time"""
+
+
+class PooledConnection:
+    """Thin wrapper around a MySQL connection; close() hands it back to the pool"""
+
+    def __init__(self, pool, cnx):
+        self._pool = pool
+        self._cnx = cnx
+        self._released = False
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool.release(self._cnx)
+
+    def __getattr__(self, name):
+        return getattr(self._cnx, name)
+
+
+class ConnectionPool:
+    """Fixed-size MySQL connection pool with health checks and usage stats"""
+
+    def __init__(self, config, size, wait_timeout, connect_timeout, query_timeout_ms, healthcheck_idle):
+        self.config = config
+        self.size = size
+        self.wait_timeout = wait_timeout
+        self.connect_timeout = connect_timeout
+        self.query_timeout_ms = query_timeout_ms
+        self.healthcheck_idle = healthcheck_idle
+        self._cond = threading.Condition()
+        self._idle = []          # LIFO stack of (connection, last_used)
+        self._open = 0
+        self._stats = {
+            'checkouts': 0,
+            'failures': 0,
+            'timeouts': 0,
+            'connections_created': 0,
+            'connections_discarded': 0,
+            'health_checks': 0,
+            'wait_time_total': 0.0,
+            'wait_time_max': 0.0,
+        }
+
+    def _connect(self):
+        cnx = mysql.connector.connect(connection_timeout=self.connect_timeout, **self.config)
+        if self.query_timeout_ms:
+            cur = cnx.cursor()
+            try:
+                cur.execute(f"SET SESSION max_execution_time = {int(self.query_timeout_ms)}")
+            except mysql.connector.Error:
+                # MariaDB names it max_statement_time and takes seconds
+                cur.execute(f"SET SESSION max_statement_time = {self.query_timeout_ms / 1000:.3f}")
+            cur.close()
+        with self._cond:
+            self._stats['connections_created'] += 1
+        return cnx
+
+    def _discard(self, cnx):
+        try:
+            cnx.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._open -= 1
+            self._stats['connections_discarded'] += 1
+            self._cond.notify()
+
+    def get(self):
+        """Check out a connection, waiting up to wait_timeout for a free slot"""
+        start = time.monotonic()
+        deadline = start + self.wait_timeout
+        cnx, last_used = None, None
+
+        with self._cond:
+            while True:
+                if self._idle:
+                    cnx, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['timeouts'] += 1
+                    self._stats['failures'] += 1
+                    raise PoolTimeout(f"no free connection after {self.wait_timeout}s")
+                self._cond.wait(remaining)
+
+            waited = time.monotonic() - start
+            self._stats['wait_time_total'] += waited
+            self._stats['wait_time_max'] = max(self._stats['wait_time_max'], waited)
+
+        # Health check: only ping connections that sat idle for a while
+        if cnx is not None and time.monotonic() - last_used > self.healthcheck_idle:
+            with self._cond:
+                self._stats['health_checks'] += 1
+            try:
+                cnx.ping(reconnect=False)
+            except Exception:
+                # Keep the slot, swap the dead connection for a fresh one
+                try:
+                    cnx.close()
+                except Exception:
+                    pass
+                with self._cond:
+                    self._stats['connections_discarded'] += 1
+                cnx = None
+
+        if cnx is None:
+            try:
+                cnx = self._connect()
+            except Exception:
+                with self._cond:
+                    self._open -= 1
+                    self._stats['failures'] += 1
+                    self._cond.notify()
+                raise
+
+        with self._cond:
+            self._stats['checkouts'] += 1
+        return PooledConnection(self, cnx)
+
+    def release(self, cnx):
+        """Return a connection, ending any open transaction so the next user starts clean"""
+        try:
+            if cnx.unread_result:
+                cnx.consume_results()
+            if cnx.in_transaction:
+                cnx.rollback()
+            healthy = cnx.is_connected()
+        except Exception:
+            healthy = False
+
+        if not healthy:
+            self._discard(cnx)
+            return
+
+        with self._cond:
+            self._idle.append((cnx, time.monotonic()))
+            self._cond.notify()
+
+    @property
+    def failures(self):
+        return self._stats['failures']
+
+    def stats(self):
+        with self._cond:
+            data = dict(self._stats)
+            data['size'] = self.size
+            data['open'] = self._open
+            data['idle'] = len(self._idle)
+            data['in_use'] = self._open - len(self._idle)
+        checkouts = data['checkouts'] or 1
+        data['wait_time_avg'] = round(data['wait_time_total'] / checkouts, 6)
+        data['wait_time_total'] = round(data['wait_time_total'], 6)
+        data['wait_time_max'] = round(data['wait_time_max'], 6)
+        return data
+
+
+db_pool = ConnectionPool(
+    DB_CONFIG,
+    size=DB_POOL_SIZE,
+    wait_timeout=DB_POOL_WAIT_TIMEOUT,
+    connect_timeout=DB_CONNECT_TIMEOUT,
+    query_timeout_ms=DB_QUERY_TIMEOUT_MS,
+    healthcheck_idle=DB_HEALTHCHECK_IDLE
+)
+
 def get_db_connection():
-    """MySQL Database Connection"""
+    """Check out a pooled MySQL connection (db.close() returns it to the pool)"""
     try:
-        return mysql.connector.connect(
-            host="localhost",
-            user="root",
-            password="",
-            database="medical_6thsem"
-        )
+        db = db_pool.get()
     except Exception as e:
         print(f"❌ DATABASE CONNECTION FAILED: {e}")
         return None
 
+    # Track per-request checkouts so anything a route forgets to close is returned
+    if has_request_context():
+        g.setdefault('db_checkouts', []).append(db)
+    return db
+
+@app.teardown_request
+def release_request_connections(exc=None):
+    """Return every connection the request checked out back to the pool"""
+    for db in g.pop('db_checkouts', []):
+        db.close()
+
+def get_pool_stats():
+    """Connection pool usage statistics"""
+    return db_pool.stats()
+
+# --- Schema (idempotent; run via init_db_schema() or `flask --app app init-db`) ---
+SCHEMA_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS bill_headers (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        invoice_no VARCHAR(20) NULL,
+        customer_name VARCHAR(255),
+        phone VARCHAR(20),
+        item_count INT NOT NULL DEFAULT 0,
+        total_quantity INT NOT NULL DEFAULT 0,
+        subtotal DECIMAL(12,2) NOT NULL DEFAULT 0,
+        discount DECIMAL(12,2) NOT NULL DEFAULT 0,
+        gst DECIMAL(12,2) NOT NULL DEFAULT 0,
+        final_amount DECIMAL(12,2) NOT NULL DEFAULT 0,
+        bill_date DATETIME NOT NULL,
+        UNIQUE KEY uq_bill_headers_invoice (invoice_no),
+        KEY idx_bill_headers_date (bill_date, id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        day DATE PRIMARY KEY,
+        revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+        bill_count INT NOT NULL DEFAULT 0,
+        items_sold INT NOT NULL DEFAULT 0,
+        discount DECIMAL(14,2) NOT NULL DEFAULT 0,
+        gst DECIMAL(14,2) NOT NULL DEFAULT 0
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS discount_rules (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        scope VARCHAR(20) NOT NULL,
+        match_value VARCHAR(255) NULL,
+        percent DECIMAL(5,2) NOT NULL,
+        min_qty INT NOT NULL DEFAULT 1,
+        starts_on DATE NULL,
+        ends_on DATE NULL,
+        active TINYINT(1) NOT NULL DEFAULT 1,
+        KEY idx_discount_rules_scope (scope, match_value)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS gst_ledger (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        bill_id INT NOT NULL,
+        invoice_no VARCHAR(20) NULL,
+        bill_date DATETIME NOT NULL,
+        gst_rate DECIMAL(5,2) NOT NULL,
+        gross_amount DECIMAL(12,2) NOT NULL DEFAULT 0,
+        discount DECIMAL(12,2) NOT NULL DEFAULT 0,
+        taxable_amount DECIMAL(12,2) NOT NULL DEFAULT 0,
+        cgst DECIMAL(12,2) NOT NULL DEFAULT 0,
+        sgst DECIMAL(12,2) NOT NULL DEFAULT 0,
+        gst DECIMAL(12,2) NOT NULL DEFAULT 0,
+        total_amount DECIMAL(12,2) NOT NULL DEFAULT 0,
+        UNIQUE KEY uq_gst_ledger_bill_rate (bill_id, gst_rate),
+        KEY idx_gst_ledger_date (bill_date, id)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS gst_daily (
+        day DATE NOT NULL,
+        gst_rate DECIMAL(5,2) NOT NULL,
+        bill_count INT NOT NULL DEFAULT 0,
+        gross_amount DECIMAL(14,2) NOT NULL DEFAULT 0,
+        discount DECIMAL(14,2) NOT NULL DEFAULT 0,
+        taxable_amount DECIMAL(14,2) NOT NULL DEFAULT 0,
+        cgst DECIMAL(14,2) NOT NULL DEFAULT 0,
+        sgst DECIMAL(14,2) NOT NULL DEFAULT 0,
+        gst DECIMAL(14,2) NOT NULL DEFAULT 0,
+        total_amount DECIMAL(14,2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, gst_rate)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS product_sales_daily (
+        product_name VARCHAR(255) NOT NULL,
+        day DATE NOT NULL,
+        quantity INT NOT NULL DEFAULT 0,
+        revenue DECIMAL(14,2) NOT NULL DEFAULT 0,
+        PRIMARY KEY (product_name, day),
+        KEY idx_product_sales_daily_day (day)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS low_stock_items (
+        product_id INT PRIMARY KEY,
+        product_name VARCHAR(255) NOT NULL,
+        manufacture VARCHAR(255),
+        stock INT NOT NULL,
+        shelf_rack VARCHAR(100),
+        reorder_point INT NOT NULL,
+        order_qty INT NOT NULL,
+        avg_daily DOUBLE NULL,
+        days_left DOUBLE NULL,
+        KEY idx_low_stock_items_name (product_name)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS stock_writeoffs (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        product_id INT NOT NULL,
+        product_name VARCHAR(255) NOT NULL,
+        quantity INT NOT NULL,
+        expirydate DATE NULL,
+        reason VARCHAR(50) NOT NULL,
+        written_off_at DATETIME NOT NULL,
+        KEY idx_stock_writeoffs_date (written_off_at)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS customer_profiles (
+        phone_norm VARCHAR(20) PRIMARY KEY,
+        customer_name VARCHAR(255),
+        phone VARCHAR(20),
+        order_count INT NOT NULL DEFAULT 0,
+        total_quantity INT NOT NULL DEFAULT 0,
+        unique_medicines INT NOT NULL DEFAULT 0,
+        last_visit DATETIME NULL,
+        KEY idx_customer_profiles_rank (order_count, total_quantity)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS customer_medicines (
+        phone_norm VARCHAR(20) NOT NULL,
+        medicine_name VARCHAR(255) NOT NULL,
+        manufacturer VARCHAR(255) NULL,
+        dose VARCHAR(100) NULL,
+        quantity INT NOT NULL DEFAULT 0,
+        last_quantity INT NOT NULL DEFAULT 0,
+        times INT NOT NULL DEFAULT 0,
+        last_bought DATETIME NULL,
+        PRIMARY KEY (phone_norm, medicine_name),
+        KEY idx_customer_medicines_recent (phone_norm, last_bought)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS purchase_orders (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        manufacturer VARCHAR(255) NULL,
+        status VARCHAR(20) NOT NULL DEFAULT 'ordered',
+        line_count INT NOT NULL DEFAULT 0,
+        total_units INT NOT NULL DEFAULT 0,
+        order_date DATETIME NOT NULL,
+        expected_delivery DATETIME NULL,
+        received_at DATETIME NULL,
+        KEY idx_purchase_orders_status (status, order_date)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS scheduler_runs (
+        job VARCHAR(50) PRIMARY KEY,
+        last_started DATETIME NULL,
+        last_finished DATETIME NULL,
+        last_status VARCHAR(20) NULL,
+        last_duration DOUBLE NULL,
+        last_error VARCHAR(500) NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS reorder_plan (
+        product_name VARCHAR(255) PRIMARY KEY,
+        avg_daily DOUBLE NOT NULL DEFAULT 0,
+        std_daily DOUBLE NOT NULL DEFAULT 0,
+        reorder_point INT NOT NULL,
+        order_up_to INT NOT NULL,
+        computed_at DATETIME NOT NULL
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS import_jobs (
+        id VARCHAR(32) PRIMARY KEY,
+        filename VARCHAR(255) NULL,
+        mode VARCHAR(10) NOT NULL,
+        match_key VARCHAR(10) NOT NULL,
+        status VARCHAR(20) NOT NULL,
+        created DATETIME NOT NULL,
+        started DATETIME NULL,
+        finished DATETIME NULL,
+        bytes_total BIGINT NOT NULL DEFAULT 0,
+        bytes_read BIGINT NOT NULL DEFAULT 0,
+        rows_read INT NOT NULL DEFAULT 0,
+        inserted INT NOT NULL DEFAULT 0,
+        updated INT NOT NULL DEFAULT 0,
+        unchanged INT NOT NULL DEFAULT 0,
+        retired INT NOT NULL DEFAULT 0,
+        rejected INT NOT NULL DEFAULT 0,
+        notes TEXT NULL,
+        error VARCHAR(500) NULL,
+        rejects MEDIUMTEXT NULL,
+        KEY idx_import_jobs_created (status, created)
+    )
+    """,
+]
+
+# (table, column, column definition) added to pre-existing tables
+SCHEMA_COLUMNS = [
+    ('bills', 'bill_id', 'INT NULL'),
+    ('bills', 'gst_rate', 'DECIMAL(5,2) NULL'),
+    ('orders', 'po_id', 'INT NULL'),
+    ('products', 'gst_rate', 'DECIMAL(5,2) NULL'),
+    ('product_sales_daily', 'revenue', 'DECIMAL(14,2) NOT NULL DEFAULT 0'),
+]
+
+# (table, column, wanted DATA_TYPE, column definition, cleanup run before converting)
+SCHEMA_COLUMN_TYPES = [
+    # Whole numbers stay; decimals are rounded half away from zero; anything else becomes 0
+    ('products', 'countInStock', 'int', 'INT NOT NULL DEFAULT 0',
+     "UPDATE products SET countInStock = CASE "
+     "WHEN countInStock REGEXP '^ *-?[0-9]+([.][0-9]*)? *$' "
+     "THEN ROUND(CAST(TRIM(countInStock) AS DECIMAL(20,4))) ELSE '0' END "
+     "WHERE countInStock IS NULL OR countInStock NOT REGEXP '^-?[0-9]+$'"),
+    # Only real calendar dates survive (2024-13-45 is shaped right but isn't one), cut to
+    # the date part; IGNORE keeps strict mode from turning STR_TO_DATE's warnings into errors
+    ('products', 'expirydate', 'date', 'DATE NULL',
+     "UPDATE IGNORE products SET expirydate = CASE "
+     "WHEN expirydate REGEXP '^ *[0-9]{4}-[0-9]{2}-[0-9]{2}' "
+     "AND STR_TO_DATE(LEFT(TRIM(expirydate), 10), '%Y-%m-%d') IS NOT NULL "
+     "THEN LEFT(TRIM(expirydate), 10) END "
+     "WHERE expirydate NOT REGEXP '^[0-9]{4}-[0-9]{2}-[0-9]{2}$' "
+     "OR STR_TO_DATE(expirydate, '%Y-%m-%d') IS NULL"),
+]
+
+# (table, index name, index definition)
+SCHEMA_INDEXES = [
+    ('bills', 'idx_bills_bill_id', '(bill_id)'),
+    ('products', 'idx_products_name_manufacture', '(name, manufacture)'),
+    ('products', 'idx_products_stock', '(countInStock)'),
+    ('products', 'idx_products_expiry', '(expirydate, countInStock)'),
+    ('orders', 'idx_orders_po', '(po_id)'),
+    ('orders', 'idx_orders_status_name', '(status, medicine_name)'),
+]
+
+def _column_exists(cur, table, column):
+    cur.execute("""
+        SELECT COUNT(*) FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    """, (table, column))
+    return cur.fetchone()[0] > 0
+
+def _column_type(cur, table, column):
+    cur.execute("""
+        SELECT DATA_TYPE FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+    """, (table, column))
+    row = cur.fetchone()
+    return row[0].lower() if row else None
+
+def _index_exists(cur, table, index):
+    cur.execute("""
+        SELECT COUNT(*) FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+    """, (table, index))
+    return cur.fetchone()[0] > 0
+
+def init_db_schema():
+    """Create the tables, columns and indexes the app relies on (safe to re-run)"""
+    db = get_db_connection()
+    if not db:
+        return False
+
+    cur = db.cursor()
+    try:
+        for ddl in SCHEMA_TABLES:
+            cur.execute(ddl)
+        for table, column, definition in SCHEMA_COLUMNS:
+            if not _column_exists(cur, table, column):
+                cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+        for table, column, data_type, definition, cleanup in SCHEMA_COLUMN_TYPES:
+            current = _column_type(cur, table, column)
+            if current and current != data_type:
+                # Values the new type can't hold would abort the ALTER in strict mode
+                cur.execute(cleanup)
+                cur.execute(f"ALTER TABLE {table} MODIFY COLUMN {column} {definition}")
+                print(f"✅ Converted {table}.{column} from {current} to {data_type}.")
+        for table, index, definition in SCHEMA_INDEXES:
+            if not _index_exists(cur, table, index):
+                try:
+                    cur.execute(f"ALTER TABLE {table} ADD INDEX {index} {definition}")
+                except mysql.connector.Error as e:
+                    # e.g. TEXT columns need a prefix length; keep going with the rest
+                    print(f"⚠️ Could not add index {index} on {table}: {e.msg}")
+        refresh_low_stock(cur)
+        db.commit()
+        print("✅ Database schema is up to date.")
+        return True
+    except Exception as e:
+        print(f"❌ Schema Init Error: {e}")
+        return False
+    finally:
+        db.close()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create missing tables, columns and indexes"""
+    init_db_schema()
+
 def read_csv():
     """Read medicines from CSV file"""
     if not os.path.exists(CSV_FILE):
@@ -58,66 +662,1609 @@ def read_users():
         print(f"❌ USERS CSV READ ERROR: {e}")
         return []
 
-def write_users(users):
-    """Write users to CSV with backup"""
+@contextmanager
+def users_file_lock():
+    """Exclusive lock on user.csv across threads and worker processes"""
+    with open(USERS_CSV + '.lock', 'a+') as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+            else:
+                lock_file.seek(0)
+                msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+def _write_users_file(users):
+    """Replace user.csv atomically (temp file + rename); caller holds the lock"""
+    folder = os.path.dirname(os.path.abspath(USERS_CSV))
+    fd, tmp_path = tempfile.mkstemp(prefix='.user-', suffix='.csv', dir=folder)
     try:
-        if os.path.exists(USERS_CSV):
-            shutil.copy(USERS_CSV, USERS_CSV + '.backup')
-        with open(USERS_CSV, 'w', newline='', encoding='utf-8') as f:
-            fieldnames = ['username', 'password', 'role', 'phone']
-            writer = csv.DictWriter(f, fieldnames=fieldnames)
+        with os.fdopen(fd, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.DictWriter(f, fieldnames=USERS_FIELDS, extrasaction='ignore')
             writer.writeheader()
             writer.writerows(users)
-        print("✅ user.csv UPDATED SUCCESSFULLY")
-    except Exception as e:
-        print(f"❌ WRITE USERS ERROR: {e}")
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(USERS_CSV):
+            shutil.copymode(USERS_CSV, tmp_path)
+            shutil.copy(USERS_CSV, USERS_CSV + '.backup')
+        os.replace(tmp_path, USERS_CSV)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
         raise
 
+
+class UserDirectory:
+    """
+    In-memory index of user.csv keyed by (username, role). The file is
+    stat'ed at most once per USERS_STAT_INTERVAL and only re-read when its
+    mtime, size or inode changed, so logins normally touch no disk at all.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._users = {}         # (username, role) -> user dict
+        self._signature = None   # (mtime_ns, size, inode) of the loaded file
+        self._checked_at = None
+
+    def _file_signature(self):
+        try:
+            st = os.stat(USERS_CSV)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+    def _refresh(self):
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < USERS_STAT_INTERVAL:
+            return
+        with self._lock:
+            if self._checked_at is not None and now - self._checked_at < USERS_STAT_INTERVAL:
+                return
+            signature = self._file_signature()
+            if signature is None:
+                init_user_list()
+                signature = self._file_signature()
+            if signature != self._signature:
+                users = read_users()
+                self._users = {(u['username'], u['role']): u for u in users}
+                self._signature = signature
+                print(f"✅ User directory loaded: {len(users)} users.")
+            self._checked_at = now
+
+    def invalidate(self):
+        """Force a stat on the next lookup (after this process wrote the file)"""
+        self._checked_at = None
+
+    def get(self, username, role):
+        self._refresh()
+        user = self._users.get((username, role))
+        return dict(user) if user else None
+
+    def update(self, change):
+        """
+        Re-read user.csv under the file lock, let change(users) edit the list
+        in place and return True to save it. Returns what change returned.
+        """
+        with users_file_lock():
+            users = read_users()
+            changed = change(users)
+            if changed:
+                _write_users_file(users)
+        if changed:
+            self.invalidate()
+            print("✅ user.csv UPDATED SUCCESSFULLY")
+        return changed
+
+
+user_directory = UserDirectory()
+
+
+class MemorySessionStore:
+    """Sessions held in this process only (single worker)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}    # sid -> (expires_at, payload)
+
+    def load(self, sid):
+        with self._lock:
+            entry = self._data.get(sid)
+        if entry and entry[0] > time.time():
+            return entry[1], entry[0]
+        return None
+
+    def save(self, sid, payload, expires_at):
+        with self._lock:
+            self._data[sid] = (expires_at, payload)
+
+    def touch(self, sid, expires_at):
+        with self._lock:
+            if sid in self._data:
+                self._data[sid] = (expires_at, self._data[sid][1])
+
+    def delete(self, sid):
+        with self._lock:
+            self._data.pop(sid, None)
+
+    def purge(self):
+        now = time.time()
+        with self._lock:
+            expired = [sid for sid, (expires_at, _) in self._data.items() if expires_at <= now]
+            for sid in expired:
+                del self._data[sid]
+        return len(expired)
+
+
+class SQLiteSessionStore:
+    """
+    Sessions in a local SQLite file, shared by every worker process on the host.
+    Nothing touches the disk until the first session is read or written.
+    """
+
+    def __init__(self, path=None):
+        self._path = path
+        self._local = threading.local()
+        self._ready = False
+        self._ready_lock = threading.Lock()
+
+    @property
+    def path(self):
+        """The given path, else app.config['SESSION_DB'], else sessions.db in the instance folder"""
+        if self._path is None:
+            self._path = app.config.get('SESSION_DB') or os.path.join(app.instance_path, 'sessions.db')
+        return self._path
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            if not self._ready:
+                os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._create_schema(conn)
+        return conn
+
+    def _create_schema(self, conn):
+        with self._ready_lock:
+            if self._ready:
+                return
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY,
+                    payload TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_sessions_expires ON sessions (expires_at)")
+            self._ready = True
+
+    def load(self, sid):
+        row = self._connect().execute(
+            "SELECT payload, expires_at FROM sessions WHERE sid = ? AND expires_at > ?",
+            (sid, time.time())
+        ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def save(self, sid, payload, expires_at):
+        self._connect().execute(
+            "INSERT OR REPLACE INTO sessions (sid, payload, expires_at) VALUES (?, ?, ?)",
+            (sid, payload, expires_at)
+        )
+
+    def touch(self, sid, expires_at):
+        self._connect().execute("UPDATE sessions SET expires_at = ? WHERE sid = ?", (expires_at, sid))
+
+    def delete(self, sid):
+        self._connect().execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def purge(self):
+        return self._connect().execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),)).rowcount
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    """Session data kept server-side; the cookie only carries a signed id"""
+
+    def __init__(self, initial=None, sid=None, expires_at=None):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.expires_at = expires_at
+        self.modified = False
+        self.regenerate = False
+
+    def clear(self):
+        # A cleared session (login/logout) gets a fresh id, so an old cookie is worthless
+        super().clear()
+        self.regenerate = True
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface over a MemorySessionStore or SQLiteSessionStore"""
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, idle_timeout=SESSION_IDLE_TIMEOUT):
+        self.store = store
+        self.idle_timeout = idle_timeout
+        self._next_purge = 0
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt='server-session')
+
+    def open_session(self, app, request):
+        if not app.secret_key:
+            return None
+        cookie = request.cookies.get(self.get_cookie_name(app))
+        if cookie:
+            try:
+                sid = self._signer(app).unsign(cookie).decode()
+            except BadSignature:
+                sid = None
+            entry = self.store.load(sid) if sid else None
+            if entry:
+                try:
+                    return ServerSession(self.serializer.loads(entry[0]), sid, entry[1])
+                except ValueError:
+                    pass
+        return ServerSession()
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        now = time.time()
+        # With the scheduler running, purging is its job instead of a request's
+        if not SCHEDULER_ENABLED and now >= self._next_purge:
+            self._next_purge = now + SESSION_PURGE_INTERVAL
+            self.store.purge()
+
+        if session.sid and (session.regenerate or not session):
+            self.store.delete(session.sid)
+            if not session:
+                response.delete_cookie(name, domain=domain, path=path)
+                return
+            session.sid = None
+        if not session:
+            return
+
+        response.vary.add('Cookie')
+        expires_at = now + self.idle_timeout
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+            session.modified = True
+        elif not session.modified:
+            # Unchanged: only push the idle expiry forward now and then
+            if session.expires_at and session.expires_at - now > self.idle_timeout - SESSION_TOUCH_INTERVAL:
+                return
+            self.store.touch(session.sid, expires_at)
+            return
+
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), expires_at)
+        response.set_cookie(
+            name,
+            self._signer(app).sign(session.sid).decode(),
+            expires=self.get_expiration_time(app, session),
+            httponly=self.get_cookie_httponly(app),
+            domain=domain,
+            path=path,
+            secure=self.get_cookie_secure(app),
+            samesite=self.get_cookie_samesite(app),
+        )
+
+
+app.session_interface = ServerSessionInterface(
+    MemorySessionStore() if SESSION_BACKEND == "memory" else SQLiteSessionStore(SESSION_DB)
+)
+
 # ========================================
 # 3. BUSINESS LOGIC FUNCTIONS
 # ========================================
-def get_low_stock_medicines(limit=15):
-    """Get medicines with stock below threshold from DB"""
+def widget_etag(value):
+    """Strong ETag for a widget payload: a hash of its canonical JSON form"""
+    payload = json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+class WidgetCache:
+    """Per-process TTL cache of dashboard widget results, invalidated by writes"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {}    # (widget, args) -> (expires_at, value, etag)
+        self._accessed = {}   # (widget, args) -> when a page last asked for it
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def get(self, key):
+        with self._lock:
+            self._accessed[key] = time.monotonic()
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._stats['hits'] += 1
+                return True, entry[1]
+            self._stats['misses'] += 1
+            return False, None
+
+    def put(self, key, value, ttl):
+        etag = widget_etag(value)
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value, etag)
+
+    def etag(self, key):
+        """ETag of a live entry, computed once when it was cached (None if absent)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                return entry[2]
+            return None
+
+    def recently_used(self, within):
+        """Keys asked for in the last `within` seconds (older access records are dropped)"""
+        cutoff = time.monotonic() - within
+        with self._lock:
+            self._accessed = {key: at for key, at in self._accessed.items() if at >= cutoff}
+            return list(self._accessed)
+
+    def invalidate(self, *widgets):
+        """Drop every cached entry belonging to the given widgets"""
+        with self._lock:
+            stale = [key for key in self._entries if key[0] in widgets]
+            for key in stale:
+                del self._entries[key]
+            self._stats['invalidations'] += len(stale)
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['entries'] = len(self._entries)
+        return data
+
+
+dashboard_cache = WidgetCache()
+dashboard_refreshers = {}    # widget name -> its helper's refresh(), for the cache warmer
+
+# Which widgets each kind of write makes stale
+WIDGET_INVALIDATIONS = {
+    'billing': ('total_sales', 'daily_sales', 'sales_chart', 'monthly_sales',
+                'top_selling', 'top_medicines', 'recent_bills', 'low_stock',
+                'low_stock_count', 'expiring', 'expired', 'expiry_counts', 'customers'),
+    'catalog': ('company_stock', 'low_stock', 'low_stock_count', 'expiring', 'expired', 'expiry_counts'),
+    'restock': ('low_stock', 'low_stock_count', 'recent_orders', 'expiring', 'expired', 'expiry_counts'),
+    'reorder': ('low_stock', 'low_stock_count'),
+    'writeoff': ('low_stock', 'low_stock_count', 'expiring', 'expired', 'expiry_counts'),
+    'customers': ('customers',),
+    'orders': ('recent_orders',),
+}
+
+def dashboard_widget(name, ttl=DASHBOARD_CACHE_TTL):
+    """
+    Cache a dashboard helper's result under a widget name for ttl seconds.
+    helper.refresh(...) recomputes and re-caches even when an entry is live.
+    """
+    def decorator(func):
+        def refresh(*args, **kwargs):
+            failures_before = db_pool.failures
+            value = func(*args, **kwargs)
+            # Don't cache the empty fallback returned while the DB is unreachable
+            if db_pool.failures == failures_before:
+                dashboard_cache.put((name, args, tuple(sorted(kwargs.items()))), value, ttl)
+            return value
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            hit, value = dashboard_cache.get((name, args, tuple(sorted(kwargs.items()))))
+            if hit:
+                return value
+            return refresh(*args, **kwargs)
+        wrapper.widget = name
+        wrapper.refresh = refresh
+        dashboard_refreshers[name] = refresh
+        return wrapper
+    return decorator
+
+def invalidate_dashboard(event):
+    """Invalidate only the widgets affected by a write ('billing', 'catalog', ...)"""
+    dashboard_cache.invalidate(*WIDGET_INVALIDATIONS[event])
+
+
+class WidgetTimings:
+    """Running per-widget fetch timings, to spot the slowest dashboard panel"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._widgets = {}
+
+    def record(self, name, seconds, outcome='ok'):
+        with self._lock:
+            t = self._widgets.setdefault(name, {
+                'calls': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0, 'timeouts': 0, 'errors': 0
+            })
+            t['calls'] += 1
+            t['total'] += seconds
+            t['max'] = max(t['max'], seconds)
+            t['last'] = seconds
+            if outcome == 'timeout':
+                t['timeouts'] += 1
+            elif outcome == 'error':
+                t['errors'] += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                name: {
+                    'calls': t['calls'],
+                    'avg': round(t['total'] / t['calls'], 6),
+                    'max': round(t['max'], 6),
+                    'last': round(t['last'], 6),
+                    'timeouts': t['timeouts'],
+                    'errors': t['errors'],
+                }
+                for name, t in self._widgets.items()
+            }
+
+
+widget_timings = WidgetTimings()
+dashboard_executor = ThreadPoolExecutor(max_workers=DASHBOARD_WORKERS, thread_name_prefix='widget')
+
+def _timed_widget(name, func, args, started=None):
+    start = time.monotonic()
+    if started is not None:
+        # started maps name -> Event; the Event carries the start time
+        started[name].at = start
+        started[name].set()
+    try:
+        result = func(*args)
+    except Exception:
+        widget_timings.record(name, time.monotonic() - start, 'error')
+        raise
+    widget_timings.record(name, time.monotonic() - start)
+    return result
+
+def fetch_widgets(widgets, timeout=DASHBOARD_WIDGET_TIMEOUT):
+    """
+    Run independent widget fetches in parallel.
+    widgets maps name -> (func, args, default); a widget that errors or
+    misses the timeout renders with its default instead of blocking the page.
+    """
+    queued = time.monotonic()
+    started = {name: threading.Event() for name in widgets}
+    futures = {
+        name: dashboard_executor.submit(_timed_widget, name, func, args, started)
+        for name, (func, args, _) in widgets.items()
+    }
+
+    results = {}
+    for name, future in futures.items():
+        default = widgets[name][2]
+        try:
+            # Each widget's clock starts when it does, so time spent queued behind
+            # other widgets isn't held against it (queueing alone is capped at timeout)
+            if not started[name].wait(max(0, queued + timeout - time.monotonic())):
+                raise FuturesTimeout()
+            results[name] = future.result(timeout=max(0, started[name].at + timeout - time.monotonic()))
+        except FuturesTimeout:
+            # A fetch still queued is dropped so it doesn't hold a thread and a connection
+            # for nobody; one already running finishes and still warms the cache
+            future.cancel()
+            widget_timings.record(name, time.monotonic() - getattr(started[name], 'at', queued), 'timeout')
+            print(f"⚠️ Widget '{name}' timed out after {timeout}s")
+            results[name] = default
+        except Exception as e:
+            print(f"❌ Widget '{name}' failed: {e}")
+            results[name] = default
+    return results
+
+class CatalogIndex:
+    """
+    In-memory snapshot of the products table with an n-gram index on name,
+    a token index on the use0/use1 indications and an undirected substitute
+    graph from substitute0/substitute1 (edges by lowercase product name).
+    Postings may keep ids of renamed/removed products; every candidate is
+    verified against the current row, so stale entries are harmless and
+    are dropped on the next full rebuild.
+    """
+
+    SELECT_SQL = """
+        SELECT id, name, price, countInStock, shelf_rack_no AS shelf_rack,
+               manufacture, use0, use1, substitute0, substitute1
+        FROM products
+    """
+
+    def __init__(self, n=SEARCH_NGRAM):
+        self.n = n
+        self._lock = threading.RLock()
+        self._rows = {}         # id -> row dict (fields used by staff.html)
+        self._names = {}        # id -> lowercase name
+        self._grams = {}        # n-gram -> array of product ids
+        self._words = {}        # name word -> array of product ids (typo matching)
+        self._word_grams = {}   # n-gram -> list of distinct name words
+        self._uses = {}         # use token -> array of product ids
+        self._use_tokens = {}   # id -> frozenset of that product's use tokens
+        self._by_name = {}      # lowercase name -> set of product ids
+        self._subs = {}         # id -> tuple of lowercase substitute names
+        self._sub_in = {}       # lowercase name -> ids listing it as a substitute
+        self._alt_cache = OrderedDict()  # lowercase name -> {reachable name: hops}
+        self._sold = {}         # lowercase name -> units sold (ranking signal)
+        self._dirty = set()     # product names changed since they were loaded
+        self._generation = 0    # bumped whenever the whole catalog is marked stale
+        self._build_lock = threading.Lock()
+        self.loaded_at = None
+
+    def _ngrams(self, text):
+        return {text[i:i + self.n] for i in range(len(text) - self.n + 1)}
+
+    @staticmethod
+    def _empty_maps():
+        return {'rows': {}, 'names': {}, 'grams': {}, 'words': {},
+                'word_grams': {}, 'uses': {}, 'use_tokens': {},
+                'by_name': {}, 'subs': {}, 'sub_in': {}}
+
+    def _maps(self):
+        return {'rows': self._rows, 'names': self._names, 'grams': self._grams,
+                'words': self._words, 'word_grams': self._word_grams,
+                'uses': self._uses, 'use_tokens': self._use_tokens,
+                'by_name': self._by_name, 'subs': self._subs, 'sub_in': self._sub_in}
+
+    def _add(self, row, maps):
+        """Index one product row; returns the names whose substitute links changed"""
+        pid = row['id']
+        name = (row['name'] or '').lower()
+        old_name = maps['names'].get(pid)
+        maps['rows'][pid] = row
+        maps['names'][pid] = name
+        if name != old_name:
+            for gram in self._ngrams(name):
+                maps['grams'].setdefault(gram, array('i')).append(pid)
+            words = maps['words']
+            for word in set(name.split()):
+                if word not in words:
+                    words[word] = array('i')
+                    for gram in self._ngrams(word):
+                        maps['word_grams'].setdefault(gram, []).append(word)
+                words[word].append(pid)
+
+        tokens = frozenset(use_tokens(f"{row.get('use0') or ''} {row.get('use1') or ''}"))
+        old_tokens = maps['use_tokens'].get(pid, frozenset())
+        maps['use_tokens'][pid] = tokens
+        for token in tokens - old_tokens:
+            maps['uses'].setdefault(token, array('i')).append(pid)
+
+        if name != old_name:
+            if old_name is not None:
+                maps['by_name'].get(old_name, set()).discard(pid)
+            maps['by_name'].setdefault(name, set()).add(pid)
+        subs = tuple(sorted(
+            {(sub or '').strip().lower() for sub in (row.get('substitute0'), row.get('substitute1'))} - {'', name}
+        ))
+        old_subs = maps['subs'].get(pid, ())
+        maps['subs'][pid] = subs
+        for sub in subs:
+            maps['sub_in'].setdefault(sub, set()).add(pid)
+        if subs == old_subs and name == old_name:
+            return set()
+        return {name, *subs, *old_subs} | ({old_name} if old_name else set())
+
+    def rebuild(self):
+        """Load every product and build a fresh index, then swap it in"""
+        db = get_db_connection()
+        if not db:
+            return False
+        # Changes marked from here on may not be in the snapshot, so they stay pending
+        with self._lock:
+            generation = self._generation
+            self._dirty.clear()
+        maps = self._empty_maps()
+        try:
+            cur = db.cursor(dictionary=True)
+            cur.execute(self.SELECT_SQL)
+            while True:
+                batch = cur.fetchmany(SEARCH_LOAD_BATCH)
+                if not batch:
+                    break
+                for row in batch:
+                    self._add(row, maps)
+
+            cur.execute("""
+                SELECT medicine_name, SUM(quantity) AS sold
+                FROM bills
+                GROUP BY medicine_name
+            """)
+            sold = {(r['medicine_name'] or '').lower(): int(r['sold'] or 0) for r in cur.fetchall()}
+        except Exception as e:
+            print(f"❌ Search Index Build Error: {e}")
+            return False
+        finally:
+            db.close()
+
+        with self._lock:
+            self._rows, self._names, self._grams = maps['rows'], maps['names'], maps['grams']
+            self._words, self._word_grams = maps['words'], maps['word_grams']
+            self._uses, self._use_tokens = maps['uses'], maps['use_tokens']
+            self._by_name, self._subs, self._sub_in = maps['by_name'], maps['subs'], maps['sub_in']
+            self._alt_cache = OrderedDict()
+            self._sold = sold
+            self.loaded_at = datetime.now() if generation == self._generation else None
+        print(f"✅ Search index built: {len(maps['rows'])} products, "
+              f"{len(maps['grams'])} n-grams, {len(maps['uses'])} use tokens.")
+        return True
+
+    def mark_dirty(self, names=None):
+        """Note products whose rows changed; names=None means the whole catalog"""
+        with self._lock:
+            if names is None:
+                self._generation += 1
+                self.loaded_at = None
+            else:
+                self._dirty.update(names)
+
+    def _refresh_dirty(self):
+        with self._lock:
+            names, self._dirty = list(self._dirty), set()
+        if not names:
+            return
+        if len(names) > SEARCH_FULL_REBUILD_AT:
+            self.rebuild()
+            return
+
+        db = get_db_connection()
+        if not db:
+            with self._lock:
+                self._dirty.update(names)
+            return
+        try:
+            cur = db.cursor(dictionary=True)
+            placeholders = ', '.join(['%s'] * len(names))
+            cur.execute(f"{self.SELECT_SQL} WHERE name IN ({placeholders})", names)
+            fresh = cur.fetchall()
+        finally:
+            db.close()
+
+        with self._lock:
+            wanted = {name.lower() for name in names}
+            fresh_ids = {row['id'] for row in fresh}
+            touched = set()
+            # Products that vanished under one of these names
+            for pid in [pid for pid, name in self._names.items() if name in wanted and pid not in fresh_ids]:
+                self._rows.pop(pid, None)
+                name = self._names.pop(pid, None)
+                self._use_tokens.pop(pid, None)
+                self._by_name.get(name, set()).discard(pid)
+                touched |= {name, *self._subs.pop(pid, ())}
+            maps = self._maps()
+            for row in fresh:
+                touched |= self._add(row, maps)
+            self._forget_alternatives(touched)
+
+    def record_sales(self, qty_by_name):
+        """Bump popularity after a bill so ranking follows what actually sells"""
+        with self._lock:
+            for name, qty in qty_by_name.items():
+                key = name.lower()
+                self._sold[key] = self._sold.get(key, 0) + qty
+
+    def ensure_fresh(self):
+        if self.loaded_at is None:
+            with self._build_lock:
+                if self.loaded_at is None:
+                    self.rebuild()
+        elif self._dirty:
+            self._refresh_dirty()
+
+    def _match_ids(self, term):
+        """Ids of products whose name contains term (case-insensitive)"""
+        if len(term) < self.n:
+            # Too short for an n-gram lookup; a plain pass over names
+            return [pid for pid, name in self._names.items() if term in name]
+
+        postings = []
+        for gram in self._ngrams(term):
+            ids = self._grams.get(gram)
+            if not ids:
+                return []
+            postings.append(ids)
+        candidates = min(postings, key=len)
+        return [pid for pid in set(candidates) if term in self._names.get(pid, '')]
+
+    def _similar_words(self, part, max_edits):
+        """Name words within max_edits of part (or whose start is), with their distance"""
+        grams = self._ngrams(part)
+        # Each edit breaks at most n n-grams, so a real match shares at least this many
+        needed = max(len(grams) - self.n * max_edits, 1)
+        shared = Counter(chain.from_iterable(self._word_grams.get(gram, ()) for gram in grams))
+
+        # Only the words sharing the most n-grams are worth an edit-distance check
+        similar = {}
+        for word, count in shared.most_common(SEARCH_FUZZY_CANDIDATES):
+            if count < needed:
+                break
+            dists = [d for d in (_edit_distance(part, word, max_edits),
+                                 _edit_distance(part, word[:len(part)], max_edits)) if d is not None]
+            if dists:
+                similar[word] = min(dists)
+        return similar
+
+    def _fuzzy_ids(self, term, exclude):
+        """
+        Typo matches for term: every word of at least SEARCH_FUZZY_MIN_LEN must be
+        close to a name word, shorter words must appear as typed. Returns id -> edits.
+        """
+        parts = term.split()
+        long_parts = [p for p in parts if len(p) >= SEARCH_FUZZY_MIN_LEN]
+        if not long_parts:
+            return {}
+
+        matches = None
+        for part in long_parts:
+            max_edits = 1 if len(part) <= 5 else SEARCH_MAX_EDITS
+            found = {}
+            for word, dist in self._similar_words(part, max_edits).items():
+                for pid in self._words[word]:
+                    # Skip stale postings left behind by renamed/removed products
+                    if word not in self._names.get(pid, ''):
+                        continue
+                    if pid not in found or dist < found[pid]:
+                        found[pid] = dist
+            if matches is None:
+                matches = found
+            else:
+                matches = {pid: matches[pid] + dist for pid, dist in found.items() if pid in matches}
+            if not matches:
+                return {}
+
+        short_parts = [p for p in parts if len(p) < SEARCH_FUZZY_MIN_LEN]
+        return {
+            pid: dist for pid, dist in matches.items()
+            if pid not in exclude and all(p in self._names[pid] for p in short_parts)
+        }
+
+    def _rank(self, pid, kind, pos):
+        """Lower sorts first: match quality, in stock, best seller, position, shorter name"""
+        row = self._rows[pid]
+        name = self._names[pid]
+        in_stock = 0 if _as_int(row['countInStock']) > 0 else 1
+        return (kind, in_stock, -self._sold.get(name, 0), pos, len(name), name)
+
+    def search_ids(self, terms):
+        """Every matching product id, best first (what the result store keeps)"""
+        self.ensure_fresh()
+        with self._lock:
+            best = self._ranked(terms)
+        return array('i', sorted(best, key=best.__getitem__))
+
+    def rows_for(self, ids):
+        """Current rows for ids, skipping products removed since"""
+        self.ensure_fresh()
+        with self._lock:
+            return [self._rows[pid] for pid in ids if pid in self._rows]
+
+    def _ranked(self, terms):
+        """id -> rank key for every product matching any term"""
+        best = {}
+        names = self._names
+        for term in terms:
+            term = term.lower()
+            exact = self._match_ids(term)
+            for pid in exact:
+                pos = names[pid].find(term)
+                if pos == 0:
+                    kind = 0
+                elif names[pid][pos - 1] in ' -(/':
+                    kind = 1
+                else:
+                    kind = 2
+                rank = self._rank(pid, kind, pos)
+                if pid not in best or rank < best[pid]:
+                    best[pid] = rank
+
+            if len(term) >= SEARCH_FUZZY_MIN_LEN and len(exact) < SEARCH_PAGE_SIZE:
+                for pid, dist in self._fuzzy_ids(term, best).items():
+                    best[pid] = self._rank(pid, 3 + dist, 0)
+        return best
+
+    def _use_ids(self, tokens):
+        """Ids of products whose indications carry every token"""
+        postings = []
+        for token in tokens:
+            ids = self._uses.get(token)
+            if not ids:
+                return set()
+            postings.append(ids)
+        postings.sort(key=len)
+        found = set(postings[0])
+        for ids in postings[1:]:
+            found.intersection_update(ids)
+            if not found:
+                break
+        # Postings can outlive a product's old indications; check the current tokens
+        return {pid for pid in found if tokens <= self._use_tokens.get(pid, frozenset())}
+
+    def browse_uses(self, groups, facet_limit=USE_FACET_LIMIT):
+        """
+        Products matching ANY group, where a group needs ALL of its tokens.
+        Returns (rows sorted by name, [(use, count), ...] for the matched rows).
+        """
+        self.ensure_fresh()
+        with self._lock:
+            ids = set()
+            for tokens in groups:
+                if tokens:
+                    ids |= self._use_ids(frozenset(tokens))
+            rows = [self._rows[pid] for pid in sorted(ids, key=self._names.__getitem__)]
+
+        facets = Counter()
+        for row in rows:
+            facets.update({(u or '').strip() for u in (row['use0'], row['use1']) if (u or '').strip()})
+        return rows, facets.most_common(facet_limit)
+
+    def _substitute_neighbours(self, name):
+        """Names linked to name in either direction by a substitute column"""
+        linked = set()
+        for pid in self._by_name.get(name, ()):
+            linked.update(self._subs.get(pid, ()))
+        for pid in self._sub_in.get(name, ()):
+            # Skip stale entries from products whose substitutes have changed
+            if name in self._subs.get(pid, ()):
+                linked.add(self._names[pid])
+        linked.discard(name)
+        return linked
+
+    def _substitute_closure(self, name):
+        """Every name reachable within SUBSTITUTE_MAX_DEPTH hops -> hop count (cached)"""
+        closure = self._alt_cache.get(name)
+        if closure is not None:
+            self._alt_cache.move_to_end(name)
+            return closure
+
+        closure, frontier = {}, [name]
+        for depth in range(1, SUBSTITUTE_MAX_DEPTH + 1):
+            next_frontier = []
+            for current in frontier:
+                for other in self._substitute_neighbours(current):
+                    if other != name and other not in closure:
+                        closure[other] = depth
+                        next_frontier.append(other)
+            frontier = next_frontier
+
+        self._alt_cache[name] = closure
+        if len(self._alt_cache) > SUBSTITUTE_CACHE_SIZE:
+            self._alt_cache.popitem(last=False)
+        return closure
+
+    def _forget_alternatives(self, names):
+        """Drop cached closures that start at or pass through any of names"""
+        if not names or not self._alt_cache:
+            return
+        for key in [key for key, closure in self._alt_cache.items()
+                    if key in names or not names.isdisjoint(closure)]:
+            del self._alt_cache[key]
+
+    def _stock_of(self, name):
+        return sum(_as_int(self._rows[pid]['countInStock']) for pid in self._by_name.get(name, ()))
+
+    def alternatives(self, name, limit=SUBSTITUTE_MAX_RESULTS):
+        """In-stock substitutes for a product, nearest first, then best stocked"""
+        self.ensure_fresh()
+        with self._lock:
+            return self._alternatives(name.strip().lower(), limit)
+
+    def _alternatives(self, key, limit):
+        found = []
+        for other, depth in self._substitute_closure(key).items():
+            for pid in self._by_name.get(other, ()):
+                row = self._rows[pid]
+                stock = _as_int(row['countInStock'])
+                if stock > 0:
+                    found.append((depth, -stock, other, row))
+        found.sort(key=lambda f: f[:3])
+        return [dict(row, depth=depth) for depth, _, _, row in found[:limit]]
+
+    def alternatives_for(self, names, below=SUBSTITUTE_SHOW_BELOW, limit=SUBSTITUTE_MAX_RESULTS):
+        """{name: alternatives} for the given names whose own stock is under below"""
+        self.ensure_fresh()
+        result = {}
+        with self._lock:
+            for name in names:
+                key = (name or '').strip().lower()
+                if key and name not in result and self._stock_of(key) < below:
+                    alternatives = self._alternatives(key, limit)
+                    if alternatives:
+                        result[name] = alternatives
+        return result
+
+    def stats(self):
+        with self._lock:
+            return {
+                'products': len(self._rows),
+                'ngrams': len(self._grams),
+                'use_tokens': len(self._uses),
+                'substitute_closures_cached': len(self._alt_cache),
+                'postings': sum(len(ids) for ids in self._grams.values()),
+                'dirty': len(self._dirty),
+                'loaded_at': self.loaded_at.isoformat() if self.loaded_at else None,
+            }
+
+
+catalog_index = CatalogIndex()
+
+
+class SearchResultStore:
+    """
+    Server-side LRU of ranked search results (product ids) keyed by a short
+    token kept in the session, bounded by entry count, bytes and age.
+    """
+
+    def __init__(self, max_bytes=SEARCH_STORE_MAX_BYTES, max_entries=SEARCH_STORE_MAX_ENTRIES,
+                 ttl=SEARCH_STORE_TTL):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # token -> (expires_at, text, ids, nbytes)
+        self._bytes = 0
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expired': 0}
+
+    def _drop(self, token):
+        self._bytes -= self._entries.pop(token)[3]
+
+    def put(self, text, ids):
+        """Store one search's ids; returns the token to keep in the session"""
+        token = uuid.uuid4().hex[:12]
+        nbytes = sys.getsizeof(ids) + sys.getsizeof(text)
+        with self._lock:
+            self._entries[token] = (time.monotonic() + self.ttl, text, ids, nbytes)
+            self._bytes += nbytes
+            # Never evict the entry just stored, even if it alone is over budget
+            while len(self._entries) > 1 and (
+                    len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                self._drop(next(iter(self._entries)))
+                self._stats['evictions'] += 1
+        return token
+
+    def get(self, token, text):
+        """Ids stored under token for this search text, or None if gone"""
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry and entry[0] <= time.monotonic():
+                self._drop(token)
+                self._stats['expired'] += 1
+                entry = None
+            if not entry or entry[1] != text:
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(token)
+            self._stats['hits'] += 1
+            return entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['entries'] = len(self._entries)
+            data['bytes'] = self._bytes
+        return data
+
+
+search_results = SearchResultStore()
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance of a and b, or None once it must exceed limit"""
+    if abs(len(a) - len(b)) > limit:
+        return None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > limit:
+            return None
+        previous = current
+    return previous[-1] if previous[-1] <= limit else None
+
+def parse_search_terms(raw_input):
+    """Split the search box by comma or newline into individual terms"""
+    return [t.strip() for t in raw_input.replace(',', '\n').splitlines() if t.strip()]
+
+def use_tokens(text):
+    """Normalized indication tokens: lowercase words, no stopwords, plurals folded"""
+    tokens = []
+    for word in re.findall(r'[a-z0-9]+', (text or '').lower()):
+        if word in USE_STOPWORDS:
+            continue
+        if len(word) > 4 and word.endswith('s') and not word.endswith('ss'):
+            word = word[:-1]
+        tokens.append(word)
+    return tokens
+
+def parse_use_query(raw):
+    """'fever | cold' or 'fever or cold' -> OR of groups; words within a group are ANDed"""
+    groups = re.split(r'\|| or ', f" {raw or ''} ", flags=re.IGNORECASE)
+    return [tokens for tokens in (use_tokens(group) for group in groups) if tokens]
+
+def on_catalog_changed(names=None):
+    """Keep in-memory catalog structures current after products change"""
+    catalog_index.mark_dirty(names)
+    if names is None:
+        # Stored rankings predate a wholesale change; let searches rerun
+        search_results.clear()
+
+# Order lines still awaiting delivery, per product
+ON_ORDER_SELECT = """
+    SELECT medicine_name, SUM(quantity) AS on_order
+    FROM orders
+    WHERE status = 'Ordered' AND po_id IS NOT NULL
+    GROUP BY medicine_name
+"""
+
+# Per product name: stock summed over its batches, its reorder levels (plan or
+# defaults) and the units still to order once deliveries already on order arrive.
+# Both the low-stock list and restock orders read this, so they always agree.
+# Params: default reorder point, default order-up-to, then any {where} params.
+STOCK_POSITION_SELECT = f"""
+    SELECT s.product_id, s.name, s.manufacture, s.stock, s.shelf_rack,
+           COALESCE(r.reorder_point, %s) AS reorder_point,
+           COALESCE(r.order_up_to, %s) - s.stock - COALESCE(o.on_order, 0) AS order_qty,
+           r.avg_daily,
+           s.stock / NULLIF(r.avg_daily, 0) AS days_left
+    FROM (
+        SELECT MAX(id) AS product_id, name, MAX(manufacture) AS manufacture,
+               SUM(countInStock) AS stock, MAX(shelf_rack_no) AS shelf_rack
+        FROM products
+        {{where}}
+        GROUP BY name
+    ) s
+    LEFT JOIN reorder_plan r ON r.product_name = s.name
+    LEFT JOIN ({ON_ORDER_SELECT}) o ON o.medicine_name = s.name
+"""
+STOCK_POSITION_DEFAULTS = (REORDER_DEFAULT_POINT, REORDER_DEFAULT_UP_TO)
+
+def stock_position_sql(names=None):
+    """STOCK_POSITION_SELECT for the given product names (or all) and its params"""
+    if names is None:
+        return STOCK_POSITION_SELECT.format(where=""), STOCK_POSITION_DEFAULTS
+    placeholders = ', '.join(['%s'] * len(names))
+    return (STOCK_POSITION_SELECT.format(where=f"WHERE name IN ({placeholders})"),
+            (*STOCK_POSITION_DEFAULTS, *names))
+
+# Products whose total stock is below their reorder point, one row per name
+LOW_STOCK_COLUMNS = """
+    product_id, product_name, manufacture, stock, shelf_rack,
+    reorder_point, order_qty, avg_daily, days_left
+"""
+LOW_STOCK_SELECT = """
+    SELECT product_id, name, manufacture, stock, shelf_rack,
+           reorder_point, GREATEST(order_qty, 0), avg_daily, days_left
+    FROM ({position}) pos
+    WHERE stock < reorder_point
+"""
+
+def refresh_low_stock(cur, names=None):
+    """
+    Re-derive low_stock_items for the given product names (or the whole
+    catalog) on the caller's cursor, inside the caller's transaction.
+    """
+    if names is not None:
+        names = list(names)
+        if not names:
+            return
+        placeholders = ', '.join(['%s'] * len(names))
+        cur.execute(f"DELETE FROM low_stock_items WHERE product_name IN ({placeholders})", names)
+    else:
+        cur.execute("DELETE FROM low_stock_items")
+    position, params = stock_position_sql(names)
+    # REPLACE: a renamed product's old row may still hold the same product_id
+    cur.execute(f"""
+        REPLACE INTO low_stock_items ({LOW_STOCK_COLUMNS})
+        {LOW_STOCK_SELECT.format(position=position)}
+    """, params)
+
+def rebuild_low_stock():
+    """Full refresh of low_stock_items in its own transaction (after imports)"""
+    db = get_db_connection()
+    if not db:
+        return False
+    cur = db.cursor()
+    try:
+        refresh_low_stock(cur)
+        db.commit()
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Low Stock Refresh Error: {e}")
+        return False
+    finally:
+        db.close()
+
+@dashboard_widget('low_stock')
+def get_low_stock_medicines(limit=None):
+    """Medicines below their reorder point (from low_stock_items), most urgent first"""
     db = get_db_connection()
     if not db:
         return []
     
     cur = db.cursor(dictionary=True)
-    # Cast countInStock to signed to ensure numeric comparison works correctly
-    cur.execute("""
-        SELECT name as medicine_name, 
+    cur.execute(f"""
+        SELECT product_name as medicine_name, 
                manufacture as manufacturer, 
-               countInStock as stock, 
-               shelf_rack_no as shelf_rack 
-        FROM products 
-        WHERE CAST(countInStock AS SIGNED) < %s 
-        ORDER BY CAST(countInStock AS SIGNED) ASC
-    """, (limit,))
+               stock, 
+               shelf_rack,
+               reorder_point,
+               order_qty,
+               avg_daily,
+               days_left
+        FROM low_stock_items
+        ORDER BY days_left IS NULL, days_left, stock
+        {"LIMIT %s" if limit else ""}
+    """, (limit,) if limit else ())
     
     low_stock = cur.fetchall()
     db.close()
     return low_stock
 
-def restock_medicines(selected_medicines):
-    """Update stock in DB to 50 for selected medicines"""
+@dashboard_widget('low_stock_count')
+def get_low_stock_count():
+    """Number of medicines below their reorder point"""
     db = get_db_connection()
     if not db:
-        return
+        return 0
+    cur = db.cursor()
+    cur.execute("SELECT COUNT(*) FROM low_stock_items")
+    count = cur.fetchone()[0]
+    db.close()
+    return count
 
+# Every expiry query is a range on idx_products_expiry (expirydate, countInStock)
+EXPIRY_COLUMNS = """
+    id, name, manufacture, countInStock as stock, shelf_rack_no as shelf_rack,
+    expirydate, DATEDIFF(expirydate, CURDATE()) as days_left
+"""
+
+@dashboard_widget('expiring')
+def get_expiring_medicines(days=EXPIRY_ALERT_DAYS, limit=EXPIRY_PANEL_LIMIT):
+    """In-stock medicines expiring within `days` days, soonest first"""
+    db = get_db_connection()
+    if not db:
+        return []
+    cur = db.cursor(dictionary=True)
+    cur.execute(f"""
+        SELECT {EXPIRY_COLUMNS}
+        FROM products
+        WHERE expirydate >= CURDATE()
+          AND expirydate < CURDATE() + INTERVAL %s DAY
+          AND countInStock > 0
+        ORDER BY expirydate, id
+        LIMIT %s
+    """, (days, limit))
+    data = cur.fetchall()
+    db.close()
+    return data
+
+@dashboard_widget('expired')
+def get_expired_medicines(limit=EXPIRY_PANEL_LIMIT):
+    """Medicines past expiry that still have stock on the shelf"""
+    db = get_db_connection()
+    if not db:
+        return []
+    cur = db.cursor(dictionary=True)
+    cur.execute(f"""
+        SELECT {EXPIRY_COLUMNS}
+        FROM products
+        WHERE expirydate < CURDATE()
+          AND countInStock > 0
+        ORDER BY expirydate, id
+        LIMIT %s
+    """, (limit,))
+    data = cur.fetchall()
+    db.close()
+    return data
+
+@dashboard_widget('expiry_counts')
+def get_expiry_counts(days=EXPIRY_ALERT_DAYS):
+    """{'expired': n, 'expiring': n} for in-stock products"""
+    db = get_db_connection()
+    if not db:
+        return {'expired': 0, 'expiring': 0}
+    cur = db.cursor()
+    cur.execute("""
+        SELECT COALESCE(SUM(expirydate < CURDATE()), 0),
+               COALESCE(SUM(expirydate >= CURDATE()), 0)
+        FROM products
+        WHERE expirydate < CURDATE() + INTERVAL %s DAY
+          AND countInStock > 0
+    """, (days,))
+    expired, expiring = cur.fetchone()
+    db.close()
+    return {'expired': int(expired), 'expiring': int(expiring)}
+
+def write_off_expired(product_ids=None, reason='expired'):
+    """
+    Move the stock of expired products (all, or just product_ids) into
+    stock_writeoffs and zero it, in one transaction. Returns units written off.
+    """
+    db = get_db_connection()
+    if not db:
+        return 0
+
+    cur = db.cursor()
+    where = "expirydate < CURDATE() AND countInStock > 0"
+    params = []
+    if product_ids is not None:
+        if not product_ids:
+            db.close()
+            return 0
+        where += f" AND id IN ({', '.join(['%s'] * len(product_ids))})"
+        params = list(product_ids)
+    try:
+        cur.execute(f"SELECT id, name, countInStock FROM products WHERE {where} FOR UPDATE", params)
+        rows = cur.fetchall()
+        if not rows:
+            db.rollback()
+            return 0
+        ids = [row[0] for row in rows]
+        id_placeholders = ', '.join(['%s'] * len(ids))
+        cur.execute(f"""
+            INSERT INTO stock_writeoffs
+                (product_id, product_name, quantity, expirydate, reason, written_off_at)
+            SELECT id, name, countInStock, expirydate, %s, %s
+            FROM products
+            WHERE id IN ({id_placeholders})
+        """, [reason, datetime.now(), *ids])
+        cur.execute(f"UPDATE products SET countInStock = 0 WHERE id IN ({id_placeholders})", ids)
+        names = sorted({row[1] for row in rows})
+        refresh_low_stock(cur, names)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Write-off Error: {e}")
+        return 0
+    finally:
+        db.close()
+
+    units = sum(int(row[2]) for row in rows)
+    invalidate_dashboard('writeoff')
+    on_catalog_changed(names)
+    print(f"🗑️ Wrote off {units} expired units across {len(rows)} products.")
+    return units
+
+# Batches of a product in first-expiry-first-out order (undated stock last)
+FEFO_ORDER = "name, expirydate IS NULL, expirydate, id"
+
+def allocate_fefo(rows, qty_by_name):
+    """
+    Split each requested quantity across a product's batches in the order
+    given, taking only what each unexpired batch holds. Rows need 'name',
+    'stock' and 'expired'. Returns ([(row, quantity), ...], {name: shortfall}).
+    """
+    remaining = dict(qty_by_name)
+    takes = []
+    for row in rows:
+        if row['expired'] or remaining.get(row['name'], 0) <= 0:
+            continue
+        take = min(remaining[row['name']], int(row['stock'] or 0))
+        if take > 0:
+            remaining[row['name']] -= take
+            takes.append((row, take))
+    return takes, {name: qty for name, qty in remaining.items() if qty > 0}
+
+def get_fefo_picks(qty_by_name):
+    """
+    First-expiry-first-out picking guidance: for each product name, which
+    racks to take the quantity from (earliest unexpired stock first), plus
+    any expired stock on the shelf that must not be sold.
+    """
+    names = list(qty_by_name)
+    if not names:
+        return {}
+    db = get_db_connection()
+    if not db:
+        return {}
+    cur = db.cursor(dictionary=True)
+    placeholders = ', '.join(['%s'] * len(names))
+    cur.execute(f"""
+        SELECT name, shelf_rack_no as shelf_rack, expirydate, countInStock as stock,
+               expirydate < CURDATE() as expired
+        FROM products
+        WHERE name IN ({placeholders}) AND countInStock > 0
+        ORDER BY {FEFO_ORDER}
+    """, names)
+    rows = cur.fetchall()
+    db.close()
+
+    picks = {}
+    for row in rows:
+        entry = picks.setdefault(row['name'], {'picks': [], 'expired': []})
+        if row['expired']:
+            entry['expired'].append({'shelf_rack': row['shelf_rack'], 'expirydate': row['expirydate'],
+                                     'quantity': row['stock']})
+    takes, _ = allocate_fefo(rows, qty_by_name)
+    for row, take in takes:
+        picks[row['name']]['picks'].append({'shelf_rack': row['shelf_rack'], 'expirydate': row['expirydate'],
+                                            'quantity': take})
+    return picks
+
+def get_reorder_quantities(names):
+    """
+    Units to order per product: its plan's order-up-to level minus current
+    stock (summed over all of its batches) and units already on order, as
+    shown on the low-stock list. Products fully covered are left out.
+    """
+    if not names:
+        return {}
+    db = get_db_connection()
+    if not db:
+        return {}
+
+    cur = db.cursor()
+    position, params = stock_position_sql(list(names))
+    cur.execute(f"SELECT name, order_qty FROM ({position}) pos", params)
+    quantities = {name: int(qty) for name, qty in cur.fetchall() if qty is not None and qty > 0}
+    db.close()
+    return quantities
+
+def format_po_no(po_id):
+    """Purchase order number derived from its id"""
+    return f"PO-{po_id:06d}"
+
+def create_purchase_orders(quantities):
+    """
+    Turn product name -> units into one purchase order per manufacturer, in a
+    single transaction: a header per supplier and every line in one batched
+    INSERT. Stock is untouched until the order is received. Returns the PO ids.
+    """
+    if not quantities:
+        return []
+    db = get_db_connection()
+    if not db:
+        return []
+
+    names = list(quantities)
     cur = db.cursor()
-    # Create placeholders for the IN clause (e.g., %s, %s, %s)
-    placeholders = ', '.join(['%s'] * len(selected_medicines))
-    query = f"UPDATE products SET countInStock = 50 WHERE name IN ({placeholders})"
-    
     try:
-        cur.execute(query, selected_medicines)
+        placeholders = ', '.join(['%s'] * len(names))
+        cur.execute(f"""
+            SELECT name, MAX(manufacture) FROM products
+            WHERE name IN ({placeholders})
+            GROUP BY name
+        """, names)
+        manufacturer_of = dict(cur.fetchall())
+        by_supplier = {}
+        for name in names:
+            by_supplier.setdefault(manufacturer_of.get(name) or None, []).append(name)
+
+        now = datetime.now()
+        delivery_date = now + timedelta(days=REORDER_LEAD_TIME_DAYS)
+        po_ids, lines = [], []
+        for manufacturer, products in by_supplier.items():
+            cur.execute("""
+                INSERT INTO purchase_orders
+                    (manufacturer, status, line_count, total_units, order_date, expected_delivery)
+                VALUES (%s, 'ordered', %s, %s, %s, %s)
+            """, (manufacturer, len(products), sum(quantities[n] for n in products), now, delivery_date))
+            po_ids.append(cur.lastrowid)
+            lines += [(cur.lastrowid, 'Supplier', n, quantities[n], 'Ordered', now, delivery_date)
+                      for n in products]
+
+        cur.executemany("""
+            INSERT INTO orders
+                (po_id, customer_phone, medicine_name, quantity, status, order_date, expected_delivery)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+        """, lines)
+        # Units now on order leave less to order on the low-stock list
+        refresh_low_stock(cur, names)
+        db.commit()
+        print(f"✅ Created {len(po_ids)} purchase orders ({len(lines)} lines).")
+        return po_ids
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Error Creating Purchase Orders: {e}")
+        return []
+    finally:
+        db.close()
+
+def receive_purchase_order(po_id):
+    """
+    Mark an open purchase order received and credit each product's units to
+    a single row, its newest batch (last in FEFO order), in one transaction.
+    Returns the units received (0 if the order is unknown or was already received).
+    """
+    db = get_db_connection()
+    if not db:
+        return 0
+
+    cur = db.cursor()
+    try:
+        cur.execute("SELECT status FROM purchase_orders WHERE id = %s FOR UPDATE", (po_id,))
+        row = cur.fetchone()
+        if not row or row[0] != 'ordered':
+            db.rollback()
+            return 0
+
+        cur.execute("""
+            SELECT medicine_name, SUM(quantity) FROM orders
+            WHERE po_id = %s AND status = 'Ordered'
+            GROUP BY medicine_name
+        """, (po_id,))
+        received = {name: int(qty) for name, qty in cur.fetchall()}
+        if received:
+            placeholders = ', '.join(['%s'] * len(received))
+            cur.execute(f"""
+                SELECT id, name FROM products
+                WHERE name IN ({placeholders})
+                ORDER BY {FEFO_ORDER}
+                FOR UPDATE
+            """, list(received))
+            # Rows come back in FEFO order, so the last one seen per name is the newest batch
+            target = {name: row_id for row_id, name in cur.fetchall()}
+            missing = [name for name in received if name not in target]
+            if missing:
+                print(f"⚠️ {format_po_no(po_id)}: no product row to credit for {', '.join(missing)}")
+                received = {name: qty for name, qty in received.items() if name in target}
+            cur.executemany("UPDATE products SET countInStock = countInStock + %s WHERE id = %s",
+                            [(qty, target[name]) for name, qty in received.items()])
+            refresh_low_stock(cur, list(received))
+        cur.execute("UPDATE orders SET status = 'Delivered' WHERE po_id = %s AND status = 'Ordered'", (po_id,))
+        cur.execute("UPDATE purchase_orders SET status = 'received', received_at = NOW() WHERE id = %s", (po_id,))
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Receive Error: {e}")
+        return 0
+    finally:
+        db.close()
+
+    on_catalog_changed(list(received))
+    invalidate_dashboard('restock')
+    units = sum(received.values())
+    print(f"✅ Received {format_po_no(po_id)}: {units} units across {len(received)} medicines.")
+    return units
+
+def compute_reorder_levels(rows, quantities, days):
+    """
+    Vectorized reorder levels from sparse daily sales: rows[i] is the product
+    index of one (product, day) total quantities[i]; days[p] is the length of
+    product p's history, and days without a row sold nothing.
+    Returns (avg_daily, std_daily, reorder_point, order_up_to) arrays.
+    """
+    # Sums and sums of squares over each history; zero days add nothing to either
+    total = np.bincount(rows, weights=quantities, minlength=len(days))
+    total_sq = np.bincount(rows, weights=quantities * quantities, minlength=len(days))
+    avg = total / days
+    std = np.sqrt(np.maximum(total_sq / days - avg * avg, 0))
+
+    lead, cover = REORDER_LEAD_TIME_DAYS, REORDER_LEAD_TIME_DAYS + REORDER_REVIEW_DAYS
+    # Reorder when stock can't cover lead-time demand plus safety stock
+    reorder_point = np.ceil(avg * lead + REORDER_SAFETY_Z * std * np.sqrt(lead)).astype(int)
+    reorder_point = np.maximum(reorder_point, 1)
+    # Restock up to demand over lead time + review period, plus safety stock
+    order_up_to = np.ceil(avg * cover + REORDER_SAFETY_Z * std * np.sqrt(cover)).astype(int)
+    order_up_to = np.maximum(order_up_to, reorder_point + 1)
+    return avg, std, reorder_point, order_up_to
+
+def rebuild_reorder_plan(names=None):
+    """
+    Recompute reorder_plan from product_sales_daily for the given products
+    (or every product that has sold), over each product's full sales history
+    from its first sale to today. Products with no sales lose their plan
+    row and fall back to the default levels.
+    """
+    db = get_db_connection()
+    if not db:
+        return False
+
+    today = date.today()
+    computed_at = datetime.now().replace(microsecond=0)
+    cur = db.cursor()
+    try:
+        where, params = "WHERE day <= %s", [today]
+        if names is not None:
+            if not names:
+                return True
+            where += f" AND product_name IN ({', '.join(['%s'] * len(names))})"
+            params += list(names)
+        # One row per (product, day), guaranteed by the primary key
+        cur.execute(f"""
+            SELECT product_name, day, quantity
+            FROM product_sales_daily
+            {where}
+        """, params)
+
+        index, rows, quantities, first_sale = {}, array('i'), array('d'), []
+        while True:
+            batch = cur.fetchmany(SEARCH_LOAD_BATCH)
+            if not batch:
+                break
+            for name, day, qty in batch:
+                row = index.setdefault(name, len(index))
+                if row == len(first_sale):
+                    first_sale.append(day)
+                elif day < first_sale[row]:
+                    first_sale[row] = day
+                rows.append(row)
+                quantities.append(float(qty))
+
+        product_names = list(index)
+        if product_names:
+            # A short history is stretched so one busy first day doesn't read as a trend
+            days = np.maximum([(today - day).days + 1 for day in first_sale], REORDER_MIN_HISTORY_DAYS)
+            avg, std, reorder_point, order_up_to = compute_reorder_levels(
+                np.frombuffer(rows, dtype=np.int32), np.frombuffer(quantities, dtype=np.float64), days
+            )
+            plan = list(zip(product_names, avg.tolist(), std.tolist(), reorder_point.tolist(),
+                            order_up_to.tolist(), [computed_at] * len(product_names)))
+            for start in range(0, len(plan), REORDER_WRITE_BATCH):
+                cur.executemany("""
+                    INSERT INTO reorder_plan
+                        (product_name, avg_daily, std_daily, reorder_point, order_up_to, computed_at)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                    ON DUPLICATE KEY UPDATE
+                        avg_daily = VALUES(avg_daily),
+                        std_daily = VALUES(std_daily),
+                        reorder_point = VALUES(reorder_point),
+                        order_up_to = VALUES(order_up_to),
+                        computed_at = VALUES(computed_at)
+                """, plan[start:start + REORDER_WRITE_BATCH])
+
+        # Plans that were not refreshed this run belong to products with no sales
+        if names is None:
+            cur.execute("DELETE FROM reorder_plan WHERE computed_at < %s", (computed_at,))
+        else:
+            stale = [name for name in names if name not in index]
+            if stale:
+                cur.execute(f"DELETE FROM reorder_plan WHERE product_name IN ({', '.join(['%s'] * len(stale))})",
+                            stale)
+        # New reorder points move products into or out of the low-stock view
+        refresh_low_stock(cur, names)
         db.commit()
-        print(f"✅ Restocked {cur.rowcount} medicines.")
     except Exception as e:
-        print(f"❌ Restock Error: {e}")
+        db.rollback()
+        print(f"❌ Reorder Plan Error: {e}")
+        return False
     finally:
         db.close()
 
+    invalidate_dashboard('reorder')
+    if names is None:
+        print(f"✅ Rebuilt reorder plan for {len(product_names)} products.")
+    return True
+
+# Products sold since the last incremental recompute; drained on a background thread
+reorder_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='reorder')
+reorder_pending = set()
+reorder_pending_lock = threading.Lock()
+
+def schedule_reorder_update(names):
+    """Queue a recompute of the reorder plan for products that just sold"""
+    with reorder_pending_lock:
+        idle = not reorder_pending
+        reorder_pending.update(names)
+    if idle:
+        reorder_executor.submit(_drain_reorder_updates)
+
+def _drain_reorder_updates():
+    with reorder_pending_lock:
+        names = list(reorder_pending)
+        reorder_pending.clear()
+    if names:
+        rebuild_reorder_plan(names)
+
 def get_staff_members():
     """Get mock staff data"""
     return [
@@ -130,24 +2277,19 @@ def get_staff_members():
     ]
 
 # OWNER ANALYTICS FUNCTIONS
+@dashboard_widget('total_sales')
 def get_total_sales():
-    """Get total revenue from all bills (unique per customer/day)"""
+    """Get total revenue from the daily sales rollup"""
     db = get_db_connection()
     if not db:
         return 0
     cur = db.cursor()
-    cur.execute("""
-        SELECT COALESCE(SUM(bill_total), 0)
-        FROM (
-            SELECT MAX(final_amount) AS bill_total
-            FROM bills
-            GROUP BY customer_name, phone, bill_date
-        ) AS unique_bills
-    """)
+    cur.execute("SELECT COALESCE(SUM(revenue), 0) FROM sales_daily")
     total = cur.fetchone()[0] or 0
     db.close()
     return float(total)
 
+@dashboard_widget('daily_sales')
 def get_daily_sales():
     """Get daily sales for last 7 days"""
     db = get_db_connection()
@@ -155,16 +2297,16 @@ def get_daily_sales():
         return []
     cur = db.cursor(dictionary=True)
     cur.execute("""
-        SELECT DATE(bill_date) AS day, COALESCE(SUM(DISTINCT final_amount), 0) AS total_sales
-        FROM bills 
-        WHERE DATE(bill_date) >= CURDATE() - INTERVAL 7 DAY
-        GROUP BY DATE(bill_date) 
+        SELECT day, revenue AS total_sales
+        FROM sales_daily
+        WHERE day >= CURDATE() - INTERVAL 7 DAY
         ORDER BY day DESC
     """)
     data = cur.fetchall()
     db.close()
     return data
 
+@dashboard_widget('recent_bills')
 def get_recent_bills(limit=15):
     """Get recent billing history"""
     db = get_db_connection()
@@ -173,64 +2315,140 @@ def get_recent_bills(limit=15):
     cur = db.cursor(dictionary=True)
     cur.execute("""
         SELECT
-            MIN(id) AS bill_id,
+            id AS bill_id,
+            invoice_no,
             customer_name,
             phone,
-            COUNT(*) AS total_items,
-            SUM(quantity) AS total_quantity,
-            MAX(final_amount) AS final_amount,
+            item_count AS total_items,
+            total_quantity,
+            final_amount,
             bill_date
-        FROM bills
-        GROUP BY customer_name, phone, bill_date
-        ORDER BY bill_date DESC
+        FROM bill_headers
+        ORDER BY bill_date DESC, id DESC
         LIMIT %s
     """, (limit,))
     bills = cur.fetchall()
     db.close()
     return bills
 
-def get_customers():
-    """Get customer analytics"""
+@dashboard_widget('customers')
+def get_customers(limit=CUSTOMER_TOP_LIMIT):
+    """Top customers, read from customer_profiles along its (order_count, total_quantity) index"""
     db = get_db_connection()
     if not db:
         return []
     cur = db.cursor(dictionary=True)
     cur.execute("""
-        SELECT 
-            customer_name, 
-            phone, 
-            COUNT(*) as total_orders,
-            SUM(quantity) as total_quantity,
-            COUNT(DISTINCT medicine_name) as unique_medicines
-        FROM customers 
-        GROUP BY customer_name, phone 
-        ORDER BY total_orders DESC, total_quantity DESC 
-        LIMIT 20
-    """)
+        SELECT
+            customer_name,
+            phone,
+            order_count AS total_orders,
+            total_quantity,
+            unique_medicines,
+            last_visit
+        FROM customer_profiles
+        ORDER BY order_count DESC, total_quantity DESC
+        LIMIT %s
+    """, (limit,))
     data = cur.fetchall()
     db.close()
     return data
 
+def normalize_phone(phone):
+    """Phone number reduced to its last 10 digits (drops spaces, +91, leading 0); '' if none"""
+    digits = re.sub(r'\D', '', phone or '')
+    return digits[-10:]
+
+def record_customer_visit(cur, customer_name, phone, quantities, visited_at=None,
+                          manufacturer=None, dose=None):
+    """
+    Add one order (medicine name -> units) to the customer's profile on the
+    caller's cursor, inside the caller's transaction.
+    """
+    phone_norm = normalize_phone(phone)
+    quantities = {name: qty for name, qty in quantities.items() if name}
+    if not phone_norm or not quantities:
+        return
+
+    cur.execute("""
+        INSERT INTO customer_profiles
+            (phone_norm, customer_name, phone, order_count, total_quantity, last_visit)
+        VALUES (%s, %s, %s, 1, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            customer_name = COALESCE(VALUES(customer_name), customer_name),
+            phone = VALUES(phone),
+            order_count = order_count + 1,
+            total_quantity = total_quantity + VALUES(total_quantity),
+            last_visit = COALESCE(GREATEST(last_visit, VALUES(last_visit)), VALUES(last_visit), last_visit)
+    """, (phone_norm, customer_name or None, phone, sum(quantities.values()), visited_at))
+    cur.executemany("""
+        INSERT INTO customer_medicines
+            (phone_norm, medicine_name, manufacturer, dose, quantity, last_quantity, times, last_bought)
+        VALUES (%s, %s, %s, %s, %s, %s, 1, %s)
+        ON DUPLICATE KEY UPDATE
+            manufacturer = COALESCE(VALUES(manufacturer), manufacturer),
+            dose = COALESCE(VALUES(dose), dose),
+            quantity = quantity + VALUES(quantity),
+            last_quantity = VALUES(last_quantity),
+            times = times + 1,
+            last_bought = VALUES(last_bought)
+    """, [(phone_norm, name, manufacturer, dose, qty, qty, visited_at) for name, qty in quantities.items()])
+    # A primary-key range count over this one customer's medicines
+    cur.execute("""
+        UPDATE customer_profiles
+        SET unique_medicines = (SELECT COUNT(*) FROM customer_medicines WHERE phone_norm = %s)
+        WHERE phone_norm = %s
+    """, (phone_norm, phone_norm))
+
+def find_customer_profile(phone):
+    """A customer's profile plus their most recent medicine, by normalized phone (or None)"""
+    phone_norm = normalize_phone(phone)
+    if not phone_norm:
+        return None
+    db = get_db_connection()
+    if not db:
+        return None
+    cur = db.cursor(dictionary=True)
+    cur.execute("""
+        SELECT customer_name, phone, order_count, total_quantity, unique_medicines, last_visit
+        FROM customer_profiles
+        WHERE phone_norm = %s
+    """, (phone_norm,))
+    profile = cur.fetchone()
+    if profile:
+        cur.execute("""
+            SELECT medicine_name, manufacturer, dose, last_quantity AS quantity
+            FROM customer_medicines
+            WHERE phone_norm = %s
+            ORDER BY last_bought DESC
+            LIMIT 1
+        """, (phone_norm,))
+        profile.update(cur.fetchone() or {})
+    db.close()
+    return profile
+
+@dashboard_widget('top_selling')
 def get_top_selling_medicines(limit=5):
-    """Get top selling medicines"""
+    """Get top selling medicines (summed from the per-product daily rollup)"""
     db = get_db_connection()
     if not db:
         return []
     cur = db.cursor(dictionary=True)
     cur.execute("""
-        SELECT medicine_name, 
-               COALESCE(SUM(quantity), 0) AS total_sold, 
-               COALESCE(SUM(final_amount), 0) AS total_revenue
-        FROM bills 
-        GROUP BY medicine_name 
-        HAVING total_sold > 0 
-        ORDER BY total_sold DESC 
+        SELECT product_name AS medicine_name,
+               SUM(quantity) AS total_sold,
+               SUM(revenue) AS total_revenue
+        FROM product_sales_daily
+        GROUP BY product_name
+        HAVING total_sold > 0
+        ORDER BY total_sold DESC
         LIMIT %s
     """, (limit,))
     data = cur.fetchall()
     db.close()
     return data
 
+@dashboard_widget('sales_chart')
 def get_sales_chart_data(days=15):
     """15-day sales trend data for chart"""
     db = get_db_connection()
@@ -238,20 +2456,14 @@ def get_sales_chart_data(days=15):
         return {"labels": [], "data": []}
     cur = db.cursor(dictionary=True)
     cur.execute("""
-        SELECT
-            DATE(bill_date) AS day,
-            MAX(final_amount) AS bill_total
-        FROM bills
-        WHERE bill_date >= DATE_SUB(CURDATE(), INTERVAL %s DAY)
-        GROUP BY customer_name, phone, bill_date
+        SELECT day, revenue
+        FROM sales_daily
+        WHERE day >= DATE_SUB(CURDATE(), INTERVAL %s DAY)
     """, (days,))
-    bill_rows = cur.fetchall()
+    rows = cur.fetchall()
     db.close()
 
-    daily_totals = {}
-    for row in bill_rows:
-        day = str(row["day"])
-        daily_totals[day] = daily_totals.get(day, 0) + float(row["bill_total"] or 0)
+    daily_totals = {str(row["day"]): float(row["revenue"] or 0) for row in rows}
 
     labels = []
     data = []
@@ -264,6 +2476,7 @@ def get_sales_chart_data(days=15):
 
     return {"labels": labels, "data": data}
 
+@dashboard_widget('top_medicines')
 def get_top_medicines_chart():
     """Top medicines chart data"""
     data = get_top_selling_medicines(10)
@@ -271,40 +2484,43 @@ def get_top_medicines_chart():
     values = [float(d['total_revenue']) for d in data]
     return {"labels": labels, "data": values}
 
+@dashboard_widget('monthly_sales')
 def get_monthly_sales_chart(months=12):
-    """Monthly sales trend"""
+    """Monthly sales trend (calendar months, derived from the daily rollup)"""
+    # First day of each of the last `months` calendar months, oldest first
+    today = datetime.now().date()
+    month_starts = []
+    for i in range(months - 1, -1, -1):
+        index = today.year * 12 + today.month - 1 - i
+        month_starts.append(date(index // 12, index % 12 + 1, 1))
+
     db = get_db_connection()
     if not db:
         return {"labels": [], "data": []}
     cur = db.cursor(dictionary=True)
     cur.execute("""
-        SELECT 
-            YEAR(bill_date) AS yr,
-            MONTH(bill_date) AS mn,
-            MAX(final_amount) AS bill_total
-        FROM bills
-        WHERE bill_date >= DATE_SUB(CURDATE(), INTERVAL %s MONTH)
-        GROUP BY customer_name, phone, bill_date
-    """, (months,))
+        SELECT
+            YEAR(day) AS yr,
+            MONTH(day) AS mn,
+            SUM(revenue) AS revenue
+        FROM sales_daily
+        WHERE day >= %s
+        GROUP BY YEAR(day), MONTH(day)
+    """, (month_starts[0],))
     rows = cur.fetchall()
     db.close()
 
-    monthly_total = {}
-    for r in rows:
-        key = f"{r['yr']}-{r['mn']:02d}"
-        monthly_total[key] = monthly_total.get(key, 0) + float(r['bill_total'] or 0)
+    monthly_total = {f"{r['yr']}-{r['mn']:02d}": float(r['revenue'] or 0) for r in rows}
 
     labels = []
     data = []
-    today = datetime.now()
-    for i in range(months - 1, -1, -1):
-        d = today - timedelta(days=30 * i)
-        key = f"{d.year}-{d.month:02d}"
+    for d in month_starts:
         labels.append(d.strftime("%b %Y"))
-        data.append(round(monthly_total.get(key, 0), 2))
+        data.append(round(monthly_total.get(f"{d.year}-{d.month:02d}", 0), 2))
 
     return {"labels": labels, "data": data}
 
+@dashboard_widget('company_stock')
 def get_company_stock_chart(limit=10):
     """Get top manufacturers by product count from DB"""
     db = get_db_connection()
@@ -331,44 +2547,29 @@ def get_company_stock_chart(limit=10):
 
 @app.route('/place_restock_order', methods=['POST'])
 def place_restock_order():
-    """Process restock: Create Order Record + Reset Stock to 50"""
+    """Process restock: one purchase order per supplier, credited to stock when received"""
+    if session.get('role') not in ['owner', 'staff']:
+        return redirect(url_for('login_page'))
+
     selected_meds = request.form.getlist('selected_meds')
     
     if selected_meds:
-        # STEP 1: Insert into ORDERS table (To show in Track Orders)
-        try:
-            db = get_db_connection()
-            if db:
-                cur = db.cursor()
-                now = datetime.now()
-                delivery_date = now + timedelta(days=7) # ✅ Delivery = Current + 7 Days
-
-                for med_name in selected_meds:
-                    # We insert 'Supplier' as placeholder for phone, and 50 as quantity
-                    cur.execute("""
-                        INSERT INTO orders 
-                        (customer_phone, medicine_name, quantity, status, order_date, expected_delivery) 
-                        VALUES (%s, %s, %s, %s, %s, %s)
-                    """, (
-                        'Supplier',    # Placeholder for customer_phone
-                        med_name,      # Medicine Name
-                        50,            # Quantity (Since we reset stock to 50)
-                        'Ordered',     # Status
-                        now,           # Order Date (Current)
-                        delivery_date  # Expected Delivery (+7 Days)
-                    ))
-                
-                db.commit()
-                db.close()
-                print(f"✅ Created {len(selected_meds)} new orders in database.")
-        except Exception as e:
-            print(f"❌ Error Creating Orders: {e}")
-
-        # STEP 2: Update Stock in Products Table (Removes from Low Stock Page)
-        restock_medicines(selected_meds)
+        # Units per product from the reorder plan, less what is already on order
+        quantities = get_reorder_quantities(selected_meds)
+        if create_purchase_orders(quantities):
+            invalidate_dashboard('restock')
     
     return redirect(url_for('low_stock_page'))
 
+@app.route('/purchase_orders/<int:po_id>/receive', methods=['POST'])
+def receive_purchase_order_route(po_id):
+    """Goods arrived: credit the purchase order's lines to stock"""
+    if session.get('role') not in ['owner', 'staff']:
+        return redirect(url_for('login_page'))
+    receive_purchase_order(po_id)
+    return redirect(url_for('track_orders'))
+
+@dashboard_widget('recent_orders')
 def get_recent_orders(limit=5):
     """Recent purchase orders"""
     db = get_db_connection()
@@ -376,9 +2577,12 @@ def get_recent_orders(limit=5):
         return []
     cur = db.cursor(dictionary=True)
     cur.execute("""
-        SELECT id, customer_phone, medicine_name, quantity, status, order_date, expected_delivery 
-        FROM orders 
-        ORDER BY order_date DESC 
+        SELECT o.id, o.po_id, o.customer_phone, o.medicine_name, o.quantity, o.status,
+               o.order_date, o.expected_delivery,
+               po.manufacturer, po.status AS po_status
+        FROM orders o
+        LEFT JOIN purchase_orders po ON po.id = o.po_id
+        ORDER BY o.order_date DESC, o.id DESC
         LIMIT %s
     """, (limit,))
     orders = cur.fetchall()
@@ -386,20 +2590,24 @@ def get_recent_orders(limit=5):
     return orders
 
 def cleanup_old_orders():
-    """Remove orders that are 3 days past their expected delivery date"""
+    """Remove delivered order lines 3 days after delivery (open orders are kept)"""
     db = get_db_connection()
     if not db:
         return
 
     cur = db.cursor()
     try:
-        # Delete orders where expected_delivery is older than 3 days ago
+        # Purchase-order lines go once received; legacy lines (stocked when
+        # ordered) still go 3 days after their expected delivery
         cur.execute("""
-            DELETE FROM orders 
-            WHERE expected_delivery < DATE_SUB(CURDATE(), INTERVAL 3 DAY)
+            DELETE o FROM orders o
+            LEFT JOIN purchase_orders po ON po.id = o.po_id
+            WHERE (o.po_id IS NULL AND o.expected_delivery < DATE_SUB(CURDATE(), INTERVAL 3 DAY))
+               OR (po.status = 'received' AND po.received_at < DATE_SUB(CURDATE(), INTERVAL 3 DAY))
         """)
         db.commit()
         if cur.rowcount > 0:
+            invalidate_dashboard('orders')
             print(f"🧹 Cleaned up {cur.rowcount} expired orders.")
     except Exception as e:
         print(f"❌ Error cleaning old orders: {e}")
@@ -424,23 +2632,11 @@ def get_medicines_by_company(company_name):
     db.close()
     return data
 def get_medicines_by_category(category_name):
-    """Filter medicines from DB by Category (checking use0 and use1)"""
-    db = get_db_connection()
-    if not db:
-        return []
-
-    cur = db.cursor(dictionary=True)
-    term = f"%{category_name}%"
-    # ✅ FIX: Select 'use0' as 'Use' here too
-    cur.execute("""
-        SELECT name, price, countInStock, shelf_rack_no, manufacture, use0 as `Use`, use1 
-        FROM products 
-        WHERE use0 LIKE %s OR use1 LIKE %s
-    """, (term, term))
-    
-    data = cur.fetchall()
-    db.close()
-    return data
+    """Medicines whose use0/use1 match the category query, plus related-use facet counts"""
+    rows, facets = catalog_index.browse_uses(parse_use_query(category_name))
+    # ✅ FIX: Expose 'use0' as 'Use' here too
+    medicines = [dict(row, Use=row['use0'], shelf_rack_no=row['shelf_rack']) for row in rows]
+    return medicines, facets
 
 
 @app.route('/contact')
@@ -475,20 +2671,16 @@ def init_user_list():
         ]
         
         try:
-            with open(USERS_CSV, 'w', newline='', encoding='utf-8') as f:
-                fieldnames = ['username', 'password', 'role', 'phone']
-                writer = csv.DictWriter(f, fieldnames=fieldnames)
-                writer.writeheader()
-                writer.writerows(users)
+            with users_file_lock():
+                # Another worker may have created it while we waited
+                if not os.path.exists(USERS_CSV):
+                    _write_users_file(users)
             print("✅ User List (user.csv) created successfully!")
         except Exception as e:
             print(f"❌ Error creating user list: {e}")
             
 @app.route('/login', methods=['GET', 'POST'])
 def login_page():
-    # Ensure List exists
-    init_user_list()
-
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
@@ -505,29 +2697,27 @@ def login_page():
         print(f"🔑 Input Password: {password}")
         print(f"🔐 Input Hash: {input_hash}")
 
-        # Read Users
-        users = read_users()
+        # Look up the cached user directory (keyed by username + role)
+        user = user_directory.get(username, role)
         
-        for user in users:
-            # Check if Username and Role match
-            if user['username'] == username and user['role'] == role:
-                print(f"✅ User Found in CSV: {user}")
+        if user:
+            print(f"✅ User Found in CSV: {user}")
+            
+            # CHECK 1: Is the password in CSV equal to the HASH? (Normal case)
+            # CHECK 2: Is the password in CSV equal to PLAIN text? (If you manually edited CSV)
+            if user['password'] == input_hash or user['password'] == password:
+                session.clear()
+                session['role'] = role
+                session['username'] = username
+                session['cart'] = {}
+                print("🚀 LOGIN SUCCESS!")
                 
-                # CHECK 1: Is the password in CSV equal to the HASH? (Normal case)
-                # CHECK 2: Is the password in CSV equal to PLAIN text? (If you manually edited CSV)
-                if user['password'] == input_hash or user['password'] == password:
-                    session.clear()
-                    session['role'] = role
-                    session['username'] = username
-                    session['cart'] = []
-                    print("🚀 LOGIN SUCCESS!")
-                    
-                    if role == 'staff':
-                        return redirect(url_for('staff'))
-                    else:
-                        return redirect(url_for('owner'))
+                if role == 'staff':
+                    return redirect(url_for('staff'))
                 else:
-                    print(f"❌ Password Mismatch. CSV has: {user['password']}")
+                    return redirect(url_for('owner'))
+            else:
+                print(f"❌ Password Mismatch. CSV has: {user['password']}")
 
         print("❌ Login Failed: No matching user/password found.")
         return render_template('login.html', msg="Invalid Username or Password")
@@ -549,25 +2739,20 @@ def forgot_password():
         if not all([username, role, phone, new_password]):
             message = "All fields are required."
         else:
-            users = read_users()
-            user_found = False
+            def reset_password(users):
+                # Loop through users to find the match
+                for user in users:
+                    if (user['username'] == username and
+                        user['role'] == role and
+                        user['phone'] == phone):
+                        
+                        # Hash the new password before saving
+                        user['password'] = hashlib.sha256(new_password.encode()).hexdigest()[:32]
+                        return True
+                return False
             
-            # Loop through users to find the match
-            for user in users:
-                if (user['username'] == username and
-                    user['role'] == role and
-                    user['phone'] == phone):
-                    
-                    # Hash the new password before saving
-                    hashed_pw = hashlib.sha256(new_password.encode()).hexdigest()[:32]
-                    user['password'] = hashed_pw
-                    
-                    user_found = True
-                    break
-            
-            if user_found:
-                # Write the updated list back to CSV
-                write_users(users)
+            # Re-read, edit and atomically rewrite user.csv under the file lock
+            if user_directory.update(reset_password):
                 success = True
                 message = "Password updated successfully. Please login."
             else:
@@ -589,17 +2774,41 @@ def staff():
     if session.get('role') != 'staff':
         return redirect(url_for('login_page'))
 
+    # Current page of the last search, sliced from the server-side result store
+    search_text = session.get('last_search_text', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    medicines, search_total = [], 0
+    terms = parse_search_terms(search_text)
+    if terms:
+        ids = search_results.get(session.get('search_token'), search_text)
+        if ids is None:
+            # Expired, evicted or from before a restart: search again
+            ids = catalog_index.search_ids(terms)
+            session['search_token'] = search_results.put(search_text, ids)
+        search_total = len(ids)
+        start = (page - 1) * SEARCH_PAGE_SIZE
+        medicines = catalog_index.rows_for(ids[start:start + SEARCH_PAGE_SIZE])
+    alternatives = catalog_index.alternatives_for([m['name'] for m in medicines]) if medicines else {}
+
+    widgets = fetch_widgets({
+        'daily_sales': (get_daily_sales, (), []),
+        'customers': (get_customers, (), []),
+        'billing_history': (get_recent_bills, (15,), []),
+        'low_stock_count': (get_low_stock_count, (), 0),
+        'company_stock_chart': (get_company_stock_chart, (), {"labels": [], "data": []}),
+    })
+
     return render_template(
         'staff.html',
-        medicines=session.get('last_search_results', []),
-        last_search_text=session.get('last_search_text', ''),
+        medicines=medicines,
+        alternatives=alternatives,
+        search_total=search_total,
+        page=page,
+        page_count=(search_total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE,
+        last_search_text=search_text,
         message=session.pop('search_message', ''),
-        daily_sales=get_daily_sales(),
-        customers=get_customers(),
-        billing_history=get_recent_bills(15),
-        low_stock_medicines=get_low_stock_medicines(10),
-        cart_count=len(session.get('cart', [])),
-        company_stock_chart=get_company_stock_chart()  # ✅ ADD THIS
+        cart_count=len(get_cart()),
+        **widgets
     )
 
 
@@ -610,47 +2819,58 @@ def search_medicine():
 
     raw_input = request.form.get('searchText', '').strip()
     # Split by comma or newline for multiple search terms
-    terms = [t.strip() for t in raw_input.replace(',', '\n').splitlines() if t.strip()]
+    terms = parse_search_terms(raw_input)
 
     if not terms:
         return redirect(url_for('staff'))
 
-    db = get_db_connection()
-    results = []
-    
-    if db:
-        cur = db.cursor(dictionary=True)
-        # Build a dynamic query: SELECT * FROM products WHERE name LIKE %s OR name LIKE %s ...
-        # This implementation searches for ANY of the terms
-        where_clauses = " OR ".join(["name LIKE %s" for _ in terms])
-        params = [f"%{term}%" for term in terms]
-        
-        query = f"""
-            SELECT name, price, countInStock, shelf_rack_no as shelf_rack, 
-                   manufacture, use0, use1 
-            FROM products 
-            WHERE {where_clauses}
-        """
-        
-        cur.execute(query, params)
-        results = cur.fetchall()
-        db.close()
+    # Results stay server-side; the session only carries the text and a short token
+    ids = catalog_index.search_ids(terms)
 
-    session['last_search_results'] = results
+    session.pop('last_search_results', None)
     session['last_search_text'] = raw_input
-    session['search_message'] = "" if results else "No medicine found"
+    session['search_token'] = search_results.put(raw_input, ids)
+    session['search_message'] = "" if ids else "No medicine found"
 
     return redirect(url_for('staff'))
 
 
 
+def get_cart():
+    """The session cart: product name -> {'price', 'quantity', 'shelf_rack'}"""
+    cart = session.get('cart') or {}
+    if isinstance(cart, list):
+        # Carts saved before the dict layout
+        converted = {}
+        for item in cart:
+            add_cart_item(converted, item['name'], item['price'], item['quantity'], item.get('shelf_rack', 'N/A'))
+        cart = converted
+    return cart
+
+def save_cart(cart):
+    session['cart'] = cart
+
+def add_cart_item(cart, name, price, qty, shelf_rack):
+    """Add qty of a product, merging with an existing line of the same name"""
+    if not name:
+        return
+    if name in cart:
+        cart[name]['quantity'] += qty
+    else:
+        cart[name] = {'price': price, 'quantity': qty, 'shelf_rack': shelf_rack}
+
+def cart_items(cart):
+    """Cart lines as a list of dicts with 'name' (for templates and billing)"""
+    return [{'name': name, **line} for name, line in cart.items()]
+
+
 @app.route('/add_to_cart', methods=['POST'])
 def add_to_cart():
     """Add a single medicine (from search results) to cart"""
     if session.get('role') != 'staff':
         return redirect(url_for('login_page'))
 
-    cart = session.get('cart', [])
+    cart = get_cart()
 
     name = request.form.get('name')
     price_raw = request.form.get('price', '0')
@@ -667,23 +2887,8 @@ def add_to_cart():
         qty = 1
 
     # Merge if already in cart
-    found = False
-    for item in cart:
-        if item['name'] == name:
-            item['quantity'] += qty
-            found = True
-            break
-
-    if not found:
-        cart.append({
-            'name': name,
-            'price': price,
-            'quantity': qty,
-            'shelf_rack': shelf
-        })
-
-    session['cart'] = cart
-    session.modified = True
+    add_cart_item(cart, name, price, qty, shelf)
+    save_cart(cart)
 
     # Back to staff page (where search results + cart_count are shown)
     return redirect(url_for('staff'))
@@ -695,7 +2900,7 @@ def bulk_add_to_cart():
     if session.get('role') != 'staff':
         return redirect(url_for('login_page'))
     
-    cart = session.get('cart', [])
+    cart = get_cart()
     selected = request.form.getlist('selected[]')
 
     for idx in selected:
@@ -713,23 +2918,9 @@ def bulk_add_to_cart():
         except ValueError:
             qty = 1
 
-        found = False
-        for item in cart:
-            if item['name'] == name:
-                item['quantity'] += qty
-                found = True
-                break
-
-        if not found:
-            cart.append({
-                'name': name,
-                'price': price,
-                'quantity': qty,
-                'shelf_rack': shelf
-            })
+        add_cart_item(cart, name, price, qty, shelf)
 
-    session['cart'] = cart
-    session.modified = True
+    save_cart(cart)
     return redirect(url_for('cart'))
 
 
@@ -740,9 +2931,9 @@ def remove_from_cart():
         return redirect(url_for('login_page'))
 
     name = request.form.get('medicine_name')
-    cart = session.get('cart', [])
-    session['cart'] = [item for item in cart if item['name'] != name]
-    session.modified = True
+    cart = get_cart()
+    cart.pop(name, None)
+    save_cart(cart)
     return redirect(url_for('cart'))
 
 
@@ -751,52 +2942,453 @@ def cart():
     """Shopping cart view"""
     if session.get('role') != 'staff':
         return redirect(url_for('login_page'))
-    cart = session.get('cart', [])
+    cart = cart_items(get_cart())
     subtotal = sum(i['price'] * i['quantity'] for i in cart)
-    return render_template('cart.html', cart=cart, subtotal=subtotal)
+    alternatives = catalog_index.alternatives_for([i['name'] for i in cart]) if cart else {}
+    return render_template('cart.html', cart=cart, subtotal=subtotal, alternatives=alternatives)
+
+
+@app.route('/medicine_alternatives')
+def medicine_alternatives():
+    """In-stock substitutes for one product as JSON"""
+    if session.get('role') not in ['owner', 'staff']:
+        return redirect(url_for('login_page'))
+    name = request.args.get('name', '').strip()
+    if not name:
+        return jsonify({'error': 'name is required'}), 400
+
+    alternatives = [
+        {key: alt[key] for key in ('name', 'price', 'countInStock', 'shelf_rack', 'manufacture', 'depth')}
+        for alt in catalog_index.alternatives(name, limit=request.args.get('limit', SUBSTITUTE_MAX_RESULTS, type=int))
+    ]
+    return jsonify({'name': name, 'alternatives': alternatives})
+
+def to_paise(amount):
+    """Money as an exact integer number of paise (half-up)"""
+    return int((Decimal(str(amount)) * 100).quantize(Decimal(1), ROUND_HALF_UP))
+
+def from_paise(paise):
+    """Integer paise back to a 2-place Decimal"""
+    return Decimal(int(paise)).scaleb(-2)
+
+def money_to_float(value):
+    """Decimal amounts (nested in dicts/lists) as floats, for values kept in the session"""
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, dict):
+        return {k: money_to_float(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [money_to_float(v) for v in value]
+    return value
+
+
+class PricingEngine:
+    """
+    Prices carts with exact money math: amounts are integer paise and rates
+    basis points, so a whole cart is priced in one numpy pass without float
+    drift. Each product uses its own GST slab (products.gst_rate) and the most
+    specific matching discount rule (product > manufacturer > all), falling back
+    to BILL_DISCOUNT_RATE. Priced carts are cached by their contents.
+    """
+    SCOPES = ('product', 'manufacturer', 'all')   # most specific first
+
+    def __init__(self, cache_size=PRICED_CART_CACHE_SIZE, ttl=PRICING_TTL):
+        self.cache_size = cache_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()    # cart key -> (expires_at, priced cart)
+        self._rules = None             # scope -> match value -> [rule, ...]
+        self._rules_expire = 0.0
+        self._stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+    def invalidate(self):
+        """Forget cached rules and priced carts (after a slab or rule change)"""
+        with self._lock:
+            self._cache.clear()
+            self._rules = None
+            self._stats['invalidations'] += 1
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            data['cached_carts'] = len(self._cache)
+        return data
+
+    def _load_rules(self, cur):
+        """Active discount rules grouped by scope and (lowercased) match value"""
+        with self._lock:
+            if self._rules is not None and self._rules_expire > time.monotonic():
+                return self._rules
+        cur.execute("""
+            SELECT scope, match_value, percent, min_qty, starts_on, ends_on
+            FROM discount_rules
+            WHERE active = 1
+        """)
+        rules = {scope: {} for scope in self.SCOPES}
+        for row in cur.fetchall():
+            if row['scope'] in rules:
+                key = (row['match_value'] or '').lower()
+                rules[row['scope']].setdefault(key, []).append(row)
+        with self._lock:
+            self._rules, self._rules_expire = rules, time.monotonic() + self.ttl
+        return rules
+
+    def _discount_bp(self, rules, name, manufacture, qty, today):
+        """Discount in basis points for one line"""
+        for scope, key in (('product', name), ('manufacturer', manufacture), ('all', '')):
+            matching = [
+                r['percent'] for r in rules.get(scope, {}).get((key or '').lower(), [])
+                if qty >= r['min_qty']
+                and (r['starts_on'] is None or r['starts_on'] <= today)
+                and (r['ends_on'] is None or today <= r['ends_on'])
+            ]
+            if matching:
+                return int(max(matching) * 100)
+        return int(Decimal(str(BILL_DISCOUNT_RATE)) * 100)
+
+    def price(self, lines):
+        """
+        Price cart lines ({'name', 'price', 'quantity', ...}). Returns
+        {'items', 'subtotal', 'discount', 'gst', 'final_amount'} with Decimal amounts;
+        each item gains total_amount, discount, discount_rate, gst, gst_rate, final_amount.
+        """
+        today = datetime.now().date()
+        key = (today, tuple(sorted(
+            (line['name'], str(line['price']), int(line['quantity']), line.get('shelf_rack'))
+            for line in lines
+        )))
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._cache.move_to_end(key)
+                self._stats['hits'] += 1
+                return entry[1]
+            self._stats['misses'] += 1
+
+        priced, complete = self._price(lines, today)
+        # Don't cache a cart priced with fallback rates while the DB is unreachable
+        if complete:
+            with self._lock:
+                self._cache[key] = (time.monotonic() + self.ttl, priced)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return priced
+
+    def _price(self, lines, today):
+        names = list({line['name'] for line in lines})
+        products, rules, complete = {}, {}, False
+        db = get_db_connection() if names else None
+        if db:
+            try:
+                cur = db.cursor(dictionary=True)
+                placeholders = ', '.join(['%s'] * len(names))
+                cur.execute(f"""
+                    SELECT name, MAX(manufacture) AS manufacture, MAX(gst_rate) AS gst_rate
+                    FROM products
+                    WHERE name IN ({placeholders})
+                    GROUP BY name
+                """, names)
+                products = {row['name']: row for row in cur.fetchall()}
+                rules = self._load_rules(cur)
+                complete = True
+            except Exception as e:
+                print(f"⚠️ Pricing fell back to default rates: {e}")
+            finally:
+                db.close()
+
+        default_gst = Decimal(str(GST_DEFAULT_RATE))
+        gst_rates, discount_bp = [], []
+        for line in lines:
+            product = products.get(line['name']) or {}
+            rate = product.get('gst_rate')
+            gst_rates.append(Decimal(str(rate)) if rate is not None else default_gst)
+            discount_bp.append(self._discount_bp(
+                rules, line['name'], product.get('manufacture'), int(line['quantity']), today))
+
+        # One vectorised pass over the cart, all in integer paise / basis points
+        price = np.array([max(to_paise(line['price']), 0) for line in lines], dtype=np.int64)
+        qty = np.array([max(int(line['quantity']), 0) for line in lines], dtype=np.int64)
+        disc = np.array(discount_bp, dtype=np.int64)
+        gst_bp = np.array([int(rate * 100) for rate in gst_rates], dtype=np.int64)
+
+        gross = price * qty
+        discount = (gross * disc + 5000) // 10000      # half-up on non-negative amounts
+        taxable = gross - discount
+        gst = (taxable * gst_bp + 5000) // 10000
+        final = taxable + gst
+
+        items = [
+            {
+                **line,
+                'price': from_paise(price[i]),
+                'total_amount': from_paise(gross[i]),
+                'discount': from_paise(discount[i]),
+                'discount_rate': Decimal(int(disc[i])).scaleb(-2),
+                'gst': from_paise(gst[i]),
+                'gst_rate': gst_rates[i],
+                'final_amount': from_paise(final[i]),
+            }
+            for i, line in enumerate(lines)
+        ]
+        return {
+            'items': items,
+            'subtotal': from_paise(gross.sum()),
+            'discount': from_paise(discount.sum()),
+            'gst': from_paise(gst.sum()),
+            'final_amount': from_paise(final.sum()),
+        }, complete
+
+
+pricing_engine = PricingEngine()
+
+
+class BillingError(Exception):
+    """Raised when a bill cannot be committed (e.g. insufficient stock)"""
+
+
+def gst_lines(items):
+    """
+    Group bill lines by GST rate into ledger amounts (rate as a percentage).
+    CGST takes the rounded half of the tax and SGST the rest, so they always add up.
+    """
+    cents = Decimal('0.01')
+    lines = {}
+    for item in items:
+        if item['quantity'] <= 0:
+            continue
+        rate = Decimal(str(item.get('gst_rate', GST_DEFAULT_RATE))).quantize(cents)
+        line = lines.setdefault(rate, dict.fromkeys(
+            ('gross_amount', 'discount', 'taxable_amount', 'gst', 'total_amount'), Decimal(0)))
+        gross = Decimal(str(item['total_amount'])).quantize(cents, ROUND_HALF_UP)
+        discount = Decimal(str(item['discount'])).quantize(cents, ROUND_HALF_UP)
+        line['gross_amount'] += gross
+        line['discount'] += discount
+        line['taxable_amount'] += gross - discount
+        line['gst'] += Decimal(str(item['gst'])).quantize(cents, ROUND_HALF_UP)
+        line['total_amount'] += Decimal(str(item['final_amount'])).quantize(cents, ROUND_HALF_UP)
+
+    for line in lines.values():
+        line['cgst'] = (line['gst'] / 2).quantize(cents, ROUND_HALF_UP)
+        line['sgst'] = line['gst'] - line['cgst']
+    return lines
+
+def record_gst(cur, bill_id, invoice_no, bill_time, items):
+    """Write a bill's GST ledger lines and add them to gst_daily (inside the bill's transaction)"""
+    lines = gst_lines(items)
+    if not lines:
+        return
+    cur.executemany("""
+        INSERT INTO gst_ledger (
+            bill_id, invoice_no, bill_date, gst_rate, gross_amount, discount,
+            taxable_amount, cgst, sgst, gst, total_amount
+        )
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+    """, [
+        (bill_id, invoice_no, bill_time, rate, l['gross_amount'], l['discount'],
+         l['taxable_amount'], l['cgst'], l['sgst'], l['gst'], l['total_amount'])
+        for rate, l in lines.items()
+    ])
+    cur.executemany("""
+        INSERT INTO gst_daily (
+            day, gst_rate, bill_count, gross_amount, discount,
+            taxable_amount, cgst, sgst, gst, total_amount
+        )
+        VALUES (%s, %s, 1, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            bill_count = bill_count + 1,
+            gross_amount = gross_amount + VALUES(gross_amount),
+            discount = discount + VALUES(discount),
+            taxable_amount = taxable_amount + VALUES(taxable_amount),
+            cgst = cgst + VALUES(cgst),
+            sgst = sgst + VALUES(sgst),
+            gst = gst + VALUES(gst),
+            total_amount = total_amount + VALUES(total_amount)
+    """, [
+        (bill_time.date(), rate, l['gross_amount'], l['discount'],
+         l['taxable_amount'], l['cgst'], l['sgst'], l['gst'], l['total_amount'])
+        for rate, l in lines.items()
+    ])
+
+def commit_bill(customer_name, phone, items, totals, bill_time):
+    """
+    Save a bill in a single transaction: lock and check stock, decrement it
+    across each product's batches in FEFO order, write the header,
+    batch-insert the line items, record the GST ledger and update the daily
+    rollups. Returns the invoice number.
+    """
+    # Merge repeated cart lines so each product is checked and decremented once
+    qty_by_name = {}
+    revenue_by_name = {}
+    for item in items:
+        if item['quantity'] > 0:
+            qty_by_name[item['name']] = qty_by_name.get(item['name'], 0) + item['quantity']
+            revenue_by_name[item['name']] = revenue_by_name.get(item['name'], 0) + item['final_amount']
+    names = list(qty_by_name)
+    if not names:
+        raise BillingError("Cart has no items with a quantity to bill.")
+
+    db = get_db_connection()
+    if not db:
+        raise BillingError("Database unavailable, bill not saved. Please try again.")
+
+    cur = db.cursor()
+    try:
+        # 1. Lock every batch of the cart's products and verify stock for the whole cart at once
+        placeholders = ', '.join(['%s'] * len(names))
+        cur.execute(f"""
+            SELECT id, name, countInStock, expirydate < CURDATE() FROM products
+            WHERE name IN ({placeholders})
+            ORDER BY {FEFO_ORDER}
+            FOR UPDATE
+        """, names)
+        batches = [
+            {'id': row_id, 'name': name, 'stock': max(int(stock or 0), 0), 'expired': bool(expired)}
+            for row_id, name, stock, expired in cur.fetchall()
+        ]
+        takes, short = allocate_fefo(batches, qty_by_name)
+        if short:
+            # Sellable stock is the sum over unexpired batches
+            raise BillingError("Insufficient stock: " + ", ".join(
+                f"{name} ({qty_by_name[name] - short[name]} left)" for name in names if name in short
+            ))
+
+        # 2. Decrement every picked batch in one set-based statement; each gives only what it holds
+        derived = " UNION ALL ".join(["SELECT %s AS id, %s AS qty"] * len(takes))
+        params = [value for batch, take in takes for value in (batch['id'], take)]
+        cur.execute(f"""
+            UPDATE products p
+            JOIN ({derived}) d ON p.id = d.id
+            SET p.countInStock = p.countInStock - d.qty
+            WHERE p.countInStock >= d.qty
+        """, params)
+        if cur.rowcount != len(takes):
+            raise BillingError("Stock changed while billing. Please try again.")
+        refresh_low_stock(cur, names)
+
+        # 3. One header row per bill, line items linked by bill_id
+        total_quantity = sum(qty_by_name.values())
+        cur.execute("""
+            INSERT INTO bill_headers (
+                customer_name, phone, item_count, total_quantity,
+                subtotal, discount, gst, final_amount, bill_date
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, (
+            customer_name,
+            phone,
+            len(items),
+            total_quantity,
+            round(totals['subtotal'], 2),
+            round(totals['discount'], 2),
+            round(totals['gst'], 2),
+            totals['final_amount'],
+            bill_time
+        ))
+        bill_id = cur.lastrowid
+        invoice_no = format_invoice_no(bill_id)
+        cur.execute("UPDATE bill_headers SET invoice_no = %s WHERE id = %s", (invoice_no, bill_id))
+
+        cur.executemany("""
+            INSERT INTO bills (
+                bill_id, customer_name, phone, medicine_name,
+                price, quantity, total_amount,
+                discount, gst, gst_rate, final_amount, bill_date
+            )
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        """, [
+            (
+                bill_id,
+                customer_name,
+                phone,
+                item['name'],
+                item['price'],
+                item['quantity'],
+                item['total_amount'],
+                item['discount'],
+                item['gst'],
+                item.get('gst_rate', GST_DEFAULT_RATE),
+                item['final_amount'],
+                bill_time
+            )
+            for item in items
+        ])
+
+        # 4. Keep the daily rollup in step with the bill
+        cur.execute("""
+            INSERT INTO sales_daily (day, revenue, bill_count, items_sold, discount, gst)
+            VALUES (%s, %s, 1, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                revenue = revenue + VALUES(revenue),
+                bill_count = bill_count + 1,
+                items_sold = items_sold + VALUES(items_sold),
+                discount = discount + VALUES(discount),
+                gst = gst + VALUES(gst)
+        """, (
+            bill_time.date(),
+            totals['final_amount'],
+            total_quantity,
+            round(totals['discount'], 2),
+            round(totals['gst'], 2)
+        ))
+
+        # 5. Per-product daily sales feed the reorder engine and the top-sellers widgets
+        cur.executemany("""
+            INSERT INTO product_sales_daily (product_name, day, quantity, revenue)
+            VALUES (%s, %s, %s, %s)
+            ON DUPLICATE KEY UPDATE
+                quantity = quantity + VALUES(quantity),
+                revenue = revenue + VALUES(revenue)
+        """, [
+            (name, bill_time.date(), qty, round(revenue_by_name[name], 2))
+            for name, qty in qty_by_name.items()
+        ])
+
+        # 6. One GST ledger line per tax rate on the bill, plus the daily tax totals
+        record_gst(cur, bill_id, invoice_no, bill_time, items)
+
+        # 7. The customer's profile counters
+        record_customer_visit(cur, customer_name, phone, qty_by_name, bill_time)
+
+        db.commit()
+    except BillingError:
+        db.rollback()
+        raise
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Billing Error: {e}")
+        raise BillingError("Could not save the bill. Please try again.")
+    finally:
+        db.close()
+
+    invalidate_dashboard('billing')
+    on_catalog_changed(names)
+    catalog_index.record_sales(qty_by_name)
+    schedule_reorder_update(names)
+    print(f"✅ Saved bill {invoice_no} ({len(items)} items).")
+    return invoice_no
 
 @app.route('/billing', methods=['GET', 'POST'])
 def billing():
     if session.get('role') != 'staff':
         return redirect(url_for('login_page'))
 
-    cart = session.get('cart', [])
+    cart = cart_items(get_cart())
     if not cart:
         return redirect(url_for('staff'))
 
     # ===============================
     # PER-ITEM BILL CALCULATIONS
     # ===============================
-    subtotal = 0
-    total_discount = 0
-    total_gst = 0
-
-    gst_rate = 0.05      # 5% GST
-    discount_rate = 0.08 # 8% Discount
-
-    calculated_items = []
-
-    for item in cart:
-        item_total = round(item['price'] * item['quantity'], 2)
-        item_discount = round(item_total * discount_rate, 2)
-        taxable_item = item_total - item_discount
-        item_gst = round(taxable_item * gst_rate, 2)
-        item_final = round(taxable_item + item_gst, 2)
-
-        subtotal += item_total
-        total_discount += item_discount
-        total_gst += item_gst
-
-        calculated_items.append({
-            **item,
-            'total_amount': item_total,
-            'discount': item_discount,
-            'gst': item_gst,
-            'final_amount': item_final
-        })
+    # Exact per-product GST slabs and discount rules; cached until the cart changes
+    priced = pricing_engine.price(cart)
+    calculated_items = priced['items']
+    subtotal = priced['subtotal']
+    total_discount = priced['discount']
+    total_gst = priced['gst']
+    final_amount = priced['final_amount']
 
-    taxable_amount = subtotal - total_discount
-    final_amount = round(taxable_amount + total_gst, 2)
+    # Which racks to pick from, earliest expiry first
+    fefo_picks = get_fefo_picks({item['name']: item['quantity'] for item in cart})
 
     # ===============================
     # SAVE BILL
@@ -806,7 +3398,28 @@ def billing():
         phone = request.form['phone']
         bill_time = datetime.now()
 
-        session['last_bill'] = {
+        try:
+            invoice_no = commit_bill(customer_name, phone, calculated_items, {
+                'subtotal': subtotal,
+                'discount': total_discount,
+                'gst': total_gst,
+                'final_amount': final_amount
+            }, bill_time)
+        except BillingError as e:
+            # Nothing was written; keep the cart so staff can adjust it
+            return render_template(
+                'billing.html',
+                cart=calculated_items,
+                subtotal=subtotal,
+                discount=total_discount,
+                gst=total_gst,
+                final_amount=final_amount,
+                fefo_picks=fefo_picks,
+                error=str(e)
+            )
+
+        session['last_bill'] = money_to_float({
+            'invoice_id': invoice_no,
             'customer_name': customer_name,
             'phone': phone,
             'items': calculated_items,
@@ -815,36 +3428,9 @@ def billing():
             'gst': total_gst,
             'final_amount': final_amount,
             'date': bill_time.strftime('%Y-%m-%d %H:%M:%S')
-        }
-
-        db = get_db_connection()
-        if db:
-            cur = db.cursor()
-            for item in calculated_items:
-                cur.execute("""
-                    INSERT INTO bills (
-                        customer_name, phone, medicine_name,
-                        price, quantity, total_amount,
-                        discount, gst, final_amount, bill_date
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                """, (
-                    customer_name,
-                    phone,
-                    item['name'],
-                    item['price'],
-                    item['quantity'],
-                    item['total_amount'],
-                    item['discount'],
-                    item['gst'],
-                    item['final_amount'],
-                    bill_time
-                ))
-            db.commit()
-            db.close()
+        })
 
-        session['cart'] = []
-        session.modified = True
+        save_cart({})
         return redirect(url_for('invoice'))
 
     return render_template(
@@ -853,7 +3439,8 @@ def billing():
         subtotal=subtotal,
         discount=total_discount,
         gst=total_gst,
-        final_amount=final_amount
+        final_amount=final_amount,
+        fefo_picks=fefo_picks
     )
 
 
@@ -876,7 +3463,7 @@ def customer_to_cart():
     if session.get('role') != 'staff':
         return redirect(url_for('login_page'))
     
-    cart = session.get('cart', [])
+    cart = get_cart()
     name = request.form.get('medicine_name')
     
     # Fetch price from DB
@@ -890,14 +3477,8 @@ def customer_to_cart():
             price = float(row[0])
         db.close()
 
-    cart.append({
-        'name': name,
-        'price': price,
-        'quantity': int(request.form.get('quantity', 1)),
-        'shelf_rack': 'From History'
-    })
-    session['cart'] = cart
-    session.modified = True
+    add_cart_item(cart, name, price, int(request.form.get('quantity', 1)), 'From History')
+    save_cart(cart)
     return redirect(url_for('cart'))
 
 
@@ -907,19 +3488,59 @@ def low_stock_page():
     if 'role' not in session:
         return redirect(url_for('login_page'))
     
-    # Threshold is set to 15 in get_low_stock_medicines()
-    low_stock = get_low_stock_medicines(limit=15)
-    return render_template('low_stock.html', low_stock_medicines=low_stock)
+    # Per-product reorder points come from reorder_plan (default 15 without sales history)
+    low_stock = get_low_stock_medicines()
+    return render_template('low_stock.html', low_stock_medicines=low_stock, lead_time=REORDER_LEAD_TIME_DAYS)
+
+@app.route('/expiry_alerts')
+def expiry_alerts():
+    """Medicines expiring within N days, and expired stock awaiting write-off"""
+    if session.get('role') not in ['owner', 'staff']:
+        return redirect(url_for('login_page'))
+
+    days = min(max(request.args.get('days', EXPIRY_ALERT_DAYS, type=int), 1), 365)
+    return render_template(
+        'expiry_alerts.html',
+        days=days,
+        expiring=get_expiring_medicines(days),
+        expired=get_expired_medicines(),
+        message=session.pop('expiry_message', ''),
+    )
+
+@app.route('/api/expiring')
+def api_expiring():
+    """Medicines expiring within ?days=N (JSON)"""
+    if session.get('role') not in ['owner', 'staff']:
+        return redirect(url_for('login_page'))
+
+    days = min(max(request.args.get('days', EXPIRY_ALERT_DAYS, type=int), 1), 365)
+    limit = min(max(request.args.get('limit', EXPIRY_PANEL_LIMIT, type=int), 1), EXPIRY_PANEL_LIMIT)
+    items = [
+        dict(item, expirydate=item['expirydate'].isoformat() if item['expirydate'] else None)
+        for item in get_expiring_medicines(days, limit)
+    ]
+    return jsonify({'days': days, 'count': len(items), 'items': items})
+
+@app.route('/write_off_expired', methods=['POST'])
+def write_off_expired_route():
+    """Write off the selected (or all) expired stock"""
+    if session.get('role') != 'owner':
+        return redirect(url_for('login_page'))
+
+    selected = [int(pid) for pid in request.form.getlist('selected_ids') if pid.isdigit()]
+    if request.form.get('all') == '1':
+        units = write_off_expired()
+    else:
+        units = write_off_expired(selected)
+    session['expiry_message'] = f"Wrote off {units} expired units." if units else "Nothing was written off."
+    return redirect(url_for('expiry_alerts'))
 
 @app.route('/track_orders')
 def track_orders():
     if session.get('role') not in ['owner', 'staff']:
         return redirect(url_for('login_page'))
 
-    # ✅ CALL THE NEW FUNCTION HERE
-    cleanup_old_orders()
-
-    # Now fetch the remaining orders
+    # Old orders are cleaned up by the background scheduler, not on page views
     orders = get_recent_orders(20)
     return render_template('track_orders.html', orders=orders)
 
@@ -936,10 +3557,441 @@ def company_details(company):
         medicines=medicines
     )
          
+# --- Catalog import pipeline ---
+PRODUCT_INSERT_SQL = """
+    INSERT INTO products (
+        name, price, manufacture, type, packSize,
+        substitute0, substitute1, use0, use1,
+        countInStock, expirydate, shelf_rack_no
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+import_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='catalog-import')
+
+# Job state lives in MySQL so any worker process can answer status/report requests
+IMPORT_JOB_COUNTERS = ('bytes_read', 'rows_read', 'inserted', 'updated', 'unchanged', 'retired', 'rejected')
+
+def save_import_job(job, with_rejects=False):
+    """Write an import job's state to import_jobs (rejected rows only when asked, i.e. once at the end)"""
+    db = get_db_connection()
+    if not db:
+        print(f"⚠️ Import {job['id']}: could not save job state (database unavailable)")
+        return
+    try:
+        cur = db.cursor()
+        cur.execute(f"""
+            INSERT INTO import_jobs (
+                id, filename, mode, match_key, status, created, started, finished, bytes_total,
+                {', '.join(IMPORT_JOB_COUNTERS)}, notes, error, rejects
+            )
+            VALUES ({', '.join(['%s'] * (12 + len(IMPORT_JOB_COUNTERS)))})
+            ON DUPLICATE KEY UPDATE
+                status = VALUES(status),
+                started = VALUES(started),
+                finished = VALUES(finished),
+                {', '.join(f'{c} = VALUES({c})' for c in IMPORT_JOB_COUNTERS)},
+                notes = VALUES(notes),
+                error = VALUES(error),
+                rejects = COALESCE(VALUES(rejects), rejects)
+        """, (
+            job['id'], job['filename'], job['mode'], job['key'], job['status'],
+            job['created'], job['started'], job['finished'], job['bytes_total'],
+            *(job[c] for c in IMPORT_JOB_COUNTERS),
+            json.dumps(job['notes']),
+            (job['error'] or '')[:500] or None,
+            json.dumps(job['rejects']) if with_rejects else None
+        ))
+        db.commit()
+    except Exception as e:
+        print(f"⚠️ Import Job Save Error: {e}")
+    finally:
+        db.close()
+
+def load_import_job(job_id):
+    """An import job's state from import_jobs (or None)"""
+    db = get_db_connection()
+    if not db:
+        return None
+    try:
+        cur = db.cursor(dictionary=True)
+        cur.execute("SELECT * FROM import_jobs WHERE id = %s", (job_id,))
+        job = cur.fetchone()
+    finally:
+        db.close()
+    if job:
+        job['key'] = job.pop('match_key')
+        job['notes'] = json.loads(job['notes'] or '[]')
+        job['rejects'] = json.loads(job['rejects'] or '[]')
+    return job
+
+def prune_import_jobs(keep=IMPORT_JOB_HISTORY):
+    """Forget all but the newest `keep` finished import jobs"""
+    db = get_db_connection()
+    if not db:
+        return
+    try:
+        cur = db.cursor()
+        cur.execute("""
+            DELETE FROM import_jobs
+            WHERE status IN ('done', 'failed')
+              AND id NOT IN (
+                  SELECT id FROM (
+                      SELECT id FROM import_jobs
+                      WHERE status IN ('done', 'failed')
+                      ORDER BY created DESC
+                      LIMIT %s
+                  ) newest
+              )
+        """, (keep,))
+        db.commit()
+    except Exception as e:
+        print(f"⚠️ Import Job Prune Error: {e}")
+    finally:
+        db.close()
+
+def parse_catalog_row(row):
+    """Validate one CSV row; returns the products INSERT values or raises ValueError(reason)"""
+    name = (row.get('name') or '').strip()
+    if not name:
+        raise ValueError("missing name")
+
+    price_raw = (row.get('price') or '').strip()
+    try:
+        price = float(price_raw)
+    except ValueError:
+        raise ValueError(f"bad price '{price_raw}'")
+    if price < 0:
+        raise ValueError(f"bad price '{price_raw}'")
+
+    stock_raw = (row.get('countInStock') or '').strip()
+    try:
+        stock = int(float(stock_raw)) if stock_raw else 0
+    except ValueError:
+        raise ValueError(f"bad countInStock '{stock_raw}'")
+    if stock < 0:
+        raise ValueError(f"bad countInStock '{stock_raw}'")
+
+    expiry_raw = (row.get('expirydate') or '').strip()
+    expiry = None
+    if expiry_raw:
+        for fmt in IMPORT_DATE_FORMATS:
+            try:
+                expiry = datetime.strptime(expiry_raw, fmt).date()
+                break
+            except ValueError:
+                continue
+        else:
+            raise ValueError(f"bad expirydate '{expiry_raw}'")
+
+    return (
+        name,
+        price,
+        row.get('Manufacture'),
+        row.get('Type'),
+        row.get('PackSize'),
+        row.get('Substitute0'),
+        row.get('Substitute1'),
+        row.get('Use0'),
+        row.get('Use1'),
+        stock,
+        expiry,
+        row.get('Shelf/Rack No')
+    )
+
+PRODUCT_INSERT_WITH_ID_SQL = """
+    INSERT INTO products (
+        id, name, price, manufacture, type, packSize,
+        substitute0, substitute1, use0, use1,
+        countInStock, expirydate, shelf_rack_no
+    ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+PRODUCT_MERGE_UPDATE_SQL = """
+    UPDATE products
+    SET price = %s, countInStock = %s, expirydate = %s, shelf_rack_no = %s
+    WHERE id = %s
+"""
+
+# Import modes offered on the owner page
+IMPORT_MODES = ('insert', 'merge', 'sync')   # sync = merge + zero the stock of products missing from the file
+IMPORT_KEYS = ('name', 'id')                 # name = name + manufacturer, id = leading id column
+
+def _reject(job, line_no, name, reason):
+    job['rejected'] += 1
+    if len(job['rejects']) < IMPORT_MAX_REJECTS:
+        job['rejects'].append({'line': line_no, 'name': name, 'reason': reason})
+
+def _same_value(old, new):
+    """Compare a DB value with a parsed CSV value (DB may hand back str/Decimal/date)"""
+    if old is None or new is None:
+        return old == new
+    if isinstance(new, (int, float)):
+        try:
+            return abs(float(old) - float(new)) < 0.005
+        except (TypeError, ValueError):
+            return False
+    return str(old).strip() == str(new).strip()
+
+def _product_key(job, product_id, name, manufacture):
+    # Case-insensitive like the name IN (...) lookup, so 'dolo 650' matches 'Dolo 650'
+    return product_id if job['key'] == 'id' else ((name or '').lower(), (manufacture or '').lower())
+
+def _diff_import_chunk(cur, job, chunk):
+    """
+    Split a chunk into inserts and updates with one SELECT of the existing rows.
+    A product stocked in several batches is replaced by the file's row: its
+    newest batch (last in FEFO order) takes the row's values and the older
+    batches are emptied, so the file's count is the product's total stock.
+    Returns (inserts, updates, emptied_ids, matched_ids), matched_ids holding
+    every batch of every matched product; unchanged rows appear only there.
+    """
+    # Last occurrence wins when the file repeats a key inside the chunk
+    latest = {}
+    for line_no, product_id, values in chunk:
+        latest[_product_key(job, product_id, values[0], values[2])] = (line_no, product_id, values)
+
+    if job['key'] == 'id':
+        lookup_col, lookup_vals = 'id', list({key for key in latest})
+    else:
+        lookup_col, lookup_vals = 'name', list({key[0] for key in latest})
+
+    batches = {}
+    placeholders = ', '.join(['%s'] * len(lookup_vals))
+    cur.execute(f"""
+        SELECT id, name, manufacture, price, countInStock, expirydate, shelf_rack_no
+        FROM products WHERE {lookup_col} IN ({placeholders})
+        ORDER BY {FEFO_ORDER}
+    """, lookup_vals)
+    for row in cur.fetchall():
+        batches.setdefault(_product_key(job, row[0], row[1], row[2]), []).append(row)
+
+    inserts, updates, emptied_ids, matched_ids = [], [], [], []
+    for key, (line_no, product_id, values) in latest.items():
+        rows = batches.get(key)
+        if not rows:
+            inserts.append((line_no, product_id, values))
+            continue
+        matched_ids += [row[0] for row in rows]
+        row, older = rows[-1], rows[:-1]
+        emptied = [old[0] for old in older if old[4]]
+        emptied_ids += emptied
+        new_fields = (values[1], values[9], values[10], values[11])   # price, stock, expiry, shelf
+        if emptied or not all(_same_value(old, new) for old, new in zip(row[3:7], new_fields)):
+            updates.append((line_no, values[0], new_fields + (row[0],)))
+        else:
+            job['unchanged'] += 1
+    return inserts, updates, emptied_ids, matched_ids
+
+def _insert_params(job, product_id, values):
+    return (product_id,) + values if job['key'] == 'id' and product_id is not None else values
+
+def _empty_batches(cur, ids):
+    """Zero older batches folded into an imported row, logging what they held in stock_writeoffs"""
+    if not ids:
+        return
+    placeholders = ', '.join(['%s'] * len(ids))
+    cur.execute(f"""
+        INSERT INTO stock_writeoffs
+            (product_id, product_name, quantity, expirydate, reason, written_off_at)
+        SELECT id, name, countInStock, expirydate, 'import-merge', %s
+        FROM products
+        WHERE id IN ({placeholders}) AND countInStock <> 0
+    """, [datetime.now(), *ids])
+    cur.execute(f"UPDATE products SET countInStock = 0 WHERE id IN ({placeholders})", ids)
+
+def _apply_import_ops(db, cur, job, inserts, updates, emptied_ids=()):
+    """Apply a chunk's inserts/updates in one batch; on failure retry row by row to isolate bad rows"""
+    plain = [v for _, pid, v in inserts if job['key'] != 'id' or pid is None]
+    with_id = [_insert_params(job, pid, v) for _, pid, v in inserts if job['key'] == 'id' and pid is not None]
+    try:
+        if plain:
+            cur.executemany(PRODUCT_INSERT_SQL, plain)
+        if with_id:
+            cur.executemany(PRODUCT_INSERT_WITH_ID_SQL, with_id)
+        if updates:
+            cur.executemany(PRODUCT_MERGE_UPDATE_SQL, [params for _, _, params in updates])
+        _empty_batches(cur, list(emptied_ids))
+        db.commit()
+        job['inserted'] += len(inserts)
+        job['updated'] += len(updates)
+        return
+    except mysql.connector.Error:
+        db.rollback()
+
+    for line_no, product_id, values in inserts:
+        try:
+            params = _insert_params(job, product_id, values)
+            cur.execute(PRODUCT_INSERT_WITH_ID_SQL if len(params) == 13 else PRODUCT_INSERT_SQL, params)
+            job['inserted'] += 1
+        except mysql.connector.Error as e:
+            _reject(job, line_no, values[0], f"database rejected row: {e.msg}")
+    for line_no, name, params in updates:
+        try:
+            cur.execute(PRODUCT_MERGE_UPDATE_SQL, params)
+            job['updated'] += 1
+        except mysql.connector.Error as e:
+            _reject(job, line_no, name, f"database rejected update: {e.msg}")
+    _empty_batches(cur, list(emptied_ids))
+    db.commit()
+
+def _flush_import_chunk(db, cur, job, chunk):
+    if job['mode'] == 'insert':
+        _apply_import_ops(db, cur, job, chunk, [])
+        return
+
+    inserts, updates, emptied_ids, matched_ids = _diff_import_chunk(cur, job, chunk)
+    # Every batch of a product in the file counts as seen, not just the one it updated
+    seen = matched_ids + [pid for _, pid, _ in inserts if pid is not None]
+    if job['mode'] == 'sync' and seen:
+        cur.executemany("INSERT IGNORE INTO import_seen (id) VALUES (%s)", [(i,) for i in seen])
+    _apply_import_ops(db, cur, job, inserts, updates, emptied_ids)
+
+def _retire_missing_products(db, cur, job, max_existing_id):
+    """
+    Sync mode: zero the stock of pre-existing products the file did not
+    mention. The rows stay, since bills and orders refer to products by
+    name; the stock taken out is logged in stock_writeoffs.
+    """
+    if job['rejected']:
+        # A rejected row may be a product that should stay; never retire on a partial file
+        job['notes'].append("Retire step skipped because some rows were rejected.")
+        return
+    cur.execute("""
+        INSERT INTO stock_writeoffs
+            (product_id, product_name, quantity, expirydate, reason, written_off_at)
+        SELECT p.id, p.name, p.countInStock, p.expirydate, 'import-sync', %s
+        FROM products p
+        LEFT JOIN import_seen s ON s.id = p.id
+        WHERE s.id IS NULL AND p.id <= %s AND p.countInStock > 0
+    """, (datetime.now(), max_existing_id))
+    cur.execute("""
+        UPDATE products p
+        LEFT JOIN import_seen s ON s.id = p.id
+        SET p.countInStock = 0
+        WHERE s.id IS NULL AND p.id <= %s AND p.countInStock > 0
+    """, (max_existing_id,))
+    job['retired'] = cur.rowcount
+    db.commit()
+
+def run_catalog_import(job, filepath):
+    """Stream a spooled CSV into products in chunks, recording progress and rejected rows"""
+    job_id = job['id']
+    job['status'] = 'running'
+    job['started'] = datetime.now()
+    save_import_job(job)
+    db = None
+    try:
+        db = get_db_connection()
+        if not db:
+            raise RuntimeError("database unavailable")
+        cur = db.cursor()
+
+        max_existing_id = 0
+        if job['mode'] == 'sync':
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM products")
+            max_existing_id = cur.fetchone()[0]
+            cur.execute("CREATE TEMPORARY TABLE IF NOT EXISTS import_seen (id INT PRIMARY KEY) ENGINE=MEMORY")
+            cur.execute("TRUNCATE TABLE import_seen")
+
+        with open(filepath, 'r', newline='', encoding='utf-8-sig') as f:
+            reader = csv.DictReader(f)
+            if job['key'] == 'id' and 'id' not in (reader.fieldnames or []):
+                raise ValueError("file has no 'id' column to match on")
+
+            chunk = []
+            for row in reader:
+                job['rows_read'] += 1
+                line_no = reader.line_num
+                try:
+                    values = parse_catalog_row(row)
+                    product_id = None
+                    if job['key'] == 'id':
+                        id_raw = (row.get('id') or '').strip()
+                        try:
+                            product_id = int(id_raw)
+                        except ValueError:
+                            raise ValueError(f"bad id '{id_raw}'")
+                    chunk.append((line_no, product_id, values))
+                except ValueError as e:
+                    _reject(job, line_no, row.get('name'), str(e))
+
+                if len(chunk) >= IMPORT_CHUNK_SIZE:
+                    _flush_import_chunk(db, cur, job, chunk)
+                    chunk = []
+                    job['bytes_read'] = f.buffer.tell()
+                    save_import_job(job)
+            if chunk:
+                _flush_import_chunk(db, cur, job, chunk)
+            job['bytes_read'] = job['bytes_total']
+
+        if job['mode'] == 'sync':
+            _retire_missing_products(db, cur, job, max_existing_id)
+
+        job['status'] = 'done'
+        print(f"✅ Import {job_id}: {job['inserted']} added, {job['updated']} updated, "
+              f"{job['retired']} zeroed, {job['rejected']} rejected.")
+    except Exception as e:
+        job['status'] = 'failed'
+        job['error'] = str(e)
+        print(f"❌ CSV Upload Error: {e}")
+    finally:
+        job['finished'] = datetime.now()
+        save_import_job(job, with_rejects=True)
+        if db:
+            if job['mode'] == 'sync':
+                try:
+                    db.cursor().execute("DROP TEMPORARY TABLE IF EXISTS import_seen")
+                except Exception:
+                    pass
+            db.close()
+        if job['inserted'] or job['updated'] or job['retired']:
+            invalidate_dashboard('catalog')
+            # Still on the import worker, so the rebuild doesn't hold up a request
+            on_catalog_changed()
+            rebuild_low_stock()
+            catalog_index.rebuild()
+        try:
+            os.remove(filepath)
+        except OSError as e:
+            print(f"⚠️ Cleanup Warning: {e}")
+
+def start_catalog_import(file_storage, mode='insert', key='name'):
+    """Spool the upload to a private temp file and queue it for background import"""
+    fd, filepath = tempfile.mkstemp(prefix='catalog_', suffix='.csv')
+    with os.fdopen(fd, 'wb') as out:
+        shutil.copyfileobj(file_storage.stream, out, 1024 * 1024)
+
+    job_id = uuid.uuid4().hex[:12]
+    job = {
+        'id': job_id,
+        'filename': file_storage.filename,
+        'mode': mode,
+        'key': key,
+        'status': 'queued',
+        'created': datetime.now(),
+        'started': None,
+        'finished': None,
+        'bytes_total': os.path.getsize(filepath),
+        'bytes_read': 0,
+        'rows_read': 0,
+        'inserted': 0,
+        'updated': 0,
+        'unchanged': 0,
+        'retired': 0,
+        'rejected': 0,
+        'rejects': [],
+        'notes': [],
+        'error': None,
+    }
+    prune_import_jobs(IMPORT_JOB_HISTORY - 1)
+    save_import_job(job)
+    import_executor.submit(run_catalog_import, job, filepath)
+    return job_id
+
 @app.route('/upload_csv', methods=['POST'])
 def upload_csv():
-    """Upload CSV and insert medicines into Database (Windows Safe Version)"""
-    
+    """Upload CSV and queue it for a chunked background import into the Database"""
+
     # 1. Security & File Checks
     if session.get('role') != 'owner':
         return redirect(url_for('login_page'))
@@ -947,201 +3999,392 @@ def upload_csv():
     if 'file' not in request.files:
         return redirect(url_for('owner'))
 
-    file = request.files['file']
-    
-    if file.filename == '':
+    file = request.files['file']
+
+    if file.filename == '':
+        return redirect(url_for('owner'))
+
+    mode = request.form.get('mode', 'insert')
+    key = request.form.get('key', 'name')
+    if mode not in IMPORT_MODES or key not in IMPORT_KEYS:
+        return redirect(url_for('owner'))
+    if mode == 'sync' and request.form.get('confirm_sync') != 'yes':
+        session['import_message'] = "Sync not started: tick the box to confirm that products missing from the file should be set to zero stock."
         return redirect(url_for('owner'))
 
-    if file:
-        # Use absolute path to ensure we know exactly where the file is
-        filepath = os.path.abspath("temp_upload.csv")
-        file.save(filepath)
+    # 2. Hand off to the import worker; the owner page polls its progress
+    session['import_job'] = start_catalog_import(file, mode, key)
+    return redirect(url_for('owner'))
 
-        db = None
-        try:
-            db = get_db_connection()
-            if not db:
-                return "Database Error", 500
+@app.route('/upload_csv/status/<job_id>')
+def upload_csv_status(job_id):
+    """Progress of a catalog import (JSON)"""
+    if session.get('role') != 'owner':
+        return redirect(url_for('login_page'))
 
-            cur = db.cursor()
-            count = 0
+    job = load_import_job(job_id)
+    if not job:
+        return jsonify({'error': 'unknown import job'}), 404
+
+    total = job['bytes_total'] or 1
+    return jsonify({
+        'id': job['id'],
+        'filename': job['filename'],
+        'mode': job['mode'],
+        'status': job['status'],
+        'progress': round(100 * job['bytes_read'] / total, 1),
+        'rows_read': job['rows_read'],
+        'inserted': job['inserted'],
+        'updated': job['updated'],
+        'unchanged': job['unchanged'],
+        'retired': job['retired'],
+        'rejected': job['rejected'],
+        'notes': job['notes'],
+        'error': job['error'],
+        # Rejected rows are saved with the final state
+        'report_url': (url_for('upload_csv_report', job_id=job_id)
+                       if job['rejected'] and job['status'] in ('done', 'failed') else None)
+    })
 
-            # ✅ FIX: The 'with' block ensures 'f' is closed automatically
-            # once the indentation ends.
-            with open(filepath, 'r', encoding='utf-8') as f:
-                reader = csv.DictReader(f)
-                
-                for row in reader:
-                    # --- Date Formatting Logic ---
-                    expiry_str = row.get('expirydate', '')
-                    formatted_date = None
-                    if expiry_str:
-                        try:
-                            d = datetime.strptime(expiry_str, '%m/%d/%Y')
-                            formatted_date = d.strftime('%Y-%m-%d')
-                        except ValueError:
-                            formatted_date = datetime.now().strftime('%Y-%m-%d')
-
-                    # --- Database Insertion ---
-                    cur.execute("""
-                        INSERT INTO products (
-                            name, price, manufacture, type, packSize, 
-                            substitute0, substitute1, use0, use1, 
-                            countInStock, expirydate, shelf_rack_no
-                        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """, (
-                        row.get('name'),
-                        row.get('price'),
-                        row.get('Manufacture'),
-                        row.get('Type'),
-                        row.get('PackSize'),
-                        row.get('Substitute0'),
-                        row.get('Substitute1'),
-                        row.get('Use0'),
-                        row.get('Use1'),
-                        row.get('countInStock'),
-                        formatted_date,
-                        row.get('Shelf/Rack No')
-                    ))
-                    count += 1
-
-            # End of 'with' block -> File is now CLOSED.
-            
-            db.commit()
-            print(f"✅ Successfully added {count} medicines.")
-            
-        except Exception as e:
-            print(f"❌ CSV Upload Error: {e}")
-            
-        finally:
-            # 2. Cleanup Database Connection
-            if db and db.is_connected():
-                db.close()
-            
-            # 3. Cleanup File (Safe Delete)
-            # The file is definitely closed now because we are outside the 'with' block.
-            try:
-                if os.path.exists(filepath):
-                    os.remove(filepath)
-                    print(f"🗑️ Cleaned up temp file: {filepath}")
-            except PermissionError:
-                print("⚠️ Warning: File is still locked by Windows. Will be deleted next time.")
-            except Exception as e:
-                print(f"⚠️ Cleanup Warning: {e}")
+@app.route('/upload_csv/report/<job_id>')
+def upload_csv_report(job_id):
+    """Download the rejected rows of a catalog import as CSV"""
+    if session.get('role') != 'owner':
+        return redirect(url_for('login_page'))
 
-    return redirect(url_for('owner'))
+    job = load_import_job(job_id)
+    if not job:
+        return "Unknown import job", 404
+
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=['line', 'name', 'reason'])
+    writer.writeheader()
+    writer.writerows(job['rejects'])
+    return out.getvalue(), 200, {
+        'Content-Type': 'text/csv',
+        'Content-Disposition': f'attachment; filename=import_{job_id}_rejections.csv'
+    }
 
 # ========================================
 # 7. ROUTES - OWNER DASHBOARD
 # ========================================
+EMPTY_CHART = {"labels": [], "data": []}
+
+# Owner dashboard widgets: name -> (func, args, default); also served one by one as JSON
+OWNER_WIDGETS = {
+    'total_sales': (get_total_sales, (), 0),
+    'daily_sales': (get_daily_sales, (), []),
+    'sales_chart_data': (get_sales_chart_data, (15,), EMPTY_CHART),
+    'top_medicines_chart': (get_top_medicines_chart, (), EMPTY_CHART),
+    'monthly_sales_chart': (get_monthly_sales_chart, (12,), EMPTY_CHART),
+    'company_stock_chart': (get_company_stock_chart, (), EMPTY_CHART),
+    'low_stock_count': (get_low_stock_count, (), 0),
+    'expiry_counts': (get_expiry_counts, (), {'expired': 0, 'expiring': 0}),
+    'billing_history': (get_recent_bills, (15,), []),
+    'customers': (get_customers, (), []),
+    'top_selling': (get_top_selling_medicines, (5,), []),
+    'recent_orders': (get_recent_orders, (5,), []),
+}
+
 @app.route('/owner')
 def owner():
     """Owner analytics dashboard"""
     if session.get('role') != 'owner':
         return redirect(url_for('login_page'))
     
+    widgets = fetch_widgets(OWNER_WIDGETS)
+
     return render_template(
         "Owner.html",
-        total_sales=get_total_sales(),
-        daily_sales=get_daily_sales(),
-        sales_chart_data=get_sales_chart_data(15),
-        top_medicines_chart=get_top_medicines_chart(),
-        monthly_sales_chart=get_monthly_sales_chart(months=12),
-        company_stock_chart=get_company_stock_chart(),
-        low_stock_medicines=get_low_stock_medicines(15),
-        billing_history=get_recent_bills(15),
-        customers=get_customers(),
-        top_selling=get_top_selling_medicines(5),
         staff_members=get_staff_members(),
-        recent_orders=get_recent_orders(5),
+        import_job=session.get('import_job'),
+        import_message=session.pop('import_message', ''),
+        poll_interval=DASHBOARD_POLL_INTERVAL,
+        **widgets
     )
 
-@app.route('/gst_summary')
-def gst_summary():
+@app.route('/api/owner/<widget>')
+def owner_widget_api(widget):
+    """
+    One dashboard widget as JSON, with a strong ETag so the page can poll cheaply.
+    An unchanged widget answers 304 from the cached fingerprint without re-serializing.
+    """
     if session.get('role') != 'owner':
         return redirect(url_for('login_page'))
+    if widget not in OWNER_WIDGETS:
+        return jsonify({'error': f'Unknown widget: {widget}'}), 404
+
+    func, args, _ = OWNER_WIDGETS[widget]
+    value = fetch_widgets({widget: OWNER_WIDGETS[widget]})[widget]
+    # Cached widgets carry the ETag computed when they were stored
+    etag = dashboard_cache.etag((func.widget, args, ())) or widget_etag(value)
+
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(value)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+@app.route('/owner/db_stats')
+def db_stats():
+    """Connection pool, dashboard cache and widget timing statistics (JSON)"""
+    if session.get('role') != 'owner':
+        return redirect(url_for('login_page'))
+    return jsonify({
+        'pool': get_pool_stats(),
+        'dashboard_cache': dashboard_cache.stats(),
+        'widgets': widget_timings.stats(),
+        'catalog_index': catalog_index.stats(),
+        'search_results': search_results.stats(),
+        'pricing': pricing_engine.stats(),
+        'scheduler': scheduler.stats()
+    })
 
+def gst_period(args, today=None):
+    """
+    (start, end, label) of the filing period in the query string: ?period=YYYY-MM
+    for a month, ?period=YYYY-Qn for a financial-year quarter (Q1 = April-June of
+    YYYY) or ?from=&to= for a custom range. Defaults to the current month.
+    """
+    today = today or datetime.now().date()
+    period = (args.get('period') or '').strip().upper()
+
+    match = re.fullmatch(r'(\d{4})-Q([1-4])', period)
+    if match:
+        year, quarter = int(match.group(1)), int(match.group(2))
+        first = year * 12 + 3 + (quarter - 1) * 3     # month index of April + offset
+        start = date(first // 12, first % 12 + 1, 1)
+        after = date((first + 3) // 12, (first + 3) % 12 + 1, 1)
+        return start, after - timedelta(days=1), f"Q{quarter} FY {year}-{(year + 1) % 100:02d}"
+
+    match = re.fullmatch(r'(\d{4})-(\d{2})', period)
+    if match and 1 <= int(match.group(2)) <= 12:
+        start = date(int(match.group(1)), int(match.group(2)), 1)
+    else:
+        start, end = parse_date_arg(args.get('from')), parse_date_arg(args.get('to'))
+        if start and end and start <= end:
+            return start, end, f"{start:%d %b %Y} - {end:%d %b %Y}"
+        start = today.replace(day=1)
+    index = start.year * 12 + start.month
+    end = date(index // 12, index % 12 + 1, 1) - timedelta(days=1)
+    return start, end, f"{start:%B %Y}"
+
+def get_gst_summary(start, end):
+    """Per-rate GST totals for a date range, summed from the gst_daily rollup"""
     db = get_db_connection()
-    cur = db.cursor()
-
+    if not db:
+        return []
+    cur = db.cursor(dictionary=True)
     cur.execute("""
-        SELECT 
-            SUM(bill_subtotal) as total_sales,
-            SUM(bill_discount) as total_discount,
-            SUM(bill_gst) as total_gst,
-            SUM(bill_final) as net_revenue
-        FROM (
-            SELECT 
-                MAX(total_amount) as bill_subtotal,
-                MAX(discount) as bill_discount,
-                MAX(gst) as bill_gst,
-                MAX(final_amount) as bill_final
-            FROM bills
-            GROUP BY customer_name, phone, bill_date
-        ) AS unique_bills
-    """)
-
-    row = cur.fetchone()
+        SELECT
+            gst_rate,
+            SUM(bill_count) AS bill_count,
+            SUM(gross_amount) AS gross_amount,
+            SUM(discount) AS discount,
+            SUM(taxable_amount) AS taxable_amount,
+            SUM(cgst) AS cgst,
+            SUM(sgst) AS sgst,
+            SUM(gst) AS gst,
+            SUM(total_amount) AS total_amount
+        FROM gst_daily
+        WHERE day BETWEEN %s AND %s
+        GROUP BY gst_rate
+        ORDER BY gst_rate
+    """, (start, end))
+    # Floats keep the template arithmetic simple
+    rows = [{k: (v if k == 'bill_count' else float(v or 0)) for k, v in row.items()}
+            for row in cur.fetchall()]
     db.close()
+    return rows
 
-    # ✅ FIX: Convert all Decimal values to float immediately
-    # This prevents the "Decimal vs Float" math error in the HTML template
-    total_sales = float(row[0] or 0)
-    total_discount = float(row[1] or 0)
-    total_gst = float(row[2] or 0)
-    net_revenue = float(row[3] or 0)
-    
-    taxable_amount = total_sales - total_discount
+@app.route('/gst_summary')
+def gst_summary():
+    if session.get('role') != 'owner':
+        return redirect(url_for('login_page'))
+
+    start, end, label = gst_period(request.args)
+    rates = get_gst_summary(start, end)
+
+    # Quick links to the current and previous financial-year quarters
+    today = datetime.now().date()
+    index = today.year * 12 + today.month - 1 - 3     # months since April of year 0
+    quarter_links = []
+    for back in (0, 1):
+        q = index // 3 - back
+        quarter_links.append((f"Q{q % 4 + 1} FY {q // 4}-{(q // 4 + 1) % 100:02d}", f"{q // 4}-Q{q % 4 + 1}"))
+
+    def total(key):
+        return sum(r[key] for r in rates)
 
     return render_template(
         'gst_summary.html',
-        total_sales=total_sales,
-        total_discount=total_discount,
-        taxable_amount=taxable_amount,
-        total_gst=total_gst,
-        net_revenue=net_revenue,
+        rates=rates,
+        period_label=label,
+        quarter_links=quarter_links,
+        start=start,
+        end=end,
+        total_sales=total('gross_amount'),
+        total_discount=total('discount'),
+        taxable_amount=total('taxable_amount'),
+        total_cgst=total('cgst'),
+        total_sgst=total('sgst'),
+        total_gst=total('gst'),
+        net_revenue=total('total_amount'),
         current_date=datetime.now()
     )
 
-def get_all_payments(limit=100):
-    """Fetch unique bill-wise payment details"""
+def iter_gst_ledger(start, end, batch=GST_EXPORT_BATCH):
+    """Yield the GST ledger lines of a date range in (bill_date, id) order, one keyset batch at a time"""
+    after = None
+    while True:
+        db = get_db_connection()
+        if not db:
+            return
+        params = [start, end + timedelta(days=1)]
+        keyset = ""
+        if after:
+            keyset = "AND (bill_date > %s OR (bill_date = %s AND id > %s))"
+            params += [after[0], after[0], after[1]]
+        cur = db.cursor(dictionary=True)
+        cur.execute(f"""
+            SELECT id, invoice_no, bill_id, bill_date, gst_rate, gross_amount, discount,
+                   taxable_amount, cgst, sgst, gst, total_amount
+            FROM gst_ledger
+            WHERE bill_date >= %s AND bill_date < %s {keyset}
+            ORDER BY bill_date, id
+            LIMIT %s
+        """, params + [batch])
+        rows = cur.fetchall()
+        db.close()
+
+        yield from rows
+        if len(rows) < batch:
+            return
+        after = (rows[-1]['bill_date'], rows[-1]['id'])
+
+@app.route('/gst_summary/export')
+def export_gst_ledger():
+    """Stream the period's GST ledger lines as CSV for filing"""
+    if session.get('role') != 'owner':
+        return redirect(url_for('login_page'))
+
+    start, end, _ = gst_period(request.args)
+
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=GST_EXPORT_FIELDS, extrasaction='ignore')
+        writer.writeheader()
+        for i, row in enumerate(iter_gst_ledger(start, end), 1):
+            writer.writerow(row)
+            if i % GST_EXPORT_BATCH == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    return app.response_class(
+        stream_with_context(generate()),
+        mimetype='text/csv',
+        headers={'Content-Disposition': f'attachment; filename=gst_ledger_{start}_to_{end}.csv'}
+    )
+
+def encode_payment_cursor(row):
+    """Opaque keyset position of a bill: its (bill_date, id)"""
+    return f"{row['bill_date']:%Y%m%d%H%M%S}-{row['bill_id']}"
+
+def decode_payment_cursor(token):
+    """(bill_date, id) from a payment cursor, or None if it is missing or malformed"""
+    try:
+        stamp, bill_id = (token or '').split('-')
+        return datetime.strptime(stamp, '%Y%m%d%H%M%S'), int(bill_id)
+    except ValueError:
+        return None
+
+def parse_date_arg(value):
+    """Date from a YYYY-MM-DD query argument, None if blank or invalid"""
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+    except ValueError:
+        return None
+
+def get_payments_page(limit=PAYMENT_PAGE_SIZE, after=None, start=None, end=None, ascending=False):
+    """
+    One keyset page of bill-wise payments ordered on (bill_date, id).
+    after is the (bill_date, id) the previous page ended on, start/end an
+    inclusive date range. Returns (rows, next_position or None).
+    """
     db = get_db_connection()
     if not db:
-        return []
+        return [], None
+
+    conditions, params = [], []
+    if after:
+        op = '>' if ascending else '<'
+        conditions.append(f"(bill_date {op} %s OR (bill_date = %s AND id {op} %s))")
+        params += [after[0], after[0], after[1]]
+    if start:
+        conditions.append("bill_date >= %s")
+        params.append(start)
+    if end:
+        conditions.append("bill_date < %s")
+        params.append(end + timedelta(days=1))
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    direction = 'ASC' if ascending else 'DESC'
 
     cur = db.cursor(dictionary=True)
-    cur.execute("""
-        SELECT 
-            MIN(id) AS bill_id,
+    # One extra row tells us whether another page follows
+    cur.execute(f"""
+        SELECT
+            id AS bill_id,
+            invoice_no,
             customer_name,
             phone,
-            SUM(total_amount) AS total_amount,
-            SUM(discount) AS discount,
-            SUM(gst) AS gst,
-            MAX(final_amount) AS final_amount,
+            subtotal AS total_amount,
+            discount,
+            gst,
+            final_amount,
             bill_date
-        FROM bills
-        GROUP BY customer_name, phone, bill_date
-        ORDER BY bill_date DESC
+        FROM bill_headers
+        {where}
+        ORDER BY bill_date {direction}, id {direction}
         LIMIT %s
-    """, (limit,))
-
-    data = cur.fetchall()
+    """, params + [limit + 1])
+    rows = cur.fetchall()
     db.close()
-    return data
+
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, (rows[-1]['bill_date'], rows[-1]['bill_id'])
+
+def iter_payments(start=None, end=None, batch=PAYMENT_EXPORT_BATCH):
+    """
+    Yield every bill in the date range, oldest first, one keyset batch at a time.
+    Each batch is a short indexed query on its own pooled connection, so memory
+    stays flat and no connection is held while a slow client downloads.
+    """
+    after = None
+    while True:
+        rows, after = get_payments_page(batch, after, start, end, ascending=True)
+        yield from rows
+        if after is None:
+            return
 @app.route('/category/<category>')
 def category_view(category):
     if session.get('role') not in ['owner', 'staff']:
         return redirect(url_for('login_page'))
 
     # Get medicines for this category
-    medicines = get_medicines_by_category(category)
+    medicines, facets = get_medicines_by_category(category)
     
     # Reuse the company_stock.html template
     return render_template(
         'company_stock.html', 
         company=f"Category: {category}", 
-        medicines=medicines
+        medicines=medicines,
+        facets=facets
     )
     
 @app.route('/payment_history')
@@ -1149,28 +4392,414 @@ def payment_history():
     if session.get('role') not in ['owner', 'staff']:
         return redirect(url_for('login_page'))
 
-    payments = get_all_payments(100)
+    start = parse_date_arg(request.args.get('from'))
+    end = parse_date_arg(request.args.get('to'))
+    after = decode_payment_cursor(request.args.get('cursor'))
+    payments, next_position = get_payments_page(PAYMENT_PAGE_SIZE, after, start, end)
 
     return render_template(
         'payment_history.html',
-        payments=payments
+        payments=payments,
+        start=start,
+        end=end,
+        filters={k: v for k, v in (('from', start), ('to', end)) if v},
+        paged=after is not None,
+        next_cursor=encode_payment_cursor(payments[-1]) if next_position else None
+    )
+
+@app.route('/payment_history/export')
+def export_payments():
+    """Stream bills in a date range as CSV (default) or NDJSON (?format=ndjson)"""
+    if session.get('role') not in ['owner', 'staff']:
+        return redirect(url_for('login_page'))
+
+    start = parse_date_arg(request.args.get('from'))
+    end = parse_date_arg(request.args.get('to'))
+    fmt = request.args.get('format', 'csv')
+    if fmt not in ('csv', 'ndjson'):
+        return "Unsupported export format", 400
+
+    def generate_csv():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=PAYMENT_EXPORT_FIELDS)
+        writer.writeheader()
+        for i, row in enumerate(iter_payments(start, end), 1):
+            writer.writerow(row)
+            if i % PAYMENT_EXPORT_BATCH == 0:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    def generate_ndjson():
+        lines = []
+        for row in iter_payments(start, end):
+            lines.append(json.dumps(row, default=str))
+            if len(lines) == PAYMENT_EXPORT_BATCH:
+                yield '\n'.join(lines) + '\n'
+                lines = []
+        if lines:
+            yield '\n'.join(lines) + '\n'
+
+    span = f"{start or 'start'}_to_{end or 'today'}"
+    generate, mimetype = (generate_csv, 'text/csv') if fmt == 'csv' else (generate_ndjson, 'application/x-ndjson')
+    return app.response_class(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename=payments_{span}.{fmt}'}
     )
 
 def get_total_collection():
     db = get_db_connection()
     cur = db.cursor()
-    cur.execute("""
-        SELECT SUM(final_amount)
-        FROM (
-            SELECT MAX(final_amount) AS final_amount
-            FROM bills
-            GROUP BY customer_name, phone, bill_date
-        ) t
-    """)
+    cur.execute("SELECT SUM(final_amount) FROM bill_headers")
     total = cur.fetchone()[0] or 0
     db.close()
     return total
 
+def format_invoice_no(bill_id):
+    """Sequential invoice number derived from the bill header id"""
+    return f"INV-{bill_id:06d}"
+
+def backfill_bill_headers():
+    """
+    One-time migration: build bill_headers from legacy line items that have
+    no bill_id yet (grouped on customer_name, phone, bill_date as before).
+    """
+    db = get_db_connection()
+    if not db:
+        return 0
+
+    cur = db.cursor()
+    try:
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM bill_headers")
+        last_header_id = cur.fetchone()[0]
+
+        cur.execute("""
+            INSERT INTO bill_headers (
+                customer_name, phone, item_count, total_quantity,
+                subtotal, discount, gst, final_amount, bill_date
+            )
+            SELECT customer_name, phone, COUNT(*), SUM(quantity),
+                   SUM(total_amount), SUM(discount), SUM(gst), SUM(final_amount), bill_date
+            FROM bills
+            WHERE bill_id IS NULL
+            GROUP BY customer_name, phone, bill_date
+            ORDER BY bill_date, MIN(id)
+        """)
+        created = cur.rowcount
+
+        cur.execute("""
+            UPDATE bills b
+            JOIN bill_headers h
+              ON h.bill_date = b.bill_date
+             AND h.customer_name <=> b.customer_name
+             AND h.phone <=> b.phone
+            SET b.bill_id = h.id
+            WHERE b.bill_id IS NULL AND h.id > %s
+        """, (last_header_id,))
+
+        cur.execute("""
+            UPDATE bill_headers
+            SET invoice_no = CONCAT('INV-', IF(id < 1000000, LPAD(id, 6, '0'), id))
+            WHERE invoice_no IS NULL
+        """)
+        db.commit()
+        invalidate_dashboard('billing')
+        print(f"✅ Backfilled {created} bill headers.")
+        return created
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Bill Backfill Error: {e}")
+        return 0
+    finally:
+        db.close()
+
+@app.cli.command('backfill-bills')
+def backfill_bills_command():
+    """Create bill headers for legacy line items"""
+    if backfill_bill_headers():
+        rebuild_sales_rollup()
+        rebuild_gst_ledger()
+        if rebuild_product_sales():
+            rebuild_reorder_plan()
+
+def rebuild_sales_rollup(since=None):
+    """Recompute sales_daily from bill_headers (all days, or from `since` onward)"""
+    db = get_db_connection()
+    if not db:
+        return False
+
+    cur = db.cursor()
+    where = "WHERE bill_date >= %s" if since else ""
+    params = (since,) if since else ()
+    try:
+        if since:
+            cur.execute("DELETE FROM sales_daily WHERE day >= %s", params)
+        else:
+            cur.execute("DELETE FROM sales_daily")
+        cur.execute(f"""
+            INSERT INTO sales_daily (day, revenue, bill_count, items_sold, discount, gst)
+            SELECT DATE(bill_date), SUM(final_amount), COUNT(*),
+                   SUM(total_quantity), SUM(discount), SUM(gst)
+            FROM bill_headers
+            {where}
+            GROUP BY DATE(bill_date)
+        """, params)
+        db.commit()
+        invalidate_dashboard('billing')
+        print(f"✅ Rebuilt sales rollup for {cur.rowcount} days.")
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Rollup Rebuild Error: {e}")
+        return False
+    finally:
+        db.close()
+
+@app.cli.command('rebuild-rollups')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Only rebuild days on or after this date (YYYY-MM-DD).')
+def rebuild_rollups_command(since):
+    """Rebuild the daily sales rollup from bill headers"""
+    rebuild_sales_rollup(since.date() if since else None)
+
+def rebuild_product_sales(since=None):
+    """Recompute product_sales_daily from bill line items (all days, or from `since` onward)"""
+    db = get_db_connection()
+    if not db:
+        return False
+
+    cur = db.cursor()
+    where = "WHERE bill_date >= %s" if since else ""
+    params = (since,) if since else ()
+    try:
+        if since:
+            cur.execute("DELETE FROM product_sales_daily WHERE day >= %s", params)
+        else:
+            cur.execute("DELETE FROM product_sales_daily")
+        cur.execute(f"""
+            INSERT INTO product_sales_daily (product_name, day, quantity, revenue)
+            SELECT medicine_name, DATE(bill_date), SUM(quantity), SUM(final_amount)
+            FROM bills
+            {where}
+            GROUP BY medicine_name, DATE(bill_date)
+        """, params)
+        db.commit()
+        invalidate_dashboard('billing')
+        print(f"✅ Rebuilt per-product sales for {cur.rowcount} product-days.")
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Product Sales Rebuild Error: {e}")
+        return False
+    finally:
+        db.close()
+
+def rebuild_gst_ledger(since=None):
+    """
+    Recompute gst_ledger and gst_daily from bill line items (all days, or from
+    `since` onward). Legacy lines carry no rate, so they are booked at GST_DEFAULT_RATE.
+    """
+    db = get_db_connection()
+    if not db:
+        return False
+
+    cur = db.cursor()
+    ledger_where = "WHERE h.bill_date >= %s" if since else ""
+    daily_where = "WHERE bill_date >= %s" if since else ""
+    params = (since,) if since else ()
+    rate = GST_DEFAULT_RATE
+    try:
+        if since:
+            cur.execute("DELETE FROM gst_ledger WHERE bill_date >= %s", params)
+            cur.execute("DELETE FROM gst_daily WHERE day >= %s", params)
+        else:
+            cur.execute("DELETE FROM gst_ledger")
+            cur.execute("DELETE FROM gst_daily")
+        cur.execute(f"""
+            INSERT INTO gst_ledger (
+                bill_id, invoice_no, bill_date, gst_rate, gross_amount, discount,
+                taxable_amount, cgst, sgst, gst, total_amount
+            )
+            SELECT h.id, h.invoice_no, h.bill_date, COALESCE(b.gst_rate, %s) AS rate,
+                   SUM(b.total_amount), SUM(b.discount), SUM(b.total_amount - b.discount),
+                   ROUND(SUM(b.gst) / 2, 2), SUM(b.gst) - ROUND(SUM(b.gst) / 2, 2),
+                   SUM(b.gst), SUM(b.final_amount)
+            FROM bill_headers h
+            JOIN bills b ON b.bill_id = h.id
+            {ledger_where}
+            GROUP BY h.id, h.invoice_no, h.bill_date, rate
+        """, (rate,) + params)
+        lines = cur.rowcount
+        cur.execute(f"""
+            INSERT INTO gst_daily (
+                day, gst_rate, bill_count, gross_amount, discount,
+                taxable_amount, cgst, sgst, gst, total_amount
+            )
+            SELECT DATE(bill_date), gst_rate, COUNT(*), SUM(gross_amount), SUM(discount),
+                   SUM(taxable_amount), SUM(cgst), SUM(sgst), SUM(gst), SUM(total_amount)
+            FROM gst_ledger
+            {daily_where}
+            GROUP BY DATE(bill_date), gst_rate
+        """, params)
+        db.commit()
+        print(f"✅ Rebuilt GST ledger ({lines} lines, {cur.rowcount} day totals).")
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"❌ GST Ledger Rebuild Error: {e}")
+        return False
+    finally:
+        db.close()
+
+@app.cli.command('rebuild-gst-ledger')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Only rebuild bills on or after this date (YYYY-MM-DD).')
+def rebuild_gst_ledger_command(since):
+    """Rebuild the GST ledger and its daily totals from bill line items"""
+    rebuild_gst_ledger(since.date() if since else None)
+
+def reprice_bills(since=None, until=None, dry_run=False):
+    """
+    Re-apply the current GST slabs to historical bill lines in one set-based
+    pass (discounts as charged are kept), re-total the affected bill headers and
+    rebuild the daily rollups and GST ledger from `since`. Returns the lines changed.
+    """
+    db = get_db_connection()
+    if not db:
+        return None
+
+    conditions, params = ["b.bill_id IS NOT NULL"], []
+    if since:
+        conditions.append("h.bill_date >= %s")
+        params.append(since)
+    if until:
+        conditions.append("h.bill_date < %s")
+        params.append(until + timedelta(days=1))
+    where = " AND ".join(conditions)
+    # products.name isn't unique, so take one slab per name
+    new_rate = "COALESCE(p.gst_rate, %s)"
+    new_gst = f"ROUND((b.total_amount - b.discount) * {new_rate} / 100, 2)"
+    joins = """
+        FROM bills b
+        JOIN bill_headers h ON h.id = b.bill_id
+        LEFT JOIN (SELECT name, MAX(gst_rate) AS gst_rate FROM products GROUP BY name) p
+               ON p.name = b.medicine_name
+    """
+    changed = f"(b.gst <> {new_gst} OR NOT (b.gst_rate <=> {new_rate}))"
+
+    cur = db.cursor()
+    try:
+        cur.execute(f"""
+            SELECT COUNT(*), COUNT(DISTINCT b.bill_id), COALESCE(SUM({new_gst} - b.gst), 0)
+            {joins}
+            WHERE {where} AND {changed}
+        """, [GST_DEFAULT_RATE] + params + [GST_DEFAULT_RATE, GST_DEFAULT_RATE])
+        lines, bills, delta = cur.fetchone()
+        print(f"{'🔍 Would reprice' if dry_run else '✅ Repricing'} {lines} lines on {bills} bills "
+              f"(GST change ₹{delta}).")
+        if dry_run or not lines:
+            return lines
+
+        cur.execute(f"""
+            UPDATE bills b
+            JOIN bill_headers h ON h.id = b.bill_id
+            LEFT JOIN (SELECT name, MAX(gst_rate) AS gst_rate FROM products GROUP BY name) p
+                   ON p.name = b.medicine_name
+            SET b.gst_rate = {new_rate},
+                b.gst = {new_gst},
+                b.final_amount = b.total_amount - b.discount + {new_gst}
+            WHERE {where}
+        """, [GST_DEFAULT_RATE, GST_DEFAULT_RATE, GST_DEFAULT_RATE] + params)
+        cur.execute(f"""
+            UPDATE bill_headers h
+            JOIN (
+                SELECT b.bill_id, SUM(b.gst) AS gst, SUM(b.final_amount) AS final_amount
+                FROM bills b
+                JOIN bill_headers h ON h.id = b.bill_id
+                WHERE {where}
+                GROUP BY b.bill_id
+            ) t ON t.bill_id = h.id
+            SET h.gst = t.gst, h.final_amount = t.final_amount
+        """, params)
+        db.commit()
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Reprice Error: {e}")
+        return None
+    finally:
+        db.close()
+
+    rebuild_sales_rollup(since)
+    rebuild_gst_ledger(since)
+    return lines
+
+@app.cli.command('reprice-bills')
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Only reprice bills on or after this date (YYYY-MM-DD).')
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Only reprice bills on or before this date (YYYY-MM-DD).')
+@click.option('--dry-run', is_flag=True, help='Report what would change without writing.')
+def reprice_bills_command(since, until, dry_run):
+    """Re-apply current GST slabs to historical bills"""
+    reprice_bills(since.date() if since else None, until.date() if until else None, dry_run)
+
+@app.cli.command('set-gst-rate')
+@click.argument('rate', type=click.Choice([str(slab) for slab in GST_SLABS]))
+@click.option('--product', default=None, help='Product name.')
+@click.option('--manufacturer', default=None, help='Every product of this manufacturer.')
+def set_gst_rate_command(rate, product, manufacturer):
+    """Set the GST slab (percent) of a product or a manufacturer's products"""
+    if bool(product) == bool(manufacturer):
+        raise click.UsageError("Pass exactly one of --product or --manufacturer.")
+    db = get_db_connection()
+    if not db:
+        return
+    cur = db.cursor()
+    column, value = ('name', product) if product else ('manufacture', manufacturer)
+    cur.execute(f"UPDATE products SET gst_rate = %s WHERE {column} = %s", (rate, value))
+    db.commit()
+    db.close()
+    pricing_engine.invalidate()
+    print(f"✅ GST slab {rate}% set on {cur.rowcount} products.")
+
+@app.cli.command('add-discount-rule')
+@click.argument('percent', type=click.FloatRange(0, 100))
+@click.option('--product', default=None, help='Applies to this product only.')
+@click.option('--manufacturer', default=None, help="Applies to this manufacturer's products.")
+@click.option('--min-qty', type=click.IntRange(1), default=1, help='Minimum quantity on the bill line.')
+@click.option('--from', 'starts_on', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+@click.option('--to', 'ends_on', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+def add_discount_rule_command(percent, product, manufacturer, min_qty, starts_on, ends_on):
+    """Add a discount rule (store-wide unless --product or --manufacturer is given)"""
+    if product and manufacturer:
+        raise click.UsageError("Pass at most one of --product or --manufacturer.")
+    scope, value = ('product', product) if product else \
+        ('manufacturer', manufacturer) if manufacturer else ('all', None)
+    db = get_db_connection()
+    if not db:
+        return
+    cur = db.cursor()
+    cur.execute("""
+        INSERT INTO discount_rules (scope, match_value, percent, min_qty, starts_on, ends_on)
+        VALUES (%s, %s, %s, %s, %s, %s)
+    """, (scope, value, round(percent, 2), min_qty,
+          starts_on.date() if starts_on else None, ends_on.date() if ends_on else None))
+    db.commit()
+    db.close()
+    pricing_engine.invalidate()
+    print(f"✅ Added {percent}% {scope} discount rule #{cur.lastrowid}.")
+
+@app.cli.command('rebuild-reorder-plan')
+@click.option('--backfill', is_flag=True,
+              help='First rebuild per-product daily sales from the bills table.')
+def rebuild_reorder_plan_command(backfill):
+    """Recompute reorder points and restock targets from sales velocity"""
+    if backfill and not rebuild_product_sales():
+        return
+    rebuild_reorder_plan()
+
 # ========================================
 # 8. ROUTES - CUSTOMER MANAGEMENT
 # ========================================
@@ -1183,19 +4812,35 @@ def add_customer():
         db = get_db_connection()
         if db:
             cur = db.cursor()
-            cur.execute("""
-                INSERT INTO customers (customer_name, phone, medicine_name, manufacturer, dose, quantity)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (
-                request.form.get('name'),
-                request.form.get('phone'),
-                request.form.get('medicine_name'),
-                request.form.get('manufacturer'),
-                request.form.get('dose'),
-                int(request.form.get('quantity', 0))
-            ))
-            db.commit()
-            db.close()
+            quantity = int(request.form.get('quantity', 0))
+            try:
+                cur.execute("""
+                    INSERT INTO customers (customer_name, phone, medicine_name, manufacturer, dose, quantity)
+                    VALUES (%s, %s, %s, %s, %s, %s)
+                """, (
+                    request.form.get('name'),
+                    request.form.get('phone'),
+                    request.form.get('medicine_name'),
+                    request.form.get('manufacturer'),
+                    request.form.get('dose'),
+                    quantity
+                ))
+                record_customer_visit(
+                    cur,
+                    request.form.get('name'),
+                    request.form.get('phone'),
+                    {request.form.get('medicine_name'): quantity},
+                    datetime.now(),
+                    manufacturer=request.form.get('manufacturer') or None,
+                    dose=request.form.get('dose') or None
+                )
+                db.commit()
+            except Exception as e:
+                db.rollback()
+                print(f"❌ Add Customer Error: {e}")
+            finally:
+                db.close()
+            invalidate_dashboard('customers')
         return redirect(url_for('staff'))
     return render_template('add_customer.html')
 
@@ -1205,15 +4850,108 @@ def find_customer():
     if session.get('role') != 'staff':
         return redirect(url_for('login_page'))
     customer = None
+    phone_searched = None
     if request.method == 'POST':
-        phone = request.form.get('phone')
-        db = get_db_connection()
-        if db:
-            cur = db.cursor(dictionary=True)
-            cur.execute("SELECT * FROM customers WHERE phone = %s", (phone,))
-            customer = cur.fetchone()
-            db.close()
-    return render_template('find_customer.html', customer=customer)
+        phone_searched = request.form.get('phone')
+        customer = find_customer_profile(phone_searched)
+    return render_template('find_customer.html', customer=customer, phone_searched=phone_searched)
+
+def backfill_customer_profiles():
+    """
+    Rebuild customer_profiles and customer_medicines from the customers table
+    and past bills: every customers row and every bill counts as one order.
+    """
+    db = get_db_connection()
+    if not db:
+        return False
+
+    profiles, medicines = {}, {}
+
+    def add(name, phone, medicine, qty, when, manufacturer=None, dose=None, new_order=True):
+        phone_norm = normalize_phone(phone)
+        if not phone_norm or not medicine:
+            return
+        qty = int(qty or 0)
+        p = profiles.setdefault(phone_norm, {'name': None, 'phone': phone, 'orders': 0, 'qty': 0, 'last': None})
+        p['name'] = name or p['name']
+        p['phone'] = phone
+        p['orders'] += 1 if new_order else 0
+        p['qty'] += qty
+        if when and (p['last'] is None or when > p['last']):
+            p['last'] = when
+        m = medicines.setdefault((phone_norm, medicine), {
+            'manufacturer': None, 'dose': None, 'qty': 0, 'last_qty': 0, 'times': 0, 'last': None})
+        m['manufacturer'] = manufacturer or m['manufacturer']
+        m['dose'] = dose or m['dose']
+        m['qty'] += qty
+        m['last_qty'] = qty
+        m['times'] += 1
+        if when and (m['last'] is None or when >= m['last']):
+            m['last'] = when
+
+    cur = db.cursor(dictionary=True)
+    try:
+        cur.execute("SELECT customer_name, phone, medicine_name, manufacturer, dose, quantity FROM customers")
+        while True:
+            batch = cur.fetchmany(CUSTOMER_BACKFILL_BATCH)
+            if not batch:
+                break
+            for r in batch:
+                add(r['customer_name'], r['phone'], r['medicine_name'], r['quantity'], None,
+                    r['manufacturer'], r['dose'])
+
+        # Bill lines arrive grouped by bill, so each bill counts as one order
+        cur.execute("""
+            SELECT h.id, h.customer_name, h.phone, h.bill_date, b.medicine_name, b.quantity
+            FROM bill_headers h
+            JOIN bills b ON b.bill_id = h.id
+            ORDER BY h.id
+        """)
+        last_bill = None
+        while True:
+            batch = cur.fetchmany(CUSTOMER_BACKFILL_BATCH)
+            if not batch:
+                break
+            for r in batch:
+                add(r['customer_name'], r['phone'], r['medicine_name'], r['quantity'], r['bill_date'],
+                    new_order=r['id'] != last_bill)
+                last_bill = r['id']
+
+        unique = Counter(phone_norm for phone_norm, _ in medicines)
+        cur = db.cursor()
+        cur.execute("DELETE FROM customer_medicines")
+        cur.execute("DELETE FROM customer_profiles")
+        rows = [(k, p['name'], p['phone'], p['orders'], p['qty'], unique[k], p['last'])
+                for k, p in profiles.items()]
+        for i in range(0, len(rows), CUSTOMER_BACKFILL_BATCH):
+            cur.executemany("""
+                INSERT INTO customer_profiles
+                    (phone_norm, customer_name, phone, order_count, total_quantity, unique_medicines, last_visit)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+            """, rows[i:i + CUSTOMER_BACKFILL_BATCH])
+        rows = [(k[0], k[1], m['manufacturer'], m['dose'], m['qty'], m['last_qty'], m['times'], m['last'])
+                for k, m in medicines.items()]
+        for i in range(0, len(rows), CUSTOMER_BACKFILL_BATCH):
+            cur.executemany("""
+                INSERT INTO customer_medicines
+                    (phone_norm, medicine_name, manufacturer, dose, quantity, last_quantity, times, last_bought)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            """, rows[i:i + CUSTOMER_BACKFILL_BATCH])
+        db.commit()
+        invalidate_dashboard('customers')
+        print(f"✅ Built {len(profiles)} customer profiles ({len(medicines)} customer medicines).")
+        return True
+    except Exception as e:
+        db.rollback()
+        print(f"❌ Customer Backfill Error: {e}")
+        return False
+    finally:
+        db.close()
+
+@app.cli.command('backfill-customers')
+def backfill_customers_command():
+    """Build customer profiles from the customers table and past bills"""
+    backfill_customer_profiles()
 
 @app.route('/to_billing')
 def to_billing():
@@ -1223,10 +4961,201 @@ def to_billing():
     return redirect(url_for('billing'))
 
 # ========================================
-# 9. APPLICATION START
+# 9. BACKGROUND JOBS & APPLICATION START
 # ========================================
+class Scheduler:
+    """
+    Runs periodic housekeeping jobs in one daemon thread per worker process.
+    Intervals get random jitter so workers don't fire in lockstep. A shared job
+    takes a MySQL GET_LOCK and checks scheduler_runs, so only one worker runs it
+    per interval; a local job (per-process caches) runs in every worker.
+    """
+
+    def __init__(self, tick=SCHEDULER_TICK, jitter=SCHEDULER_JITTER):
+        self.tick = tick
+        self.jitter = jitter
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add(self, name, func, interval, shared=True):
+        # First runs are spread over the first jittered interval
+        self._jobs[name] = {
+            'func': func, 'interval': interval, 'shared': shared,
+            'next_run': time.monotonic() + random.uniform(0, interval * self.jitter) + self.tick,
+            'stats': {'runs': 0, 'failures': 0, 'skipped': 0, 'total': 0.0, 'max': 0.0,
+                      'last': None, 'last_run': None, 'last_error': None},
+        }
+
+    def job_names(self):
+        return sorted(self._jobs)
+
+    def start(self):
+        """Start the scheduler thread (once per process)"""
+        if self._thread and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+            self._thread.start()
+        print(f"⏱️ Scheduler started with {len(self._jobs)} jobs.")
+
+    def stop(self):
+        self._stop.set()
+
+    def _loop(self):
+        while not self._stop.wait(self.tick):
+            for name, job in list(self._jobs.items()):
+                if time.monotonic() >= job['next_run']:
+                    self.run(name)
+
+    def _reschedule(self, job):
+        spread = job['interval'] * self.jitter
+        job['next_run'] = time.monotonic() + job['interval'] + random.uniform(-spread, spread)
+
+    def run(self, name, force=False):
+        """Run one job now (force skips the 'another worker ran it recently' check)"""
+        job = self._jobs[name]
+        self._reschedule(job)
+        if not job['shared']:
+            return self._execute(name, job)
+
+        db = get_db_connection()
+        if not db:
+            return 'skipped'
+        cur = db.cursor()
+        lock_name = f"{DB_CONFIG['database']}.job.{name}"
+        try:
+            cur.execute("SELECT GET_LOCK(%s, 0)", (lock_name,))
+            if not cur.fetchone()[0]:
+                job['stats']['skipped'] += 1       # another worker is running it
+                return 'skipped'
+            try:
+                cur.execute("""
+                    SELECT TIMESTAMPDIFF(SECOND, last_finished, NOW())
+                    FROM scheduler_runs WHERE job = %s
+                """, (name,))
+                row = cur.fetchone()
+                if not force and row and row[0] is not None and row[0] < job['interval'] * (1 - self.jitter):
+                    job['stats']['skipped'] += 1   # another worker ran it recently
+                    return 'skipped'
+                cur.execute("""
+                    INSERT INTO scheduler_runs (job, last_started) VALUES (%s, NOW())
+                    ON DUPLICATE KEY UPDATE last_started = VALUES(last_started)
+                """, (name,))
+                db.commit()
+
+                outcome = self._execute(name, job)
+                stats = job['stats']
+                cur.execute("""
+                    UPDATE scheduler_runs
+                    SET last_finished = NOW(), last_status = %s, last_duration = %s, last_error = %s
+                    WHERE job = %s
+                """, (outcome, stats['last'], (stats['last_error'] or '')[:500] or None, name))
+                db.commit()
+                return outcome
+            finally:
+                cur.execute("SELECT RELEASE_LOCK(%s)", (lock_name,))
+                cur.fetchone()
+        except Exception as e:
+            print(f"❌ Scheduler error on '{name}': {e}")
+            return 'error'
+        finally:
+            db.close()
+
+    def _execute(self, name, job):
+        stats = job['stats']
+        start = time.monotonic()
+        outcome = 'ok'
+        try:
+            job['func']()
+            stats['last_error'] = None
+        except Exception as e:
+            outcome = 'error'
+            stats['failures'] += 1
+            stats['last_error'] = str(e)
+            print(f"❌ Job '{name}' failed: {e}")
+        elapsed = time.monotonic() - start
+        stats['runs'] += 1
+        stats['total'] += elapsed
+        stats['max'] = max(stats['max'], elapsed)
+        stats['last'] = round(elapsed, 6)
+        stats['last_run'] = datetime.now().isoformat(timespec='seconds')
+        return outcome
+
+    def stats(self):
+        data = {}
+        now = time.monotonic()
+        for name, job in self._jobs.items():
+            s = dict(job['stats'])
+            s['avg'] = round(s.pop('total') / s['runs'], 6) if s['runs'] else None
+            s['max'] = round(s['max'], 6)
+            s['interval'] = job['interval']
+            s['shared'] = job['shared']
+            s['next_run_in'] = round(max(0, job['next_run'] - now), 1)
+            data[name] = s
+        return {'running': bool(self._thread and self._thread.is_alive()), 'jobs': data}
+
+
+def reconcile_rollups():
+    """Rebuild the last few days of rollups and the whole reorder plan"""
+    since = datetime.now().date() - timedelta(days=ROLLUP_REBUILD_DAYS - 1)
+    rebuild_sales_rollup(since)
+    rebuild_gst_ledger(since)
+    if rebuild_product_sales(since):
+        rebuild_reorder_plan()
+
+def warm_dashboard_cache():
+    """
+    Recompute, just before they expire, only the widget entries a page asked
+    for within the last TTL, so an open dashboard keeps hitting a warm cache
+    and nobody watching means no background queries.
+    """
+    for name, args, kwargs in dashboard_cache.recently_used(DASHBOARD_CACHE_TTL):
+        try:
+            dashboard_refreshers[name](*args, **dict(kwargs))
+        except Exception as e:
+            print(f"❌ Cache warm of '{name}' failed: {e}")
+
+def sweep_expired_stock():
+    """Report (or, with EXPIRY_AUTO_WRITE_OFF, write off) expired and expiring stock"""
+    if EXPIRY_AUTO_WRITE_OFF:
+        write_off_expired()
+    counts = get_expiry_counts()
+    if counts['expired'] or counts['expiring']:
+        print(f"⚠️ Expiry sweep: {counts['expired']} expired, {counts['expiring']} expiring "
+              f"within {EXPIRY_ALERT_DAYS} days.")
+
+def purge_sessions():
+    app.session_interface.store.purge()
+
+
+scheduler = Scheduler()
+scheduler.add('order_cleanup', cleanup_old_orders, ORDER_CLEANUP_INTERVAL)
+scheduler.add('rollups', reconcile_rollups, ROLLUP_REBUILD_INTERVAL)
+scheduler.add('expiry_sweep', sweep_expired_stock, EXPIRY_SWEEP_INTERVAL)
+scheduler.add('cache_warm', warm_dashboard_cache, CACHE_WARM_INTERVAL)
+scheduler.add('session_purge', purge_sessions, SESSION_PURGE_INTERVAL, shared=False)
+
+@app.before_request
+def start_scheduler():
+    """Start the job thread in whichever process actually serves requests"""
+    if SCHEDULER_ENABLED:
+        scheduler.start()
+
+@app.cli.command('run-job')
+@click.argument('name', type=click.Choice(scheduler.job_names()))
+def run_job_command(name):
+    """Run one background job now (e.g. from cron when the scheduler is disabled)"""
+    print(f"Job '{name}': {scheduler.run(name, force=True)}")
+
 if __name__ == "__main__":
     print("🚀 PHARMACLOUD PRO - STARTING...")
     init_user_list() # <--- Add this line here
+    init_db_schema()
+    threading.Thread(target=catalog_index.rebuild, daemon=True).start()
     app.run(debug=True, host='0.0.0.0', port=5000)
 
@@ -0,0 +1,84 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as store  # noqa: E402
+
+
+class FakeCursor:
+    """
+    Records statements; answers SELECTs from (sql fragment, rows) pairs and
+    sets rowcount for writes from (sql fragment, params -> count) pairs.
+    """
+
+    def __init__(self, results=(), rowcounts=()):
+        self.results = list(results)
+        self.rowcounts = list(rowcounts)
+        self.executed = []
+        self.rows = []
+        self.rowcount = 0
+        self.lastrowid = 1
+
+    def execute(self, sql, params=()):
+        self.executed.append((' '.join(sql.split()), params))
+        self.rows = next((rows for fragment, rows in self.results if fragment in sql), [])
+        count = next((count for fragment, count in self.rowcounts if fragment in sql), None)
+        self.rowcount = count(params) if count else len(self.rows)
+
+    def executemany(self, sql, seq):
+        seq = list(seq)
+        for params in seq:
+            self.executed.append((' '.join(sql.split()), params))
+        self.rowcount = len(seq)
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def statements(self, fragment):
+        return [params for sql, params in self.executed if fragment in sql]
+
+    def close(self):
+        pass
+
+
+class FakeDB:
+    def __init__(self, cursor):
+        self.cur = cursor
+        self.committed = False
+        self.rolled_back = False
+
+    def cursor(self, **kwargs):
+        return self.cur
+
+    def commit(self):
+        self.committed = True
+
+    def rollback(self):
+        self.rolled_back = True
+
+    def close(self):
+        pass
+
+
+@pytest.fixture(autouse=True)
+def quiet_side_effects(monkeypatch):
+    """Keep cache invalidation, catalog sync and reorder scheduling out of unit tests"""
+    for name in ('invalidate_dashboard', 'on_catalog_changed', 'schedule_reorder_update'):
+        monkeypatch.setattr(store, name, lambda *args, **kwargs: None)
+    monkeypatch.setattr(store.catalog_index, 'record_sales', lambda *args: None)
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """Point get_db_connection at a FakeDB answering from the given results"""
+    def install(results=(), rowcounts=()):
+        db = FakeDB(FakeCursor(results, rowcounts))
+        monkeypatch.setattr(store, 'get_db_connection', lambda: db)
+        return db
+    return install
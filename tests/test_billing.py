@@ -0,0 +1,107 @@
+from datetime import date, datetime
+
+import pytest
+
+import app as store
+
+
+def line(name, quantity, price=10.0):
+    amount = price * quantity
+    return {'name': name, 'price': price, 'quantity': quantity, 'total_amount': amount,
+            'discount': 0, 'gst': 0, 'gst_rate': 5, 'final_amount': amount}
+
+
+def totals(items):
+    amount = sum(item['final_amount'] for item in items)
+    return {'subtotal': amount, 'discount': 0, 'gst': 0, 'final_amount': amount}
+
+
+# The decrement matches every picked batch (two params per batch) unless a test says otherwise
+DECREMENT = 'SET p.countInStock = p.countInStock - d.qty'
+ALL_MATCHED = [(DECREMENT, lambda params: len(params) // 2)]
+
+
+def batch(row_id, name, stock, expired=False):
+    return {'id': row_id, 'name': name, 'stock': stock, 'expired': expired}
+
+
+def test_allocate_fefo_takes_earliest_batches_first():
+    rows = [batch(1, 'Dolo', 3), batch(2, 'Dolo', 5), batch(3, 'Dolo', 9)]
+    takes, short = store.allocate_fefo(rows, {'Dolo': 6})
+    assert [(row['id'], qty) for row, qty in takes] == [(1, 3), (2, 3)]
+    assert short == {}
+
+
+def test_allocate_fefo_skips_expired_and_reports_shortfall():
+    rows = [batch(1, 'Dolo', 4, expired=True), batch(2, 'Dolo', 2), batch(3, 'Crocin', 1)]
+    takes, short = store.allocate_fefo(rows, {'Dolo': 3, 'Crocin': 1})
+    assert [(row['id'], qty) for row, qty in takes] == [(2, 2), (3, 1)]
+    assert short == {'Dolo': 1}
+
+
+def test_get_fefo_picks_lists_racks_and_expired_stock(fake_db):
+    fake_db([('FROM products', [
+        {'name': 'Dolo', 'shelf_rack': 'A1', 'expirydate': date(2020, 1, 1), 'stock': 4, 'expired': 1},
+        {'name': 'Dolo', 'shelf_rack': 'A2', 'expirydate': date(2030, 1, 1), 'stock': 2, 'expired': 0},
+        {'name': 'Dolo', 'shelf_rack': 'A3', 'expirydate': None, 'stock': 5, 'expired': None},
+    ])])
+    picks = store.get_fefo_picks({'Dolo': 4})['Dolo']
+    assert [(p['shelf_rack'], p['quantity']) for p in picks['picks']] == [('A2', 2), ('A3', 2)]
+    assert [(p['shelf_rack'], p['quantity']) for p in picks['expired']] == [('A1', 4)]
+
+
+def test_commit_bill_decrements_every_batch_in_one_statement(fake_db):
+    db = fake_db([('FOR UPDATE', [(11, 'Dolo', 2, 0), (12, 'Dolo', 10, 0), (21, 'Crocin', 5, 0)])],
+                 ALL_MATCHED)
+    items = [line('Dolo', 5), line('Crocin', 1)]
+    invoice_no = store.commit_bill('Asha', '98765 43210', items, totals(items), datetime(2024, 5, 1, 10))
+
+    assert invoice_no == store.format_invoice_no(1)
+    assert db.committed and not db.rolled_back
+    decrements = db.cur.statements(DECREMENT)
+    assert decrements == [[11, 2, 12, 3, 21, 1]]
+
+
+def test_commit_bill_rejects_a_batch_that_changed_under_it(fake_db):
+    db = fake_db([('FOR UPDATE', [(11, 'Dolo', 2, 0), (12, 'Dolo', 10, 0)])],
+                 [(DECREMENT, lambda params: 1)])
+    items = [line('Dolo', 5)]
+    with pytest.raises(store.BillingError, match='Stock changed'):
+        store.commit_bill('Asha', '9876543210', items, totals(items), datetime(2024, 5, 1, 10))
+    assert db.rolled_back and not db.committed
+
+
+def test_commit_bill_checks_the_sum_of_unexpired_batches(fake_db):
+    db = fake_db([('FOR UPDATE', [(11, 'Dolo', 3, 1), (12, 'Dolo', 2, 0), (13, 'Dolo', 2, 0)])])
+    items = [line('Dolo', 5)]
+    with pytest.raises(store.BillingError, match=r'Dolo \(4 left\)'):
+        store.commit_bill('Asha', '9876543210', items, totals(items), datetime(2024, 5, 1, 10))
+    assert db.rolled_back and not db.committed
+    assert not db.cur.statements(DECREMENT)
+
+
+def test_commit_bill_sells_across_batches_when_no_single_one_suffices(fake_db):
+    db = fake_db([('FOR UPDATE', [(11, 'Dolo', 3, 0), (12, 'Dolo', 3, 0)])], ALL_MATCHED)
+    items = [line('Dolo', 5)]
+    store.commit_bill('Asha', '9876543210', items, totals(items), datetime(2024, 5, 1, 10))
+    assert db.cur.statements(DECREMENT) == [[11, 3, 12, 2]]
+
+
+def test_commit_bill_rolls_repeated_lines_into_one_product_day(fake_db):
+    db = fake_db([('FOR UPDATE', [(11, 'Dolo', 9, 0), (21, 'Crocin', 5, 0)])], ALL_MATCHED)
+    items = [line('Dolo', 2), line('Crocin', 1, price=25.0), line('Dolo', 3)]
+    store.commit_bill('Asha', '9876543210', items, totals(items), datetime(2024, 5, 1, 10))
+    assert db.cur.statements('INSERT INTO product_sales_daily') == [
+        ('Dolo', date(2024, 5, 1), 5, 50.0),
+        ('Crocin', date(2024, 5, 1), 1, 25.0),
+    ]
+
+
+def test_top_selling_medicines_read_the_product_rollup(fake_db):
+    db = fake_db([('FROM product_sales_daily', [
+        {'medicine_name': 'Dolo', 'total_sold': 40, 'total_revenue': 400},
+    ])])
+    data = store.get_top_selling_medicines.refresh(5)
+    assert data[0]['medicine_name'] == 'Dolo'
+    assert not db.cur.statements('FROM bills')
+
@@ -0,0 +1,36 @@
+from datetime import datetime
+
+import pytest
+
+import app as store
+
+
+@pytest.mark.parametrize('raw, expected', [
+    ('98765 43210', '9876543210'),
+    ('+91-98765-43210', '9876543210'),
+    ('098765 43210', '9876543210'),
+    ('', ''),
+    (None, ''),
+    ('n/a', ''),
+])
+def test_normalize_phone_keeps_the_last_ten_digits(raw, expected):
+    assert store.normalize_phone(raw) == expected
+
+
+def test_visit_updates_profile_and_medicine_counters(fake_db):
+    cur = fake_db().cur
+    when = datetime(2024, 5, 1, 10)
+    store.record_customer_visit(cur, 'Asha', '+91 98765 43210', {'Dolo': 2, 'Crocin': 1}, when)
+
+    profile = cur.statements('INSERT INTO customer_profiles')
+    assert profile == [('9876543210', 'Asha', '+91 98765 43210', 3, when)]
+    medicines = cur.statements('INSERT INTO customer_medicines')
+    assert [(row[1], row[4]) for row in medicines] == [('Dolo', 2), ('Crocin', 1)]
+    assert cur.statements('SET unique_medicines') == [('9876543210', '9876543210')]
+
+
+def test_visit_without_a_usable_phone_records_nothing(fake_db):
+    cur = fake_db().cur
+    store.record_customer_visit(cur, 'Asha', 'walk-in', {'Dolo': 2})
+    store.record_customer_visit(cur, 'Asha', '9876543210', {'': 2})
+    assert not cur.executed
@@ -0,0 +1,17 @@
+import app as store
+
+
+def test_write_off_moves_expired_stock_and_zeroes_it(fake_db):
+    db = fake_db([('FOR UPDATE', [(4, 'Dolo', 6), (9, 'Crocin', 2)])])
+    assert store.write_off_expired() == 8
+    assert db.committed
+    reason, _, *ids = db.cur.statements('INSERT INTO stock_writeoffs')[0]
+    assert (reason, ids) == ('expired', [4, 9])
+    assert db.cur.statements('UPDATE products SET countInStock = 0') == [[4, 9]]
+
+
+def test_write_off_of_nothing_selected_touches_nothing(fake_db):
+    db = fake_db()
+    assert store.write_off_expired([]) == 0
+    assert not db.cur.executed
+
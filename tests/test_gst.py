@@ -0,0 +1,55 @@
+from datetime import date, datetime
+from decimal import Decimal
+
+import app as store
+
+
+def item(quantity, total, discount, gst, rate):
+    return {'name': 'x', 'quantity': quantity, 'total_amount': total, 'discount': discount,
+            'gst': gst, 'gst_rate': rate, 'final_amount': total - discount + gst}
+
+
+def test_gst_lines_group_by_rate():
+    lines = store.gst_lines([
+        item(1, 100, 8, 4.6, 5),
+        item(2, 200, 16, 9.2, 5),
+        item(1, 50, 4, 5.52, 12),
+    ])
+    assert sorted(lines) == [Decimal('5.00'), Decimal('12.00')]
+    five = lines[Decimal('5.00')]
+    assert five['gross_amount'] == Decimal('300.00')
+    assert five['taxable_amount'] == Decimal('276.00')
+    assert five['gst'] == Decimal('13.80')
+    assert five['total_amount'] == Decimal('289.80')
+
+
+def test_cgst_and_sgst_always_add_up_to_the_tax():
+    lines = store.gst_lines([item(1, 1, 0, 0.05, 5)])
+    line = lines[Decimal('5.00')]
+    assert (line['cgst'], line['sgst']) == (Decimal('0.03'), Decimal('0.02'))
+    assert line['cgst'] + line['sgst'] == line['gst']
+
+
+def test_gst_lines_skip_unbilled_lines_and_default_the_rate():
+    unrated = item(1, 10, 0, 0.5, None)
+    del unrated['gst_rate']
+    lines = store.gst_lines([unrated, item(0, 99, 0, 9, 18)])
+    assert list(lines) == [Decimal(store.GST_DEFAULT_RATE).quantize(Decimal('0.01'))]
+
+
+def test_record_gst_writes_one_ledger_row_per_rate(fake_db):
+    cur = fake_db().cur
+    store.record_gst(cur, 7, 'INV-7', datetime(2024, 5, 1, 10),
+                     [item(1, 100, 0, 5, 5), item(1, 100, 0, 12, 12)])
+    ledger = cur.statements('INSERT INTO gst_ledger')
+    daily = cur.statements('INSERT INTO gst_daily')
+    assert [row[3] for row in ledger] == [Decimal('5.00'), Decimal('12.00')]
+    assert all(row[0] == date(2024, 5, 1) for row in daily)
+
+
+def test_gst_period_quarters_follow_the_financial_year():
+    assert store.gst_period({'period': '2024-Q4'}) == (date(2025, 1, 1), date(2025, 3, 31), 'Q4 FY 2024-25')
+    start, end, _ = store.gst_period({'period': '2024-02'})
+    assert (start, end) == (date(2024, 2, 1), date(2024, 2, 29))
+    start, end, _ = store.gst_period({}, today=date(2024, 12, 15))
+    assert (start, end) == (date(2024, 12, 1), date(2024, 12, 31))
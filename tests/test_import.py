@@ -0,0 +1,61 @@
+from datetime import date
+
+import pytest
+
+import app as store
+
+# Dolo by Micro is stocked in two batches, the newer one last (FEFO order)
+DOLO_BATCHES = [
+    (1, 'Dolo 650', 'Micro', 30.0, 5, date(2025, 1, 1), 'A1'),
+    (2, 'Dolo 650', 'Micro', 30.0, 7, date(2026, 1, 1), 'A2'),
+]
+
+
+def new_job(mode):
+    return {'id': 'test', 'mode': mode, 'key': 'name', 'inserted': 0, 'updated': 0,
+            'unchanged': 0, 'rejected': 0, 'rejects': [], 'notes': []}
+
+
+def chunk(**row):
+    csv_row = {'name': 'dolo 650', 'price': '30', 'Manufacture': 'micro', 'countInStock': '20',
+               'expirydate': '2027-01-01', 'Shelf/Rack No': 'A2', **row}
+    return [(2, None, store.parse_catalog_row(csv_row))]
+
+
+@pytest.mark.parametrize('mode', ['merge', 'sync'])
+def test_file_row_replaces_every_batch_of_a_product(fake_db, mode):
+    db = fake_db([('FROM products WHERE name IN', DOLO_BATCHES)])
+    job = new_job(mode)
+    store._flush_import_chunk(db, db.cur, job, chunk())
+
+    # The newest batch takes the file's count; the older one is emptied (and logged)
+    assert db.cur.statements('SET price = %s, countInStock = %s') == [(30.0, 20, date(2027, 1, 1), 'A2', 2)]
+    assert db.cur.statements('UPDATE products SET countInStock = 0 WHERE id IN') == [[1]]
+    _, *ids = db.cur.statements("'import-merge'")[0]
+    assert ids == [1]
+    # Matched case-insensitively, so nothing is inserted as a duplicate
+    assert not db.cur.statements('INSERT INTO products')
+    assert (job['inserted'], job['updated'], job['unchanged']) == (0, 1, 0)
+
+
+def test_sync_marks_every_batch_of_a_listed_product_as_seen(fake_db):
+    db = fake_db([('FROM products WHERE name IN', DOLO_BATCHES)])
+    store._flush_import_chunk(db, db.cur, new_job('sync'), chunk())
+    assert sorted(db.cur.statements('INTO import_seen')) == [(1,), (2,)]
+
+
+def test_merge_leaves_a_single_matching_batch_alone(fake_db):
+    db = fake_db([('FROM products WHERE name IN', DOLO_BATCHES[1:])])
+    job = new_job('merge')
+    store._flush_import_chunk(db, db.cur, job, chunk(countInStock='7', expirydate='2026-01-01'))
+    assert not db.cur.statements('SET price = %s, countInStock = %s')
+    assert not db.cur.statements('UPDATE products SET countInStock = 0')
+    assert job['unchanged'] == 1
+
+
+def test_unknown_product_is_inserted(fake_db):
+    db = fake_db([('FROM products WHERE name IN', DOLO_BATCHES)])
+    job = new_job('merge')
+    store._flush_import_chunk(db, db.cur, job, chunk(name='Crocin'))
+    assert len(db.cur.statements('INSERT INTO products')) == 1
+    assert job['inserted'] == 1
@@ -0,0 +1,76 @@
+from datetime import date
+from decimal import Decimal
+
+import pytest
+
+import app as store
+
+PRODUCTS = [
+    {'name': 'Dolo', 'manufacture': 'Micro', 'gst_rate': Decimal('12.00')},
+    {'name': 'Crocin', 'manufacture': 'GSK', 'gst_rate': None},
+]
+
+
+def rule(scope, match_value, percent, min_qty=1, starts_on=None, ends_on=None):
+    return {'scope': scope, 'match_value': match_value, 'percent': Decimal(percent),
+            'min_qty': min_qty, 'starts_on': starts_on, 'ends_on': ends_on}
+
+
+@pytest.fixture
+def engine():
+    return store.PricingEngine()
+
+
+def test_prices_in_exact_paise_with_the_products_slab(fake_db, engine):
+    fake_db([('FROM products', PRODUCTS), ('FROM discount_rules', [])])
+    priced = engine.price([{'name': 'Dolo', 'price': 33.33, 'quantity': 3}])
+    line = priced['items'][0]
+    assert line['total_amount'] == Decimal('99.99')
+    assert line['discount'] == Decimal('8.00')        # 8% of 99.99, half-up
+    assert line['gst_rate'] == Decimal('12.00')
+    assert line['gst'] == Decimal('11.04')            # 12% of 91.99, half-up
+    assert line['final_amount'] == priced['final_amount'] == Decimal('103.03')
+
+
+def test_unrated_products_use_the_default_slab(fake_db, engine):
+    fake_db([('FROM products', PRODUCTS), ('FROM discount_rules', [])])
+    line = engine.price([{'name': 'Crocin', 'price': 100, 'quantity': 1}])['items'][0]
+    assert line['gst_rate'] == Decimal(store.GST_DEFAULT_RATE)
+
+
+def test_most_specific_live_rule_wins(fake_db, engine):
+    fake_db([('FROM products', PRODUCTS), ('FROM discount_rules', [
+        rule('all', None, '2.00'),
+        rule('manufacturer', 'gsk', '10.00', min_qty=2),
+        rule('product', 'dolo', '0.00', ends_on=date(2020, 1, 1)),
+    ])])
+    priced = engine.price([
+        {'name': 'Dolo', 'price': 10, 'quantity': 1},
+        {'name': 'Crocin', 'price': 10, 'quantity': 2},
+    ])
+    rates = {line['name']: line['discount_rate'] for line in priced['items']}
+    assert rates == {'Dolo': Decimal('2.00'), 'Crocin': Decimal('10.00')}
+
+
+def test_min_quantity_gates_a_rule(fake_db, engine):
+    fake_db([('FROM products', PRODUCTS), ('FROM discount_rules', [rule('manufacturer', 'gsk', '10.00', min_qty=2)])])
+    line = engine.price([{'name': 'Crocin', 'price': 10, 'quantity': 1}])['items'][0]
+    assert line['discount_rate'] == Decimal(store.BILL_DISCOUNT_RATE)
+
+
+def test_same_cart_in_any_order_is_served_from_cache(fake_db, engine):
+    fake_db([('FROM products', PRODUCTS), ('FROM discount_rules', [])])
+    cart = [{'name': 'Dolo', 'price': 10, 'quantity': 1}, {'name': 'Crocin', 'price': 5, 'quantity': 2}]
+    first = engine.price(cart)
+    assert engine.price(list(reversed(cart))) is first
+    engine.invalidate()
+    assert engine.price(cart) is not first
+    assert engine.stats()['hits'] == 1
+
+
+def test_unreachable_database_falls_back_without_caching(monkeypatch, engine):
+    monkeypatch.setattr(store, 'get_db_connection', lambda: None)
+    cart = [{'name': 'Dolo', 'price': 10, 'quantity': 1}]
+    line = engine.price(cart)['items'][0]
+    assert line['gst_rate'] == Decimal(store.GST_DEFAULT_RATE)
+    assert engine.stats()['cached_carts'] == 0
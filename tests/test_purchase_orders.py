@@ -0,0 +1,54 @@
+import app as store
+
+
+def test_reorder_quantities_keep_only_products_left_to_order(fake_db):
+    fake_db([('order_qty FROM', [('Dolo', 8), ('Crocin', -2), ('Zinc', 0)])])
+    assert store.get_reorder_quantities(['Dolo', 'Crocin', 'Zinc']) == {'Dolo': 8}
+
+
+def test_low_stock_list_and_restock_read_the_same_stock_position(fake_db):
+    db = fake_db()
+    store.get_reorder_quantities(['Dolo'])
+    store.refresh_low_stock(db.cur, ['Dolo'])
+    position = ' '.join(store.stock_position_sql(['Dolo'])[0].split())
+    reorder_sql, low_stock_sql = db.cur.executed[0][0], db.cur.executed[-1][0]
+    assert position in reorder_sql and position in low_stock_sql
+    # One row per name: stock summed over batches, less what is already on order
+    assert 'SUM(countInStock) AS stock' in position and 'GROUP BY name' in position
+    assert '- COALESCE(o.on_order, 0)' in position
+    assert 'WHERE stock < reorder_point' in low_stock_sql
+
+
+def test_reorder_quantities_of_nothing(fake_db):
+    db = fake_db()
+    assert store.get_reorder_quantities([]) == {}
+    assert not db.cur.executed
+
+
+def test_receiving_credits_only_the_newest_batch(fake_db):
+    db = fake_db([
+        ('FROM purchase_orders', [('ordered',)]),
+        ('SUM(quantity) FROM orders', [('Dolo', 10), ('Crocin', 4)]),
+        ('SELECT id, name FROM products', [(3, 'Crocin'), (1, 'Dolo'), (7, 'Dolo')]),
+    ])
+    assert store.receive_purchase_order(5) == 14
+    assert db.committed
+    credits = db.cur.statements('SET countInStock = countInStock + %s')
+    assert sorted(credits) == [(4, 3), (10, 7)]
+
+
+def test_receiving_skips_products_with_no_row(fake_db):
+    db = fake_db([
+        ('FROM purchase_orders', [('ordered',)]),
+        ('SUM(quantity) FROM orders', [('Dolo', 10), ('Gone', 4)]),
+        ('SELECT id, name FROM products', [(1, 'Dolo')]),
+    ])
+    assert store.receive_purchase_order(5) == 10
+    assert db.cur.statements('SET countInStock = countInStock + %s') == [(10, 1)]
+
+
+def test_an_already_received_order_credits_nothing(fake_db):
+    db = fake_db([('FROM purchase_orders', [('received',)])])
+    assert store.receive_purchase_order(5) == 0
+    assert db.rolled_back
+    assert not db.cur.statements('SET countInStock = countInStock + %s')
@@ -0,0 +1,66 @@
+from datetime import date, timedelta
+
+import numpy as np
+
+import app as store
+
+
+def levels(rows, quantities, days):
+    return store.compute_reorder_levels(np.array(rows, dtype=np.int32),
+                                        np.array(quantities, dtype=np.float64),
+                                        np.array(days))
+
+
+def test_velocity_averages_over_each_products_history():
+    # Product 0 sold 10 on each of 10 days of a 10-day history; product 1 sold 30 once in 30 days
+    avg, std, _, _ = levels([0] * 10 + [1], [10.0] * 10 + [30.0], [10, 30])
+    assert avg.tolist() == [10.0, 1.0]
+    assert std[0] == 0
+    assert std[1] > 0
+
+
+def test_reorder_point_covers_lead_time_demand():
+    _, _, reorder_point, order_up_to = levels([0] * 10, [10.0] * 10, [10])
+    lead = store.REORDER_LEAD_TIME_DAYS
+    cover = lead + store.REORDER_REVIEW_DAYS
+    assert reorder_point[0] == 10 * lead
+    assert order_up_to[0] == 10 * cover
+
+
+def test_levels_never_collapse_for_products_with_no_sales():
+    _, _, reorder_point, order_up_to = levels([0], [5.0], [20, 20])
+    assert reorder_point[1] == 1
+    assert order_up_to[1] == 2
+
+
+class SalesCursor:
+    def __init__(self, sales):
+        self.sales = list(sales)
+        self.plan = []
+
+    def execute(self, sql, params=()):
+        pass
+
+    def fetchmany(self, size):
+        batch, self.sales = self.sales[:size], self.sales[size:]
+        return batch
+
+    def executemany(self, sql, seq):
+        if 'INSERT INTO reorder_plan' in sql:
+            self.plan.extend(seq)
+
+
+def test_rebuild_uses_full_history_with_a_minimum_span(fake_db, monkeypatch):
+    today = date.today()
+    cur = SalesCursor([
+        ('Dolo', today - timedelta(days=199), 100),
+        ('Dolo', today, 100),
+        ('Crocin', today, 28),
+    ])
+    db = fake_db()
+    db.cur = cur
+    monkeypatch.setattr(store, 'refresh_low_stock', lambda cur, names=None: None)
+    assert store.rebuild_reorder_plan(['Dolo', 'Crocin'])
+    avg = {row[0]: row[1] for row in cur.plan}
+    assert avg['Dolo'] == 1.0                                   # 200 units over 200 days
+    assert avg['Crocin'] == 28 / store.REORDER_MIN_HISTORY_DAYS  # first day stretched to the minimum